@@ -0,0 +1,435 @@
+"""
+Headless, prompt seeded annotation of whole directories of videos
+
+Takes videos and/or directories (searched recursively) and/or a manifest listing one video per line, and runs the
+same pipeline as VideoAnnotator --headless --prompt on every video, spread over a pool of processes. Like --headless,
+it writes <video-name>.tracked.annotations, so annotation files a human made are never overwritten. Each worker
+loads the prompt model once and keeps it for every video it gets, only the detection cache is swapped per video.
+A video's segments are tracked inside its worker, the pool already keeps every core busy
+
+Progress is kept in a job state file that is rewritten after every finished video, so a killed run picks up where
+it stopped: finished videos are skipped unless they, the prompt, the options that shape the annotations (see
+run_settings) or where they are written changed since, failed ones are retried with --retry-failed
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from utils.DetectionCache import open_detection_cache, video_content_hash
+from utils.HeadlessTracker import (
+    headless_track_scale,
+    run_headless,
+    seeds_from_prompt,
+)
+from utils.Paths import (
+    VIDEO_EXTENSIONS,
+    default_annotation_path,
+    tracked_annotation_path,
+)
+from utils.PromptDetector import DETECTOR_BACKENDS, PromptDetector
+from utils.Trackers import TRACKER_BACKENDS
+
+STATE_VERSION: int = 1
+
+
+@dataclass(frozen=True)
+class BatchOptions:
+    segment_frames: int = 1800
+    prompt_threshold: float = 0.1
+    detection_cache_mb: int = 256
+    tracker: str = "csrt"
+    track_scale: float = 0
+    binary: bool = False
+
+
+# The prompt model of this worker process, loaded once by init_worker
+worker_detector: PromptDetector | None = None
+
+
+def init_worker(
+    prompt_str: str,
+    model_threads: int,
+    prompt_batch: int,
+    detector_backend: str = "eager",
+    model_cache_dir: str = "",
+) -> None:
+    global worker_detector
+    worker_detector = PromptDetector(
+        prompt_str,
+        batch_size=prompt_batch,
+        num_threads=model_threads,
+        backend=detector_backend,
+        model_cache_dir=model_cache_dir,
+    )
+
+
+def annotate_video(
+    video_path: str, annotation_path: str, options: BatchOptions
+) -> Dict:
+    """
+    Prompt seeds and headless tracking of one video with this worker's model, returns its job state entry
+    """
+    start_time = time.perf_counter()
+    window_scale = (
+        options.track_scale
+        if options.track_scale > 0
+        else headless_track_scale(video_path)
+    )
+    worker_detector.cache = open_detection_cache(
+        video_path, annotation_path, options.detection_cache_mb
+    )
+    try:
+        seeds = seeds_from_prompt(
+            video_path,
+            worker_detector,
+            options.segment_frames,
+            window_scale,
+            threshold=options.prompt_threshold,
+        )
+        if not seeds:
+            return {
+                "status": "failed",
+                "error": "The prompt found nothing on any segment boundary",
+            }
+        store = run_headless(
+            video_path,
+            annotation_path,
+            seeds,
+            segment_frames=options.segment_frames,
+            workers=1,
+            window_scale=window_scale,
+            binary=options.binary,
+            tracker_name=options.tracker,
+        )
+    finally:
+        if worker_detector.cache is not None:
+            worker_detector.cache.close()
+            worker_detector.cache = None
+    seconds = time.perf_counter() - start_time
+    return {
+        "status": "done",
+        "annotations": annotation_path,
+        "frames": len(store),
+        "visible": int(np.count_nonzero(store.visible)),
+        "seconds": seconds,
+        "fps": len(store) / max(seconds, 1e-9),
+    }
+
+
+def find_videos(paths: List[str], manifest_path: str = "") -> List[str]:
+    """
+    Every video in the given files, directories (recursively) and manifest, once each and in order
+    """
+    videos: List[str] = []
+    if manifest_path:
+        base_directory = os.path.dirname(os.path.abspath(manifest_path))
+        with open(manifest_path) as file:
+            for line in file:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    # Relative entries are relative to the manifest, not to wherever the run was started
+                    videos.append(os.path.join(base_directory, line))
+    for path in paths:
+        if os.path.isfile(path):
+            videos.append(path)
+            continue
+        for directory, _, files in os.walk(path):
+            for name in sorted(files):
+                if name.lower().endswith(VIDEO_EXTENSIONS):
+                    videos.append(os.path.join(directory, name))
+    return list(dict.fromkeys(os.path.abspath(video) for video in videos))
+
+
+def load_state(state_path: str) -> Dict:
+    if os.path.exists(state_path):
+        with open(state_path) as file:
+            state = json.load(file)
+        if state.get("version") == STATE_VERSION:
+            return state
+        print(f"Ignoring {state_path}, it is from another version")
+    return {"version": STATE_VERSION, "videos": {}}
+
+
+def save_state(state_path: str, state: Dict) -> None:
+    # Written aside and swapped in, a kill mid write leaves the previous state intact
+    temporary_path = state_path + ".tmp"
+    with open(temporary_path, "w") as file:
+        json.dump(state, file, indent=2)
+    os.replace(temporary_path, state_path)
+
+
+def run_settings(prompt_str: str, detector_backend: str, options: BatchOptions) -> Dict:
+    """
+    Everything a video's annotations depend on besides the video itself, stored in its job state entry
+    """
+    return {
+        "prompt": prompt_str,
+        "format": "binary" if options.binary else "text",
+        "detector_backend": detector_backend,
+        "prompt_threshold": options.prompt_threshold,
+        "segment_frames": options.segment_frames,
+        "tracker": options.tracker,
+        "track_scale": options.track_scale,
+    }
+
+
+def is_finished(
+    entry: Dict | None, video_hash: str, settings: Dict, annotation_path: str
+) -> bool:
+    return (
+        entry is not None
+        and entry.get("status") == "done"
+        and entry.get("video_hash") == video_hash
+        and all(entry.get(key) == value for key, value in settings.items())
+        and entry.get("annotations") == annotation_path
+        and os.path.exists(annotation_path)
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "paths",
+        type=str,
+        nargs="*",
+        help="Videos and/or directories to search for them",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default="",
+        help="File listing one video per line, relative to the manifest's directory",
+    )
+    parser.add_argument(
+        "--prompt", type=str, required=True, help="The prompt to seed every video with"
+    )
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        default="",
+        help="Directory for the <video-name>.tracked.annotations files, defaults to next to each video",
+    )
+    parser.add_argument(
+        "--state",
+        type=str,
+        default="",
+        help="Job state file, defaults to batch_state.json in the output directory or the current one",
+    )
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="Also rerun videos that failed in an earlier run",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Videos annotated at once, each worker holds its own copy of the model. Defaults to one per core",
+    )
+    parser.add_argument(
+        "--model-threads",
+        type=int,
+        default=0,
+        help="Torch threads per worker, defaults to the cores divided among the workers",
+    )
+    parser.add_argument(
+        "--prompt-batch",
+        type=int,
+        default=4,
+        help="Frames per forward pass of the prompt model",
+    )
+    parser.add_argument(
+        "--detector-backend",
+        type=str,
+        choices=DETECTOR_BACKENDS,
+        default="eager",
+        help="How the prompt model runs: float32 PyTorch, int8 quantized PyTorch or ONNX Runtime (needs onnxruntime)",
+    )
+    parser.add_argument(
+        "--model-cache",
+        type=str,
+        default="",
+        help="Directory for the converted int8 and ONNX models, defaults to ~/.cache/video-annotation-tool",
+    )
+    parser.add_argument(
+        "--prompt-threshold",
+        type=float,
+        default=0.1,
+        help="Minimum score of a prompt detection",
+    )
+    parser.add_argument(
+        "--detection-cache-mb",
+        type=int,
+        default=256,
+        help="Size cap of each video's detection cache in MB, 0 disables it",
+    )
+    parser.add_argument(
+        "--segment-frames",
+        type=int,
+        default=1800,
+        help="Minimum number of frames per tracked segment, the prompt seeds every segment boundary",
+    )
+    parser.add_argument(
+        "--tracker",
+        type=str,
+        choices=list(TRACKER_BACKENDS),
+        default="csrt",
+        help="Tracking backend",
+    )
+    parser.add_argument(
+        "--track-scale",
+        type=float,
+        default=0,
+        help="Scale of the video the tracker runs at, defaults to full size up to 1920x1080 like --headless",
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=["text", "binary"],
+        default="text",
+        help="Annotation file format",
+    )
+    args = parser.parse_args()
+
+    videos = find_videos(args.paths, args.manifest)
+    if not videos:
+        parser.error("No videos found")
+    binary = args.format == "binary"
+    jobs: List[Tuple[str, str]] = []
+    for video_path in videos:
+        annotation_path = tracked_annotation_path(
+            default_annotation_path(video_path, binary), binary
+        )
+        if args.output_dir:
+            annotation_path = os.path.abspath(
+                os.path.join(args.output_dir, os.path.basename(annotation_path))
+            )
+        jobs.append((video_path, annotation_path))
+    if len({annotation_path for _, annotation_path in jobs}) != len(jobs):
+        parser.error("Several videos share a name, their annotations would collide")
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    state_path = args.state or os.path.join(args.output_dir, "batch_state.json")
+    state = load_state(state_path)
+
+    options = BatchOptions(
+        segment_frames=args.segment_frames,
+        prompt_threshold=args.prompt_threshold,
+        detection_cache_mb=args.detection_cache_mb,
+        tracker=args.tracker,
+        track_scale=args.track_scale,
+        binary=binary,
+    )
+    settings = run_settings(args.prompt, args.detector_backend, options)
+    video_hashes = {video_path: video_content_hash(video_path) for video_path in videos}
+    todo = [
+        (video_path, annotation_path)
+        for video_path, annotation_path in jobs
+        if not is_finished(
+            state["videos"].get(video_path),
+            video_hashes[video_path],
+            settings,
+            annotation_path,
+        )
+        and (
+            args.retry_failed
+            or state["videos"].get(video_path, {}).get("status") != "failed"
+        )
+    ]
+    cores = os.cpu_count() or 1
+    workers = min(args.workers if args.workers > 0 else cores, max(len(todo), 1))
+    model_threads = args.model_threads or max(1, cores // workers)
+    print(
+        f"{len(jobs)} videos, {len(jobs) - len(todo)} done or failed before, annotating {len(todo)} "
+        f"with {workers} worker(s) of {model_threads} model thread(s)"
+    )
+
+    def finish(video_path: str, result: Dict) -> None:
+        result.update({"video_hash": video_hashes[video_path], **settings})
+        state["videos"][video_path] = result
+        save_state(state_path, state)
+        if result["status"] == "done":
+            print(
+                f"{video_path}: {result['frames']} frames in {result['seconds']:.1f}s "
+                f"({result['fps']:.1f} fps), {result['visible']} visible"
+            )
+        else:
+            print(f"{video_path}: failed, {result['error']}")
+
+    start_time = time.perf_counter()
+    results: List[Dict] = []
+    if workers == 1 and todo:
+        init_worker(
+            args.prompt,
+            model_threads,
+            args.prompt_batch,
+            args.detector_backend,
+            args.model_cache,
+        )
+    try:
+        if workers == 1:
+            for video_path, annotation_path in todo:
+                try:
+                    result = annotate_video(video_path, annotation_path, options)
+                except Exception as error:
+                    result = {
+                        "status": "failed",
+                        "error": f"{type(error).__name__}: {error}",
+                    }
+                finish(video_path, result)
+                results.append(result)
+        else:
+            pool = ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=init_worker,
+                initargs=(
+                    args.prompt,
+                    model_threads,
+                    args.prompt_batch,
+                    args.detector_backend,
+                    args.model_cache,
+                ),
+            )
+            try:
+                futures = {
+                    pool.submit(
+                        annotate_video, video_path, annotation_path, options
+                    ): video_path
+                    for video_path, annotation_path in todo
+                }
+                for future in as_completed(futures):
+                    try:
+                        result = future.result()
+                    except Exception as error:
+                        result = {
+                            "status": "failed",
+                            "error": f"{type(error).__name__}: {error}",
+                        }
+                    finish(futures[future], result)
+                    results.append(result)
+            finally:
+                pool.shutdown(cancel_futures=True)
+    except KeyboardInterrupt:
+        print(f"Stopped, rerun the same command to continue from {state_path}")
+        return 130
+    elapsed = time.perf_counter() - start_time
+
+    done = [result for result in results if result["status"] == "done"]
+    frames = sum(result["frames"] for result in done)
+    print(
+        f"Annotated {len(done)} of {len(todo)} videos, {frames} frames in {elapsed:.1f}s: "
+        f"{frames / max(elapsed, 1e-9):.1f} frames/s, {len(done) * 3600 / max(elapsed, 1e-9):.1f} videos/hour"
+    )
+    return 0 if len(done) == len(todo) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+"""
+Batch quality checks over annotation files, so bad tracks can be found without replaying every file
+in the validator
+
+Takes annotation files and/or directories (searched recursively), checks every file on a process pool and
+prints a summary and the files with the most issues. Exits non zero when any file has an issue
+"""
+
+import argparse
+import json
+import sys
+import time
+from functools import partial
+from typing import Dict, List
+
+from utils.AnnotationQA import CHECKS, QAThresholds, check_file
+from utils.Paths import find_annotation_files
+from utils.utils import map_files
+
+
+def check_annotations(
+    paths: List[str],
+    video_dirs: List[str],
+    thresholds: QAThresholds,
+    window_scale: float = 0,
+    workers: int = 0,
+) -> Dict:
+    """
+    Checks every annotation file under paths, returns the per file results and the totals
+    """
+    annotation_paths = find_annotation_files(paths)
+    start_time = time.perf_counter()
+    check = partial(
+        check_file,
+        video_dirs=video_dirs,
+        thresholds=thresholds,
+        window_scale=window_scale,
+    )
+    files = map_files(check, annotation_paths, workers=workers)
+    elapsed = time.perf_counter() - start_time
+
+    checked = [result for result in files if "error" not in result]
+    totals = {
+        check_name: sum(result["issues"][check_name] for result in checked)
+        for check_name in CHECKS
+    }
+    frames = sum(result["frames"] * result["tracks"] for result in checked)
+    return {
+        "files": files,
+        "summary": {
+            "files": len(files),
+            "unreadable_files": len(files) - len(checked),
+            "files_with_issues": sum(
+                1 for result in checked if any(result["issues"].values())
+            ),
+            "files_without_video": sum(1 for result in checked if not result["video"]),
+            "frames": frames,
+            "issues": totals,
+            "seconds": elapsed,
+            "frames_per_second": frames / max(elapsed, 1e-9),
+        },
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "paths",
+        type=str,
+        nargs="+",
+        help="Annotation files and/or directories to search for them",
+    )
+    parser.add_argument(
+        "--videos",
+        type=str,
+        nargs="*",
+        default=[],
+        help="Directories to look for the videos in, besides the annotation file's own",
+    )
+    parser.add_argument(
+        "--window-scale",
+        type=float,
+        default=0,
+        help="Scale the annotations were made at, defaults to what the annotator would use on this screen",
+    )
+    parser.add_argument(
+        "--max-jump",
+        type=float,
+        default=0.5,
+        help="Largest center movement between consecutive V frames, relative to the box's size",
+    )
+    parser.add_argument(
+        "--max-size-ratio",
+        type=float,
+        default=1.5,
+        help="Largest factor the width or height may change by between consecutive V frames",
+    )
+    parser.add_argument(
+        "--max-gap",
+        type=int,
+        default=1,
+        help="S runs of at most this many frames between V frames are reported",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Number of processes checking files, defaults to one per core",
+    )
+    parser.add_argument(
+        "--top", type=int, default=20, help="Number of worst files to list"
+    )
+    parser.add_argument(
+        "--output", type=str, default="", help="Write the full report to this JSON file"
+    )
+    args = parser.parse_args()
+
+    report = check_annotations(
+        args.paths,
+        args.videos,
+        QAThresholds(args.max_jump, args.max_size_ratio, args.max_gap),
+        args.window_scale,
+        args.workers,
+    )
+    summary = report["summary"]
+    print(
+        f"Checked {summary['files']} files, {summary['frames']} frames in {summary['seconds']:.2f}s "
+        f"({summary['frames_per_second']:.0f} frames/s)"
+    )
+    print(
+        f"{summary['files_with_issues']} with issues, {summary['unreadable_files']} unreadable, "
+        f"{summary['files_without_video']} without a video (box and frame count checks skipped)"
+    )
+    print("  ".join(f"{name}: {count}" for name, count in summary["issues"].items()))
+
+    for result in report["files"]:
+        if "error" in result:
+            print(f"{result['path']}: {result['error']}")
+    flagged = sorted(
+        (result for result in report["files"] if "error" not in result),
+        key=lambda result: -sum(result["issues"].values()),
+    )
+    flagged = [result for result in flagged if any(result["issues"].values())]
+    for result in flagged[: args.top]:
+        issues = ", ".join(
+            f"{name} {count}" for name, count in result["issues"].items() if count
+        )
+        first = {
+            name: [frame for _, frame in frames[:3]]
+            for name, frames in result["examples"].items()
+        }
+        print(f"{result['path']}: {issues} (first frames {first})")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    return 1 if flagged or summary["unreadable_files"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,180 @@
+"""
+Agreement between two sets of annotations of the same videos, e.g. from two annotators or from a human and the tracker,
+so they can be compared without watching both in the validator
+
+Takes two annotation files, or two directories whose files are paired by relative path and video name, compares every
+pair on a process pool and prints each pair's agreement, IoU, V/I/S confusion and worst frames. Exits non zero when
+any pair agrees less than --min-agreement, has a different frame or track count, or a file has no partner
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from functools import partial
+from typing import Dict, List
+
+from utils.utils import map_files
+from utils.AnnotationDiff import (
+    STATES,
+    DiffThresholds,
+    diff_files,
+    pair_annotation_files,
+)
+
+
+def compare_annotations(
+    path_a: str,
+    path_b: str,
+    thresholds: DiffThresholds,
+    video_dirs: List[str],
+    window_scale: float = 0,
+    workers: int = 0,
+) -> Dict:
+    """
+    Compares every pair of files under the two paths, returns the per pair results and the totals
+    """
+    pairs, unmatched = pair_annotation_files(path_a, path_b)
+    start_time = time.perf_counter()
+    diff = partial(
+        diff_files,
+        thresholds=thresholds,
+        video_dirs=video_dirs,
+        window_scale=window_scale,
+    )
+    results = map_files(
+        diff, [a for a, _ in pairs], [b for _, b in pairs], workers=workers
+    )
+    elapsed = time.perf_counter() - start_time
+
+    compared = [result for result in results if "error" not in result]
+    frames = sum(result["frames"] * result["tracks"] for result in compared)
+    disagreeing = sum(result["disagreeing_frames"] for result in compared)
+    return {
+        "pairs": results,
+        "unmatched": unmatched,
+        "summary": {
+            "pairs": len(results),
+            "unreadable_pairs": len(results) - len(compared),
+            "failed_pairs": sum(1 for result in compared if not result["passed"]),
+            "unmatched_files": len(unmatched),
+            "frames": frames,
+            "agreement": 1.0 - disagreeing / frames if frames else 1.0,
+            "disagreement_runs": sum(
+                result["disagreement_runs"] for result in compared
+            ),
+            "seconds": elapsed,
+            "ms_per_pair": elapsed * 1000 / max(len(results), 1),
+        },
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "first", type=str, help="Annotation file, or directory to search for them"
+    )
+    parser.add_argument(
+        "second",
+        type=str,
+        help="Annotation file, or directory with the same layout, to compare against",
+    )
+    parser.add_argument(
+        "--videos",
+        type=str,
+        nargs="*",
+        default=[],
+        help="Directories to look for the videos in, only needed when one file's boxes are in window pixels",
+    )
+    parser.add_argument(
+        "--window-scale",
+        type=float,
+        default=0,
+        help="Scale of files made before scales were stored, defaults to what the annotator would use on this screen",
+    )
+    parser.add_argument(
+        "--min-iou",
+        type=float,
+        default=0.5,
+        help="Frames where both files are V count as a disagreement below this IoU",
+    )
+    parser.add_argument(
+        "--min-agreement",
+        type=float,
+        default=0.95,
+        help="Lowest fraction of agreeing frames a pair may have",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Number of processes comparing pairs, defaults to one per core",
+    )
+    parser.add_argument(
+        "--top", type=int, default=20, help="Number of worst pairs to list"
+    )
+    parser.add_argument(
+        "--output", type=str, default="", help="Write the full report to this JSON file"
+    )
+    args = parser.parse_args()
+
+    if os.path.isfile(args.first) != os.path.isfile(args.second):
+        parser.error("Compare two files or two directories")
+    report = compare_annotations(
+        args.first,
+        args.second,
+        DiffThresholds(args.min_iou, args.min_agreement),
+        args.videos,
+        args.window_scale,
+        args.workers,
+    )
+    summary = report["summary"]
+    print(
+        f"Compared {summary['pairs']} pairs, {summary['frames']} frames in {summary['seconds']:.2f}s "
+        f"({summary['ms_per_pair']:.1f} ms per pair)"
+    )
+    print(
+        f"Agreement {summary['agreement']:.3f}, {summary['disagreement_runs']} disagreement runs, "
+        f"{summary['failed_pairs']} pairs below the bar, {summary['unreadable_pairs']} unreadable, "
+        f"{summary['unmatched_files']} files without a partner"
+    )
+
+    for path in report["unmatched"]:
+        print(f"{path}: no partner")
+    for result in report["pairs"]:
+        if "error" in result:
+            print(f"{result['path']}: {result['error']}")
+    compared = sorted(
+        (result for result in report["pairs"] if "error" not in result),
+        key=lambda result: result["agreement"],
+    )
+    for result in compared[: args.top]:
+        confusion = " ".join(
+            f"{a}{b} {result['confusion'][a][b]}"
+            for a in STATES
+            for b in STATES
+            if a != b and result["confusion"][a][b]
+        )
+        mean_iou = "-" if result["mean_iou"] is None else f"{result['mean_iou']:.3f}"
+        print(
+            f"{result['path']}: agreement {result['agreement']:.3f}, mean IoU {mean_iou}, "
+            f"{result['disagreement_runs']} runs{', ' + confusion if confusion else ''}"
+            f"{'' if result['passed'] else ', FAILED'} "
+            f"(worst frames {[worst['frame'] for worst in result['worst'][:5]]})"
+        )
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    return (
+        1
+        if summary["failed_pairs"]
+        or summary["unreadable_pairs"]
+        or summary["unmatched_files"]
+        else 0
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
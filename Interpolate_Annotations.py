@@ -0,0 +1,92 @@
+"""
+Fills the S runs between two V frames of annotation files with interpolated boxes
+
+Takes annotation files and/or directories (searched recursively) and rewrites every file in its own format,
+unless --output is given for a single file. Filled frames are flagged as interpolated, so they can be told
+apart from labelled ones. I frames, and S runs next to them, are left alone
+"""
+
+import argparse
+import sys
+import time
+
+from utils.Paths import find_annotation_files
+from utils.AnnotationStore import AnnotationStore, is_binary_annotation_file
+from utils.Interpolation import INTERPOLATION_METHODS, interpolate_track
+
+
+def interpolate_file(
+    annotation_path: str,
+    output_path: str = "",
+    method: str = "linear",
+    max_gap: int = 0,
+) -> int:
+    """
+    Interpolates every track of a file, returns the number of filled frames
+    """
+    binary = is_binary_annotation_file(annotation_path)
+    if binary:
+        # Read rather than mapped, the file may be about to be overwritten
+        stores = AnnotationStore.tracks_from_binary(annotation_path, mmap=False)
+    else:
+        stores = AnnotationStore.tracks_from_text(annotation_path)
+    filled = 0
+    for track, store in enumerate(stores):
+        stores[track], track_filled = interpolate_track(store, method, max_gap)
+        filled += track_filled
+    output_path = output_path or annotation_path
+    if binary:
+        AnnotationStore.tracks_to_binary(stores, output_path)
+    else:
+        AnnotationStore.tracks_to_text(stores, output_path)
+    return filled
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "paths",
+        type=str,
+        nargs="+",
+        help="Annotation files and/or directories to search for them",
+    )
+    parser.add_argument(
+        "--method",
+        type=str,
+        choices=INTERPOLATION_METHODS,
+        default="linear",
+        help="linear, or cubic to keep the object's speed through the gap",
+    )
+    parser.add_argument(
+        "--max-gap",
+        type=int,
+        default=0,
+        help="Only fill runs of at most this many skipped frames, 0 fills every run",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="",
+        help="Write the result here instead of over the input, only with a single input file",
+    )
+    args = parser.parse_args()
+
+    annotation_paths = find_annotation_files(args.paths)
+    if args.output and len(annotation_paths) != 1:
+        parser.error("--output needs exactly one input file")
+    start_time = time.perf_counter()
+    total = 0
+    for annotation_path in annotation_paths:
+        filled = interpolate_file(
+            annotation_path, args.output, args.method, args.max_gap
+        )
+        total += filled
+        print(f"{annotation_path}: filled {filled} frames")
+    print(
+        f"Filled {total} frames in {len(annotation_paths)} file(s) in {time.perf_counter() - start_time:.2f}s"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
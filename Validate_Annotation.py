@@ -3,28 +3,53 @@ This is a tool that can be used to replay the annotations produced by VideoAnnot
 Takes in a video file path and it's corresponding annotation file path
 
 If annotation path is not passed in, defaults to the same directory as the passed in video file
+
+With --compare, a second annotation file of the same video is drawn in magenta on top, and the validator starts on
+the frames where the two disagree the most, w steps on to the next worst one
+
+With --export, no window is opened: every annotated frame is drawn and written to a video file instead.
+That is a pipeline of a decode thread, a thread pool drawing the overlays of chunks of frames
+(OpenCV releases the GIL while scaling and drawing) and the calling thread writing the chunks back in order
 """
 
 import argparse
 import os
+import queue
 import sys
-from typing import Any, List
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Deque, List, Tuple
 from numpy import dtype, floating, integer, ndarray
 import cv2
 from utils.utils import (
     apply_infobar,
+    copy_into,
+    draw_tracks,
     get_optimal_font_scale,
-    get_optimal_window_scaling,
     get_scaled_image,
-    read_annotations,
+    video_window_scale,
     Annotation,
 )
-from pynput.keyboard import Key, Controller, Listener
+from utils.AnnotationDiff import diff_tracks
+from utils.AnnotationStore import FLAG_INTERPOLATED, VISIBLE, AnnotationStore
+from utils.FrameCache import FrameCache, FramePrefetcher
+from utils.FrameSource import VideoFrameSource, open_frame_source
+from utils.Profiler import Profiler, create_profiler
+from utils.VideoBackend import CAPTURE_BACKENDS, Capture, open_capture
+
+Frame = cv2.Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]]
 
 
 class AnnotationValidator:
     def __init__(self):
-        self.annotations: List[Annotation]
+        # One store per track, single object files have just the one
+        self.annotations: List[AnnotationStore] = []
+        # Tracks of the --compare file, and its worst disagreements with ours in the order w visits them
+        self.compare_annotations: List[AnnotationStore] = []
+        self.worst_frames: List[int] = []
+        self.worst_position: int = 0
         self.frame_copy: cv2.Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]] = (
             None
         )
@@ -42,61 +67,110 @@ class AnnotationValidator:
         self.caps_or_shift_active: bool = False
         self.window_scale: float = 1
 
-    def ReadAnnotations(self, video_path: str, annotation_path: str = "") -> None:
+    def ReadAnnotations(
+        self,
+        video_path: str,
+        annotation_path: str = "",
+        cache_mb: int = 512,
+        profile_path: str = "",
+        proxy_path: str = "",
+        backend: str = "cv2",
+        decode_threads: int = 0,
+        compare_path: str = "",
+        min_iou: float = 0.5,
+    ) -> None:
+        """
+        With profile_path, per stage timings of the frame loop are written there as JSON on exit
+        With compare_path, that file's boxes are drawn too and playback starts on the worst disagreement, frames where
+        both are V count as one below min_iou
+        Frames come from the video's proxy (proxy_path, by default <video-name>.proxy) when it matches the video
+        and this screen's scale, then every frame is a slice of its memory map and nothing is cached or prefetched.
+        Otherwise they are decoded with the given video backend
+        """
+        profiler = create_profiler(profile_path)
         full_video_name: str = os.path.basename(video_path)
         video_name: str = os.path.splitext(full_video_name)[0]
 
         # There's a known bug in opencv where shift + keys result in the lower value
         # in order to work around this, I had to create a separate listener to handle the
         # shift + keystroke cases
+        # pynput is imported here rather than at the top so that it isn't paid for on import
+        from pynput.keyboard import Listener
+
         listener: Listener = Listener(on_press=self.onPress, on_release=self.onRelease)
         listener.start()
 
-        if annotation_path != "":
-            # if an annotation path is provided, use that path
-            self.annotations = read_annotations(annotation_path)
-        else:
-            # otherwise, it is in same location as video
+        if annotation_path == "":
+            # if no annotation path is provided, it is in same location as video
             directory_path = os.path.dirname(video_path)
             annotation_name = video_name + ".annotations"
             annotation_path = os.path.join(directory_path, annotation_name)
-            self.annotations = read_annotations(annotation_path)
-
-        cap = cv2.VideoCapture(video_path)
-        while cap.isOpened():
+            if not os.path.exists(annotation_path):
+                # Annotations may have been written in the binary format only
+                annotation_path += ".bin"
+        self.window_scale = video_window_scale(video_path)
+        # Columnar stores, binary files (and up to date binary sidecars) are memory mapped,
+        # boxes stored in the video's pixels are mapped to the window's all at once
+        self.annotations = [
+            store.at_scale(self.window_scale)
+            for store in AnnotationStore.load_tracks(annotation_path)
+        ]
+        if compare_path:
+            self.__load_comparison(compare_path, min_iou)
+        # Seeks only when a cache miss isn't the frame right after the last one read
+        source = open_frame_source(
+            video_path,
+            self.window_scale,
+            proxy_path,
+            profiler=profiler,
+            backend=backend,
+            decode_threads=decode_threads,
+        )
+        self.width = source.width
+        self.height = source.height
+        # Already scaled frames, filled by the prefetcher
+        frame_cache = FrameCache(cache_mb * 1024 * 1024)
+        prefetcher: FramePrefetcher | None = None
+        if isinstance(source, VideoFrameSource):
+            prefetcher = FramePrefetcher(
+                video_path,
+                frame_cache,
+                self.window_scale,
+                profiler=profiler,
+                index=source.cap.index,
+                backend=backend,
+                decode_threads=decode_threads,
+            )
+        previous_frame_number: int = 0
+        while True:
             # Only get the next frame if appropriate key bindings have been pressed
             if self.get_next_frame:
-                cap.set(cv2.CAP_PROP_POS_FRAMES, self.frame_number)
-                ret, frame = cap.read()
-                if not ret:
-                    print("End of video.")
-                    break
-
-                if self.frame_number == 0:
-                    self.window_scale = get_optimal_window_scaling(
-                        frame.shape[1], frame.shape[0]
+                with profiler.stage("cache_lookup", self.frame_number):
+                    frame = frame_cache.get(self.frame_number)
+                if frame is None:
+                    source.seek(self.frame_number)
+                    ret, frame = source.read()
+                    if not ret:
+                        print("End of video.")
+                        break
+                    if prefetcher is not None:
+                        frame_cache.put(self.frame_number, frame)
+                if prefetcher is not None:
+                    prefetcher.request(
+                        self.frame_number, self.frame_number - previous_frame_number
                     )
-                    frame = get_scaled_image(frame, self.window_scale)
-                    self.width = int(frame.shape[1])
-                    self.height = int(frame.shape[0])
-                else:
-                    frame = get_scaled_image(frame, self.window_scale)
-                # Make a clean copy in case we need to go back to clean image
-                self.frame_copy = frame.copy()
-
-                self.cur_frame = self.frame_copy.copy()
-                self.__apply_annotation(
-                    self.cur_frame, self.annotations[self.frame_number]
-                )
+                previous_frame_number = self.frame_number
+                # Cached frames are shared with the cache, so they are only ever drawn on as a copy
+                self.frame_copy = frame
 
-                apply_infobar(
-                    self.cur_frame,
-                    self.normal_keyboard_options,
-                    self.frame_number,
-                    self.width,
-                )
+                with profiler.stage("overlay", self.frame_number):
+                    self.cur_frame = copy_into(self.cur_frame, self.frame_copy)
+                    self.__draw_overlay(
+                        self.cur_frame, self.frame_number, self.normal_keyboard_options
+                    )
 
-            cv2.imshow("Video Stream", self.cur_frame)
+            with profiler.stage("imshow", self.frame_number):
+                cv2.imshow("Video Stream", self.cur_frame)
 
             self.get_next_frame = False
             key = cv2.waitKey(0) & 0xFF
@@ -120,15 +194,231 @@ class AnnotationValidator:
             elif key == ord("p"):
                 self.frame_number = max(0, self.frame_number - 1)
                 self.get_next_frame = True
+            elif key == ord("w") and self.worst_frames:
+                self.worst_position = (self.worst_position + 1) % len(self.worst_frames)
+                self.frame_number = self.worst_frames[self.worst_position]
+                self.get_next_frame = True
+
+        if prefetcher is not None:
+            prefetcher.stop()
+        source.release()
+        profiler.write(profile_path)
+
+    def ExportAnnotations(
+        self,
+        video_path: str,
+        export_path: str,
+        annotation_path: str = "",
+        workers: int = 0,
+        chunk_frames: int = 16,
+        fourcc: str = "mp4v",
+        profile_path: str = "",
+        backend: str = "cv2",
+        decode_threads: int = 0,
+        scale: float = 1.0,
+    ) -> float:
+        """
+        Burns the annotations into every annotated frame of the video and writes the result to export_path
+        Frames are written at scale of the video, the screen is never asked for its size. Files from before scales
+        were stored are taken to be at that scale, pass the window's scale they were made at
+        workers (0 means one per core) draw chunk_frames frames at a time
+        Returns the frames per second the whole pipeline achieved
+        """
+        profiler = create_profiler(profile_path)
+        if annotation_path == "":
+            annotation_path = os.path.splitext(video_path)[0] + ".annotations"
+            if not os.path.exists(annotation_path):
+                annotation_path += ".bin"
+        self.window_scale = scale
+        self.annotations = [
+            store.at_scale(self.window_scale)
+            for store in AnnotationStore.load_tracks(annotation_path)
+        ]
+        frame_count = len(self.annotations[0])
+        if workers <= 0:
+            workers = os.cpu_count() or 1
+
+        cap = open_capture(video_path, backend=backend, decode_threads=decode_threads)
+        fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+        self.width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH) * self.window_scale)
+        self.height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT) * self.window_scale)
+        writer = cv2.VideoWriter(
+            export_path,
+            cv2.VideoWriter_fourcc(*fourcc),
+            fps,
+            (self.width, self.height),
+        )
+        if not writer.isOpened():
+            cap.release()
+            raise ValueError(f"Can't write {export_path} with the {fourcc} codec")
+
+        # Bounded on both sides, so memory stays at a few chunks per worker however long the video is
+        chunks: queue.Queue[Tuple[int, List[Frame]] | None] = queue.Queue(
+            maxsize=workers * 2
+        )
+        stop = threading.Event()
+        decoder = threading.Thread(
+            target=self.__decode_chunks,
+            args=(cap, frame_count, chunk_frames, chunks, stop, profiler),
+            daemon=True,
+        )
+        pending: Deque[Future[List[Frame]]] = deque()
+        written = 0
+        start_time = time.perf_counter()
+        decoder.start()
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                while True:
+                    chunk = chunks.get()
+                    if chunk is not None:
+                        pending.append(
+                            pool.submit(self.__render_chunk, *chunk, profiler)
+                        )
+                    # Written strictly in submission order, waiting on the oldest chunk once enough are in flight
+                    while pending and (
+                        chunk is None or len(pending) > workers * 2 or pending[0].done()
+                    ):
+                        frames = pending.popleft().result()
+                        with profiler.stage("write", written):
+                            for frame in frames:
+                                writer.write(frame)
+                        written += len(frames)
+                    if chunk is None:
+                        break
+        finally:
+            stop.set()
+            # Unblock the decoder if it is waiting on a full queue
+            while decoder.is_alive():
+                try:
+                    chunks.get_nowait()
+                except queue.Empty:
+                    decoder.join(0.01)
+            writer.release()
+            cap.release()
+        elapsed = time.perf_counter() - start_time
+        export_fps = written / max(elapsed, 1e-9)
+        print(
+            f"Exported {written} frames to {export_path} in {elapsed:.1f}s ({export_fps:.1f} fps, {workers} workers)"
+        )
+        profiler.write(profile_path)
+        return export_fps
+
+    @staticmethod
+    def __decode_chunks(
+        cap: Capture,
+        frame_count: int,
+        chunk_frames: int,
+        chunks: "queue.Queue[Tuple[int, List[Frame]] | None]",
+        stop: threading.Event,
+        profiler: Profiler,
+    ) -> None:
+        """
+        Reads the video sequentially into chunks of consecutive frames, None marks the end
+        """
+        frame_number = 0
+        while frame_number < frame_count and not stop.is_set():
+            first_frame = frame_number
+            frames: List[Frame] = []
+            while len(frames) < chunk_frames and frame_number < frame_count:
+                with profiler.stage("decode", frame_number):
+                    ret, frame = cap.read()
+                if not ret:
+                    frame_count = frame_number
+                    break
+                frames.append(frame)
+                frame_number += 1
+            if frames:
+                chunks.put((first_frame, frames))
+        chunks.put(None)
+
+    def __render_chunk(
+        self, first_frame: int, frames: List[Frame], profiler: Profiler
+    ) -> List[Frame]:
+        """
+        Scales a chunk of decoded frames and draws their annotations and infobar, in place where possible
+        """
+        rendered: List[Frame] = []
+        for frame_number, frame in enumerate(frames, first_frame):
+            with profiler.stage("scale", frame_number):
+                frame = get_scaled_image(frame, self.window_scale)
+            with profiler.stage("overlay", frame_number):
+                # Same overlay as the window shows, so exports and interactive review look alike
+                self.__draw_overlay(frame, frame_number, self.normal_keyboard_options)
+            rendered.append(frame)
+        return rendered
+
+    def __load_comparison(self, compare_path: str, min_iou: float) -> None:
+        """
+        Loads the other file at the window's scale and ranks the runs where it disagrees with ours, the validator starts
+        on the worst one
+        """
+        # Both files at the window's scale, as the boxes are drawn
+        self.compare_annotations = [
+            store.at_scale(self.window_scale)
+            for store in AnnotationStore.load_tracks(compare_path)
+        ]
+        worst = []
+        for track_a, track_b in zip(self.annotations, self.compare_annotations):
+            diff = diff_tracks(track_a, track_b, min_iou)
+            worst.extend(diff.worst(len(diff.runs)))
+        worst.sort(key=lambda run: -run[2])
+        # Runs of several tracks can share their worst frame
+        self.worst_frames = list(dict.fromkeys(frame for frame, _, _ in worst))
+        print(
+            f"{len(self.worst_frames)} disagreements with {compare_path}, "
+            f"worst frames {self.worst_frames[:10]}"
+        )
+        if self.worst_frames:
+            self.frame_number = self.worst_frames[0]
+            self.normal_keyboard_options.append("w : Next Worst Disagreement")
+
+    def __draw_overlay(
+        self, frame: Frame, frame_number: int, keyboard_options: List[str]
+    ) -> None:
+        """
+        Draws the frame's annotations, every track's when there are several, and the infobar
+        Only reads state that is fixed once the annotations are loaded, so export workers can share it
+        """
+        interpolated = [
+            bool(track.flags[frame_number] & FLAG_INTERPOLATED)
+            for track in self.annotations
+        ]
+        if len(self.annotations) == 1:
+            self.__apply_annotation(
+                frame, self.annotations[0][frame_number], frame_number, interpolated[0]
+            )
+        else:
+            draw_tracks(
+                frame,
+                [track[frame_number] for track in self.annotations],
+                self.height,
+                self.width,
+                interpolated=interpolated,
+            )
+        for track in self.compare_annotations:
+            if frame_number < len(track) and track.types[frame_number] == VISIBLE:
+                center_x, center_y, width, height = (
+                    int(value) for value in track.boxes[frame_number]
+                )
+                cv2.rectangle(
+                    frame,
+                    (center_x - width // 2, center_y - height // 2),
+                    (center_x + width // 2, center_y + height // 2),
+                    (255, 0, 255),
+                    2,
+                )
+        apply_infobar(frame, keyboard_options, frame_number, self.width)
 
     def __apply_annotation(
         self,
         frame: cv2.Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]],
         annotation: Annotation,
+        frame_number: int,
+        interpolated: bool = False,
     ) -> None:
         """
         Given an annotation, applies it to the given frame
-        If it object is visible i.e ("V") draw the bbox that is there
+        If it object is visible i.e ("V") draw the bbox that is there, in orange if it was interpolated
         otherwise, display the status of the missing annotation
         S : Skipped
         I : Invisible
@@ -139,13 +429,21 @@ class AnnotationValidator:
             bottom_y: int = annotation.center_y - int(annotation.height / 2)
             upper_x: int = annotation.center_x + int(annotation.width / 2)
             upper_y: int = annotation.center_y + int(annotation.height / 2)
+            color = (0, 165, 255) if interpolated else (0, 255, 0)
             frame = cv2.rectangle(
-                frame, (bottom_x, bottom_y), (upper_x, upper_y), (0, 255, 0), 2
+                frame, (bottom_x, bottom_y), (upper_x, upper_y), color, 2
             )
         else:
-            text: str = f"Annotation is {annotation.annotation_type} for Frame : {self.frame_number}"
+            text: str = (
+                f"Annotation is {annotation.annotation_type} for Frame : {frame_number}"
+            )
             font = cv2.FONT_HERSHEY_SIMPLEX
-            font_scale = get_optimal_font_scale(text, self.width)
+            # Digits are all as wide, so the font scale only depends on how many there are and stays memoized
+            font_scale = get_optimal_font_scale(
+                f"Annotation is {annotation.annotation_type} for Frame : "
+                + "0" * len(str(frame_number)),
+                self.width,
+            )
             color = (0, 0, 255)  # White color (B, G, R)
             thickness = 2
             org = (
@@ -160,6 +458,8 @@ class AnnotationValidator:
         """
         Just a listener that also catches keystrokes, but this one just toggles if shift has been hit
         """
+        from pynput.keyboard import Key
+
         if key == Key.shift_l or key == Key.shift_r:
             self.caps_or_shift_active = True
 
@@ -168,6 +468,8 @@ class AnnotationValidator:
         Another event listener for key releases, just checks if shift key was just released
         as well as if caps was hit
         """
+        from pynput.keyboard import Key, Controller
+
         if key == Key.shift_l or key == Key.shift_r:
             self.caps_or_shift_active = False
         elif key == Key.caps_lock:
@@ -183,6 +485,105 @@ if __name__ == "__main__":
     parser.add_argument(
         "--output", type=str, default="", help="The path for the output annotation file"
     )
+    parser.add_argument(
+        "--cache-mb",
+        type=int,
+        default=512,
+        help="Memory budget in MB for decoded frames kept around for scrubbing",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default="",
+        metavar="OUT_JSON",
+        help="Time every stage of the frame loop (excluding waiting on keys) and write the report to this JSON file",
+    )
+    parser.add_argument(
+        "--proxy",
+        type=str,
+        default="",
+        help="Proxy frame file to read frames from, defaults to <video-name>.proxy next to the video when it exists",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=CAPTURE_BACKENDS,
+        default="cv2",
+        help="Video decoding backend, pyav needs PyAV installed",
+    )
+    parser.add_argument(
+        "--decode-threads",
+        type=int,
+        default=0,
+        help="Threads the codec decodes with, 0 lets FFmpeg pick",
+    )
+    parser.add_argument(
+        "--compare",
+        type=str,
+        default="",
+        help="Another annotation file of the video to draw in magenta, starting on the frames where the two disagree most",
+    )
+    parser.add_argument(
+        "--min-iou",
+        type=float,
+        default=0.5,
+        help="With --compare, frames where both files are V count as a disagreement below this IoU",
+    )
+    parser.add_argument(
+        "--export",
+        type=str,
+        default="",
+        metavar="OUT_VIDEO",
+        help="Don't open a window, burn the annotations into every annotated frame and write them to this video file",
+    )
+    parser.add_argument(
+        "--export-scale",
+        type=float,
+        default=1.0,
+        help="Scale of the video --export writes, annotations from before scales were stored need their window's",
+    )
+    parser.add_argument(
+        "--export-workers",
+        type=int,
+        default=0,
+        help="Threads drawing overlays for --export, defaults to one per core",
+    )
+    parser.add_argument(
+        "--export-chunk",
+        type=int,
+        default=16,
+        help="Frames handed to an export worker at a time",
+    )
+    parser.add_argument(
+        "--export-fourcc",
+        type=str,
+        default="mp4v",
+        help="FourCC of the codec --export encodes with",
+    )
     args = parser.parse_args()
     print(args)
-    video_annotator.ReadAnnotations(args.input_file, args.output)
+    if args.export:
+        video_annotator.ExportAnnotations(
+            args.input_file,
+            args.export,
+            args.output,
+            workers=args.export_workers,
+            chunk_frames=args.export_chunk,
+            fourcc=args.export_fourcc,
+            profile_path=args.profile,
+            backend=args.backend,
+            decode_threads=args.decode_threads,
+            scale=args.export_scale,
+        )
+    else:
+        video_annotator.ReadAnnotations(
+            args.input_file,
+            args.output,
+            args.cache_mb,
+            args.profile,
+            args.proxy,
+            args.backend,
+            args.decode_threads,
+            args.compare,
+            args.min_iou,
+        )
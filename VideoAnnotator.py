@@ -1,14 +1,38 @@
 import os
 import sys
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Any, List
 import cv2
 from numpy import dtype, floating, integer, ndarray
+from utils.Paths import default_annotation_path, tracked_annotation_path
+from utils.AnnotationStore import AnnotationStore, is_binary_annotation_file
 from utils.Annotator import Annotator
-from utils.utils import apply_infobar, get_optimal_window_scaling, get_scaled_image
+from utils.DetectionCache import open_detection_cache
+from utils.HeadlessTracker import (
+    center_to_corner,
+    headless_track_scale,
+    run_headless,
+    seeds_from_annotations,
+    seeds_from_prompt,
+)
+from utils.FrameSource import open_frame_source
+from utils.Interpolation import INTERPOLATION_METHODS, GapInterpolator
+from utils.LookaheadTracker import LookaheadTracker
+from utils.Profiler import NullProfiler, Profiler, create_profiler
+from utils.PromptDetector import DETECTOR_BACKENDS, PromptDetector
+from utils.Redetection import RegionRedetector
+from utils.Trackers import TRACKER_BACKENDS, Tracker, create_tracker
+from utils.VideoBackend import CAPTURE_BACKENDS
+from utils.utils import (
+    Annotation,
+    apply_infobar,
+    copy_into,
+    draw_tracks,
+    get_scaled_image,
+    scale_boxes,
+    video_window_scale,
+)
 import argparse
-from transformers import OwlViTProcessor, OwlViTForObjectDetection
-from PIL import Image
-import numpy as np
 
 
 class VideoAnnotator:
@@ -53,13 +77,25 @@ class VideoAnnotator:
             "Q/q : Quit",
         ]
         self.tracking = False
-        self.annotator: Annotator
+        self.annotator: Annotator | GapInterpolator
         self.get_next_frame: bool = True
         self.window_scale: float = 1
 
-        # I could make a Kalman filter here or use like an optical flow approach for tracking, but
-        # For sake of time, let's just use an inbuilt opencv tracker here
-        self.tracker: cv2.TrackerCSRT = cv2.TrackerCSRT.create()
+        # One tracker per tracked object, CSRT by default, StartAnnotations swaps in whichever backend was asked for
+        self.trackers: List[Tracker] = [create_tracker("csrt")]
+        # Multi object sessions: the track keys apply to and every track's record for the current frame
+        self.active_track: int = 0
+        self.pending_records: List[tuple[str, int, int, int, int]] = []
+        self.multi_keyboard_options: List[str] = [
+            "1-9 : Select track",
+            "L/l : Label",
+            "S/s : Skip",
+            "I/i : Invisible",
+            "A/a : Accept frame",
+            "Q/q : Quit",
+        ]
+        # Runs the tracker ahead of the user on a worker thread, set up once the first frame is read
+        self.lookahead: LookaheadTracker
         self.frame_copy: cv2.Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]] = (
             None
         )
@@ -69,107 +105,444 @@ class VideoAnnotator:
 
         # Prompt based stuff
         self.prompt_enable = False
-        self.processor: OwlViTProcessor
-        self.model: OwlViTForObjectDetection
+        # The model loads in the background while the first frame is decoded and shown
+        self.detector_loader: Future[PromptDetector]
         self.prompt_bar = False
+        self.prompt_threshold: float = 0.1
+        # Searches for the object with the prompt model when the tracker loses it, only with a prompt
+        self.redetector: RegionRedetector | None = None
+        # Stage timers, a no-op unless a profile was asked for
+        self.profiler: Profiler = NullProfiler()
+        # Frames the keyframe key moves on by, only offered when skipped frames get interpolated
+        self.keyframe_step: int = 10
 
     def StartAnnotations(
-        self, video_path: str, annotation_path: str = "", prompt_str: str = ""
+        self,
+        video_path: str,
+        annotation_path: str = "",
+        prompt_str: str = "",
+        flush_every: int = 64,
+        flush_interval: float = 5.0,
+        crash_safe: bool = False,
+        sync_every: int = 1,
+        binary: bool = False,
+        lookahead: int = 8,
+        model_threads: int = 0,
+        prompt_threshold: float = 0.1,
+        detection_cache_mb: int = 256,
+        resume: bool = False,
+        reseed_max_gap: int = 150,
+        tracker: str = "csrt",
+        profile_path: str = "",
+        tracks: int = 1,
+        track_workers: int = 0,
+        proxy_path: str = "",
+        interpolate: str = "",
+        keyframe_step: int = 10,
+        track_scale: float = 0,
+        backend: str = "cv2",
+        decode_threads: int = 0,
+        redetect_threshold: float = 0.3,
+        detector_backend: str = "eager",
+        model_cache_dir: str = "",
     ) -> None:
-        full_video_name: str = os.path.basename(video_path)
-        video_name: str = os.path.splitext(full_video_name)[0]
+        """
+        Frames come from the video's proxy (proxy_path, by default <video-name>.proxy) when it matches the video
+        and this screen's scale, otherwise they are decoded with the given video backend on a thread of their own,
+        a few frames ahead of the tracker
+        With profile_path, per stage timings of the frame loop are written there as JSON when the session ends
+        With resume, an existing annotation file is continued from its first unannotated frame and,
+        if a track's last V box is at most reseed_max_gap frames back, its tracker picks up from that box
+        With more than one track, all objects are annotated in the same pass, their trackers updated on
+        track_workers threads (0 means one per track, up to the number of cores)
+        With interpolate (linear or cubic), skipped frames between two V frames are written as interpolated
+        boxes, and K skips keyframe_step frames at once so only every keyframe_step-th frame needs labelling
+        With track_scale, trackers run on frames at that scale of the video (at most the window's) instead of
+        the window's. Boxes are written in the video's own pixels either way
+        With a prompt, a track the tracker loses is searched for with the model around where it was heading, then in
+        ever bigger crops up to the whole frame, and the first box scoring above redetect_threshold (0 turns this off)
+        re-seeds the tracker and is offered for accepting like a prediction
+        """
+        if tracks > 1 and prompt_str != "":
+            raise ValueError("Prompt detection only supports a single track")
+        self.trackers = [create_tracker(tracker) for _ in range(max(1, tracks))]
+        if track_workers <= 0:
+            track_workers = min(len(self.trackers), os.cpu_count() or 1)
+        self.profiler = create_profiler(profile_path)
+        if annotation_path == "":
+            annotation_path = default_annotation_path(video_path, binary)
+            other_format_path = default_annotation_path(video_path, not binary)
+            if (
+                resume
+                and not os.path.exists(annotation_path)
+                and os.path.exists(other_format_path)
+            ):
+                annotation_path = other_format_path
+        if prompt_str != "":
+            # Only load in model if prompt is valid, on a worker thread so startup doesn't wait on it
+            loader_pool = ThreadPoolExecutor(max_workers=1)
+            self.detector_loader = loader_pool.submit(
+                self.load_detector,
+                video_path,
+                annotation_path,
+                prompt_str,
+                model_threads=model_threads,
+                detection_cache_mb=detection_cache_mb,
+                detector_backend=detector_backend,
+                model_cache_dir=model_cache_dir,
+            )
+            loader_pool.shutdown(wait=False)
+            self.prompt_enable = True
+            self.prompt_threshold = prompt_threshold
+            if redetect_threshold > 0:
+                self.redetector = RegionRedetector(redetect_threshold)
+
+        self.window_scale = video_window_scale(video_path)
+        track_ratio = 1.0
+        if track_scale > 0:
+            # Scaling past the window's would only make tracking slower than it already is
+            track_ratio = min(1.0, track_scale / self.window_scale)
+        self.annotator = Annotator(
+            annotation_path,
+            flush_every=flush_every,
+            flush_interval=flush_interval,
+            crash_safe=crash_safe,
+            sync_every=sync_every,
+            binary=binary,
+            append=resume,
+            tracks=len(self.trackers),
+            with_flags=interpolate != "",
+            scale=self.window_scale,
+        )
+        if interpolate != "":
+            # Skipped frames are held back in front of the file until their gap closes
+            self.annotator = GapInterpolator(self.annotator, interpolate)
+        if interpolate != "" and len(self.trackers) == 1:
+            self.keyframe_step = max(1, keyframe_step)
+            for keyboard_options in (
+                self.normal_keyboard_options,
+                self.predicted_keyboard_options,
+                self.prompt_keyboard_options,
+            ):
+                keyboard_options.insert(-1, "K/k : Next keyframe")
 
+        source = open_frame_source(
+            video_path,
+            self.window_scale,
+            proxy_path,
+            profiler=self.profiler,
+            backend=backend,
+            decode_threads=decode_threads,
+            threaded=True,
+        )
+        try:
+            seeds: List[tuple[int, tuple[int, int, int, int]] | None] = [None] * len(
+                self.trackers
+            )
+            first_read = 0
+            if resume:
+                self.frame_number = self.annotator.existing_records
+                if is_binary_annotation_file(annotation_path):
+                    stores = AnnotationStore.tracks_from_binary(annotation_path)
+                else:
+                    stores = AnnotationStore.tracks_from_text(annotation_path)
+                seeds = [
+                    self.resume_seed(
+                        store.at_scale(self.window_scale),
+                        self.frame_number,
+                        reseed_max_gap,
+                    )
+                    for store in stores
+                ]
+                print(f"Resuming {annotation_path} at frame {self.frame_number}")
+                first_read = min(
+                    (seed[0] for seed in seeds if seed is not None),
+                    default=self.frame_number,
+                )
+                source.seek(first_read)
+            ret, frame = source.read()
+            if not ret:
+                print("End of video.")
+                return
+            # Each re-seeded tracker starts on its last box and follows its object through
+            # the frames skipped after it, up to where we resume
+            for frame_number in range(first_read, self.frame_number):
+                track_frame = (
+                    frame if track_ratio == 1 else get_scaled_image(frame, track_ratio)
+                )
+                for tracker, seed in zip(self.trackers, seeds):
+                    if seed is not None and seed[0] == frame_number:
+                        tracker.init(
+                            track_frame,
+                            tuple(scale_boxes([seed[1]], track_ratio)[0].tolist()),
+                        )
+                    elif seed is not None and seed[0] < frame_number:
+                        tracker.update(track_frame)
+                ret, frame = source.read()
+                if not ret:
+                    print("End of video.")
+                    return
+            self.tracking = seeds[0] is not None
+            if self.redetector is not None and seeds[0] is not None:
+                self.redetector.remember(*seeds[0])
+            self.width = int(frame.shape[1])
+            self.height = int(frame.shape[0])
+            self.lookahead = LookaheadTracker(
+                source,
+                self.trackers,
+                frame,
+                lookahead,
+                start_frame=self.frame_number,
+                trackers_ready=[seed is not None for seed in seeds],
+                profiler=self.profiler,
+                track_workers=track_workers,
+                track_ratio=track_ratio,
+            )
+            try:
+                if len(self.trackers) > 1:
+                    self.__multi_annotation_loop()
+                else:
+                    self.__annotation_loop(prompt_str)
+            finally:
+                self.lookahead.stop()
+        finally:
+            # Always get the buffered annotations onto disk, whether we quit, hit the end or crashed
+            self.annotator.close()
+            source.release()
+            self.profiler.write(profile_path)
+
+    def StartHeadless(
+        self,
+        video_path: str,
+        annotation_path: str = "",
+        box: tuple[int, int, int, int] | None = None,
+        seed_annotation_path: str = "",
+        seed_every_v: bool = False,
+        segment_frames: int = 1800,
+        workers: int = 0,
+        binary: bool = False,
+        prompt_str: str = "",
+        model_threads: int = 0,
+        prompt_batch: int = 4,
+        prompt_threshold: float = 0.1,
+        detection_cache_mb: int = 256,
+        tracker: str = "csrt",
+        track_scale: float = 0,
+        detector_backend: str = "eager",
+        model_cache_dir: str = "",
+        seed_window_scale: float = 0,
+    ) -> None:
+        """
+        Tracks the whole video without a window, seeded from the given box (center x, center y, width, height
+        on the first frame in the video's pixels, like a V line), the first V line of an existing annotation file
+        (every one with seed_every_v) and/or prompt detections at the segment boundaries
+        The V and I lines of the seed annotation file are kept, the tracker only fills its S and missing frames.
+        With nothing else to seed from, the seed file is the video's annotation file and the result is written
+        next to it as <video-name>.tracked.annotations, never over it. So does the result of a box or prompt seeded
+        run without an annotation_path, the video's annotation file is left alone
+        A seed file from before scales were stored has its boxes in the pixels of the window it was made in, whose scale
+        has to be given as seed_window_scale
+        Frames are tracked at track_scale of the video, by default at full size up to 1920x1080
+        """
+        if box is None and seed_annotation_path == "" and prompt_str == "":
+            # Fall back on whatever was already annotated for this video
+            seed_annotation_path = annotation_path or default_annotation_path(
+                video_path, binary
+            )
+            if annotation_path == "":
+                annotation_path = tracked_annotation_path(seed_annotation_path, binary)
+        if annotation_path == "":
+            annotation_path = tracked_annotation_path(
+                default_annotation_path(video_path, binary), binary
+            )
+        if seed_annotation_path != "" and os.path.abspath(annotation_path).removesuffix(
+            ".bin"
+        ) == os.path.abspath(seed_annotation_path).removesuffix(".bin"):
+            raise ValueError(
+                f"Headless tracking would overwrite its seed file {seed_annotation_path}, pass another --output"
+            )
+        window_scale = (
+            track_scale if track_scale > 0 else headless_track_scale(video_path)
+        )
+        seeds: dict[int, tuple[int, int, int, int]] = {}
+        labelled: AnnotationStore | None = None
+        if seed_annotation_path != "":
+            labelled = AnnotationStore.load(seed_annotation_path)
+            if labelled.scale <= 0:
+                # From before scales were stored, in the pixels of a window on a screen this may not even have
+                if seed_window_scale <= 0:
+                    raise ValueError(
+                        f"{seed_annotation_path} is from before scales were stored, its boxes are in the pixels of "
+                        "the window it was made in, pass that window's scale with --window-scale"
+                    )
+                labelled = AnnotationStore(
+                    labelled.types, labelled.boxes, labelled.flags, seed_window_scale
+                )
+            seeds = seeds_from_annotations(labelled, window_scale, seed_every_v)
+            labelled = labelled.at_scale(1.0)
         if prompt_str != "":
-            # Only load in model if prompt is valid
-            self.processor = OwlViTProcessor.from_pretrained(
-                "google/owlvit-base-patch32"
+            detector = self.load_detector(
+                video_path,
+                annotation_path,
+                prompt_str,
+                model_threads=model_threads,
+                prompt_batch=prompt_batch,
+                detection_cache_mb=detection_cache_mb,
+                detector_backend=detector_backend,
+                model_cache_dir=model_cache_dir,
             )
-            self.model = OwlViTForObjectDetection.from_pretrained(
-                "google/owlvit-base-patch32"
+            seeds = (
+                seeds_from_prompt(
+                    video_path,
+                    detector,
+                    segment_frames,
+                    window_scale,
+                    threshold=prompt_threshold,
+                )
+                | seeds
             )
-            self.prompt_enable = True
+        if box is not None:
+            seeds[0] = center_to_corner(*scale_boxes([box], window_scale)[0].tolist())
+        run_headless(
+            video_path,
+            annotation_path,
+            seeds,
+            segment_frames=segment_frames,
+            workers=workers,
+            window_scale=window_scale,
+            binary=binary,
+            tracker_name=tracker,
+            labelled=labelled,
+        )
 
-        if annotation_path != "":
-            # if an annotation path is provided, use that path
-            self.annotator = Annotator(annotation_path)
-        else:
-            # otherwise, put it in same location as video
-            directory_path = os.path.dirname(video_path)
-            # Add the ".annotations" extension
-            video_name += ".annotations"
-            annotation_path = os.path.join(directory_path, video_name)
-            self.annotator = Annotator(annotation_path)
+    @staticmethod
+    def load_detector(
+        video_path: str,
+        annotation_path: str,
+        prompt_str: str,
+        model_threads: int = 0,
+        prompt_batch: int = 4,
+        detection_cache_mb: int = 256,
+        detector_backend: str = "eager",
+        model_cache_dir: str = "",
+    ) -> PromptDetector:
+        """
+        Loads the prompt model in the given backend, backed by a detection cache next to the annotation file
+        unless its size is 0
+        """
+        return PromptDetector(
+            prompt_str,
+            batch_size=prompt_batch,
+            num_threads=model_threads,
+            cache=open_detection_cache(video_path, annotation_path, detection_cache_mb),
+            backend=detector_backend,
+            model_cache_dir=model_cache_dir,
+        )
 
-        cap = cv2.VideoCapture(video_path)
-        while cap.isOpened():
+    @staticmethod
+    def resume_seed(
+        store: AnnotationStore, resume_frame: int, max_gap: int
+    ) -> tuple[int, tuple[int, int, int, int]] | None:
+        """
+        Frame number and top left box of a track's last V record before resume_frame,
+        None if there is none or it is too far back for the tracker to still find the object
+        """
+        visible = store.visible[:resume_frame].nonzero()[0]
+        if len(visible) == 0 or resume_frame - visible[-1] > max_gap:
+            return None
+        seed_frame_number = int(visible[-1])
+        return seed_frame_number, center_to_corner(
+            *(int(i) for i in store.boxes[seed_frame_number])
+        )
+
+    def __annotation_loop(self, prompt_str: str) -> None:
+        redetected: bool = False
+        while True:
             # Only get the next frame if appropriate key bindings have been pressed
             if self.get_next_frame:
-                ret, frame = cap.read()
-                if not ret:
+                # Decoded, scaled and (once tracking) already tracked while the user was deciding
+                frame, predictions = self.lookahead.get(self.frame_number)
+                ok, bbox = predictions[0] or (None, None)
+                if frame is None:
                     print("End of video.")
                     break
-
-                if self.frame_number == 0:
-                    self.window_scale = get_optimal_window_scaling(
-                        frame.shape[1], frame.shape[0]
-                    )
-                    frame = get_scaled_image(frame, self.window_scale)
-                    self.width = int(frame.shape[1])
-                    self.height = int(frame.shape[0])
-                else:
-                    frame = get_scaled_image(frame, self.window_scale)
-                # Make a clean copy in case we need to go back to clean image
-                self.frame_copy = frame.copy()
+                # The look-ahead worker shares this frame, so it is only ever drawn on as a copy
+                self.frame_copy = frame
+                redetected = False
+                if self.tracking and self.redetector is not None:
+                    if ok:
+                        # The tracker found the object again by itself, the next loss is worth a search again
+                        self.redetector.gave_up = False
+                    else:
+                        ok, bbox = self.redetect()
+                        redetected = ok
 
             predicted_enable: bool = False
             prompt_bar: bool = False
-            # Copy in clean frame copy
-            self.cur_frame = self.frame_copy.copy()
-            if self.tracking:
-                ok, bbox = self.tracker.update(self.cur_frame)
-                if ok:
-                    bbox_lower = (int(bbox[0]), int(bbox[1]))
-                    bbox_upper = (int(bbox[0] + bbox[2]), int(bbox[1] + bbox[3]))
-                    self.cur_frame = cv2.rectangle(
-                        self.cur_frame, bbox_lower, bbox_upper, (0, 255, 0), 2
-                    )
+            with self.profiler.stage("overlay", self.frame_number):
+                # Copy in clean frame copy
+                self.cur_frame = copy_into(self.cur_frame, self.frame_copy)
+                if self.tracking:
+                    if ok:
+                        bbox_lower = (int(bbox[0]), int(bbox[1]))
+                        bbox_upper = (int(bbox[0] + bbox[2]), int(bbox[1] + bbox[3]))
+                        self.cur_frame = cv2.rectangle(
+                            self.cur_frame, bbox_lower, bbox_upper, (0, 255, 0), 2
+                        )
+                        apply_infobar(
+                            self.cur_frame,
+                            (["Re-detected"] if redetected else [])
+                            + self.predicted_keyboard_options,
+                            self.frame_number,
+                            self.width,
+                        )
+                        predicted_enable = True
+                        cur_prediction: tuple[int, int, int, int] = bbox
+                    else:
+                        apply_infobar(
+                            self.cur_frame,
+                            self.normal_keyboard_options,
+                            self.frame_number,
+                            self.width,
+                        )
+                elif not self.prompt_enable:
                     apply_infobar(
                         self.cur_frame,
-                        self.predicted_keyboard_options,
+                        self.normal_keyboard_options,
                         self.frame_number,
                         self.width,
                     )
-                    predicted_enable = True
-                    cur_prediction: tuple[int, int, int, int] = bbox
-                else:
+            if not self.tracking and self.prompt_enable:
+                if not self.detector_loader.done():
+                    # Put the frame up right away instead of staring at nothing until the model is ready
+                    loading_frame = self.cur_frame.copy()
                     apply_infobar(
-                        self.cur_frame,
-                        self.normal_keyboard_options,
+                        loading_frame,
+                        ["Loading model..."],
                         self.frame_number,
                         self.width,
                     )
-            elif self.prompt_enable:
-                valid_prediction, cur_prediction = self.run_prompt_model(
-                    self.cur_frame, prompt_str
-                )
+                    cv2.imshow("Video Stream", loading_frame)
+                    cv2.waitKey(1)
+                    with self.profiler.stage("model_load_wait", self.frame_number):
+                        self.detector_loader.result()
+                with self.profiler.stage("prompt", self.frame_number):
+                    valid_prediction, cur_prediction = self.run_prompt_model(
+                        self.cur_frame, prompt_str
+                    )
                 if valid_prediction:
                     prompt_bar = True
                 else:
-                    apply_infobar(
-                        self.cur_frame,
-                        self.normal_keyboard_options,
-                        self.frame_number,
-                        self.width,
-                    )
-            else:
-                apply_infobar(
-                    self.cur_frame,
-                    self.normal_keyboard_options,
-                    self.frame_number,
-                    self.width,
-                )
+                    with self.profiler.stage("overlay", self.frame_number):
+                        apply_infobar(
+                            self.cur_frame,
+                            self.normal_keyboard_options,
+                            self.frame_number,
+                            self.width,
+                        )
 
-            cv2.imshow("Video Stream", self.cur_frame)
+            with self.profiler.stage("imshow", self.frame_number):
+                cv2.imshow("Video Stream", self.cur_frame)
 
             self.get_next_frame = False
             key = cv2.waitKey(0) & 0xFF
@@ -197,6 +570,11 @@ class VideoAnnotator:
                 self.onInvisible()
                 self.get_next_frame = True
                 self.frame_number += 1
+            elif (key == ord("k") or key == ord("K")) and isinstance(
+                self.annotator, GapInterpolator
+            ):
+                self.onKeyframe()
+                self.get_next_frame = True
             elif (key == ord("f") or key == ord("F")) and (
                 predicted_enable or prompt_bar
             ):
@@ -209,50 +587,135 @@ class VideoAnnotator:
             ):
                 self.onAccept(cur_prediction)
                 if not predicted_enable:
-                    self.tracker.init(frame, cur_prediction)
+                    self.lookahead.reinit(
+                        self.frame_number, self.frame_copy, cur_prediction
+                    )
                     self.tracking = True
                 self.prompt_enable = False
                 self.get_next_frame = True
                 self.frame_number += 1
 
+    def __multi_annotation_loop(self) -> None:
+        """
+        Annotates every track in the same pass over the video
+        Each track's record for the frame starts out as its prediction (or skipped if there is none),
+        the number keys pick the track that labelling, skipping and marking invisible apply to,
+        and accepting writes every track's record and moves on to the next frame
+        """
+        while True:
+            if self.get_next_frame:
+                # Decoded and scaled once, then handed to every tracker
+                frame, predictions = self.lookahead.get(self.frame_number)
+                if frame is None:
+                    print("End of video.")
+                    break
+                self.frame_copy = frame
+                self.pending_records = []
+                for prediction in predictions:
+                    if prediction is not None and prediction[0]:
+                        x, y, width, height = prediction[1]
+                        self.pending_records.append(
+                            (
+                                "V",
+                                x + int(width / 2),
+                                y + int(height / 2),
+                                width,
+                                height,
+                            )
+                        )
+                    else:
+                        self.pending_records.append(("S", -1, -1, -1, -1))
+
+            with self.profiler.stage("overlay", self.frame_number):
+                self.cur_frame = copy_into(self.cur_frame, self.frame_copy)
+                draw_tracks(
+                    self.cur_frame,
+                    [Annotation(*record) for record in self.pending_records],
+                    self.height,
+                    self.width,
+                    self.active_track,
+                )
+                apply_infobar(
+                    self.cur_frame,
+                    [f"Track {self.active_track + 1}"] + self.multi_keyboard_options,
+                    self.frame_number,
+                    self.width,
+                )
+            with self.profiler.stage("imshow", self.frame_number):
+                cv2.imshow("Video Stream", self.cur_frame)
+
+            self.get_next_frame = False
+            key = cv2.waitKey(0) & 0xFF
+            if key == ord("q") or key == ord("Q"):
+                break
+            elif ord("1") <= key <= ord("9"):
+                if key - ord("1") < len(self.trackers):
+                    self.active_track = key - ord("1")
+            elif key in (ord("l"), ord("L"), ord("f"), ord("F")):
+                self.onLabelTrack()
+            elif key == ord("s") or key == ord("S"):
+                self.pending_records[self.active_track] = ("S", -1, -1, -1, -1)
+            elif key == ord("i") or key == ord("I"):
+                self.pending_records[self.active_track] = ("I", -1, -1, -1, -1)
+            elif key == ord("a") or key == ord("A"):
+                with self.profiler.stage("write", self.frame_number):
+                    self.annotator.write_frame(self.pending_records)
+                self.get_next_frame = True
+                self.frame_number += 1
+
+    def onLabelTrack(self) -> None:
+        """
+        Labels (or fixes) the active track on the current frame without moving on,
+        so the other tracks can still be handled on this frame
+        """
+        frame = self.frame_copy.copy()
+        apply_infobar(
+            frame,
+            [f"Track {self.active_track + 1}"] + self.label_keyboard_options,
+            self.frame_number,
+            self.width,
+        )
+        x, y, width, height = cv2.selectROI(
+            "Video Stream", frame, fromCenter=True, showCrosshair=False
+        )
+        if all(itr == 0 for itr in [x, y, width, height]):
+            return
+        self.lookahead.reinit(
+            self.frame_number, self.frame_copy, (x, y, width, height), self.active_track
+        )
+        self.pending_records[self.active_track] = (
+            "V",
+            x + int(width / 2),
+            y + int(height / 2),
+            width,
+            height,
+        )
+
     def run_prompt_model(
         self, frame, prompt_str
     ) -> tuple[bool, tuple[int, int, int, int]]:
         """
-        Passes in the given prompt to the OwlViTProcessor and object detection models
+        Passes in the given frame to the prompt detector, which already has the prompt encoded
         Given a prompt string, the model will look at the frame and return a predicted bounding box around
         where it thinks the object from the prompt appears
         i.e if the prompt is "man in a red shirt" the model will do it's best to place a bounding box around
         a man in a red shirt it sees in the image
         """
-        inputs = self.processor(
-            text=[prompt_str], images=self.cur_frame, return_tensors="pt"
-        )
-        outputs = self.model(**inputs)
-        pil_image = Image.fromarray(frame)
-        target_sizes = [pil_image.size[::-1]]
-        results = self.processor.post_process_grounded_object_detection(
-            outputs=outputs, target_sizes=target_sizes, threshold=0.1
-        )
-        boxes, scores, labels = (
-            results[0]["boxes"],
-            results[0]["scores"],
-            results[0]["labels"],
-        )
+        # Reruns and repeat visits to a frame are answered from the detection cache
+        detections = self.detector_loader.result().detect([frame], [self.frame_number])[
+            0
+        ]
         # Get highest scoring box
-        if len(scores) == 0:
-            return False, (-1, -1, -1, -1)
-        score_list = scores.tolist()
-        max_prediction_idx = np.argmax(score_list)
-        if score_list[max_prediction_idx] > 0.1:
+        valid, (x, y, width, height), score = detections.best(
+            threshold=self.prompt_threshold
+        )
+        if valid:
             label = prompt_str
-            box_list = boxes.tolist()
-            box = [int(i) for i in box_list[max_prediction_idx]]
-            cv2.rectangle(frame, (box[0], box[1]), (box[2], box[3]), (0, 255, 0), 2)
+            cv2.rectangle(frame, (x, y), (x + width, y + height), (0, 255, 0), 2)
             cv2.putText(
                 frame,
-                f"{label}: {score_list[max_prediction_idx]:.2f}",
-                (box[0], box[1] - 10),
+                f"{label}: {score:.2f}",
+                (x, y - 10),
                 cv2.FONT_HERSHEY_SIMPLEX,
                 0.5,
                 (0, 255, 0),
@@ -261,7 +724,7 @@ class VideoAnnotator:
             apply_infobar(
                 frame, self.prompt_keyboard_options, self.frame_number, self.width
             )
-            return True, (box[0], box[1], box[2] - box[0], box[3] - box[1])
+            return True, (x, y, width, height)
         return False, (-1, -1, -1, -1)  # default return invalid
 
     def onLabel(self) -> None:
@@ -279,25 +742,43 @@ class VideoAnnotator:
         )
         if all(itr == 0 for itr in [x, y, width, height]):
             return
-        self.tracker.init(frame, (x, y, width, height))
+        # Speculative predictions made from the old box are thrown away and recomputed from this one
+        self.lookahead.reinit(self.frame_number, self.frame_copy, (x, y, width, height))
+        if self.redetector is not None:
+            self.redetector.remember(self.frame_number, (x, y, width, height))
         self.tracking = True
         center_x: int = x + int(width / 2)
         center_y: int = y + int(height / 2)
-        self.annotator.write_bounding_box(
-            x_center=center_x, y_center=center_y, width=width, height=height
-        )
+        with self.profiler.stage("write", self.frame_number):
+            self.annotator.write_bounding_box(
+                x_center=center_x, y_center=center_y, width=width, height=height
+            )
 
     def onSkip(self) -> None:
         """
         Skips the current frame, moving to the next frame
         """
-        self.annotator.write_skipped()
+        with self.profiler.stage("write", self.frame_number):
+            self.annotator.write_skipped()
+
+    def onKeyframe(self) -> None:
+        """
+        Skips ahead to the next keyframe, the skipped frames are interpolated once it is labelled
+        The frames in between still go through the tracker, so its prediction is ready on the keyframe
+        """
+        for skipped in range(self.keyframe_step):
+            if skipped > 0 and self.lookahead.get(self.frame_number)[0] is None:
+                # Past the end of the video, the annotation loop stops on its next read
+                return
+            self.onSkip()
+            self.frame_number += 1
 
     def onInvisible(self) -> None:
         """
         Marks the object as invisible in scene, and moves to next frame
         """
-        self.annotator.write_invisible()
+        with self.profiler.stage("write", self.frame_number):
+            self.annotator.write_invisible()
 
     def onAccept(self, predicted_bbox: tuple[int, int, int, int]) -> None:
         """
@@ -306,9 +787,33 @@ class VideoAnnotator:
         x, y, width, height = predicted_bbox
         center_x: int = x + int(width / 2)
         center_y: int = y + int(height / 2)
-        self.annotator.write_bounding_box(
-            x_center=center_x, y_center=center_y, width=width, height=height
-        )
+        with self.profiler.stage("write", self.frame_number):
+            self.annotator.write_bounding_box(
+                x_center=center_x, y_center=center_y, width=width, height=height
+            )
+        if self.redetector is not None:
+            self.redetector.remember(self.frame_number, predicted_bbox)
+
+    def redetect(self) -> tuple[bool, tuple[int, int, int, int] | None]:
+        """
+        Looks for the object the tracker lost on the current frame, starting around where it was heading
+        A box found above the re-detection threshold re-seeds the tracker, so the frames after it are tracked from it
+        After a search that found nothing on the whole frame, nothing is searched until the user labels or accepts a
+        box or the tracker recovers, rather than running the model on every frame the object is out of view
+        """
+        if not self.detector_loader.done():
+            # Still loading, tracking goes on being lost rather than freezing the window on the model
+            return False, None
+        if self.redetector.gave_up:
+            return False, None
+        with self.profiler.stage("redetect", self.frame_number):
+            found, box, _ = self.redetector.find(
+                self.detector_loader.result(), self.frame_copy, self.frame_number
+            )
+        if not found:
+            return False, None
+        self.lookahead.reinit(self.frame_number, self.frame_copy, box)
+        return True, box
 
 
 if __name__ == "__main__":
@@ -321,5 +826,249 @@ if __name__ == "__main__":
     parser.add_argument(
         "--prompt", type=str, default="", help="The prompt to pass to the model"
     )
+    parser.add_argument(
+        "--flush-every",
+        type=int,
+        default=64,
+        help="Number of buffered annotations that triggers a write to disk",
+    )
+    parser.add_argument(
+        "--flush-interval",
+        type=float,
+        default=5.0,
+        help="Maximum number of seconds annotations stay buffered before being written",
+    )
+    parser.add_argument(
+        "--crash-safe",
+        action="store_true",
+        help="Journal every annotation to an fsync'd side file so a crash loses at most --sync-every frames",
+    )
+    parser.add_argument(
+        "--sync-every",
+        type=int,
+        default=1,
+        help="In crash safe mode, how many annotations may be written before the journal is fsync'd",
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=["text", "binary"],
+        default="text",
+        help="Write the V/I/S text format or the compact binary format",
+    )
+    parser.add_argument(
+        "--lookahead",
+        type=int,
+        default=8,
+        help="Number of frames decoded and tracked ahead while waiting on a key, 0 disables speculation",
+    )
+    parser.add_argument(
+        "--model-threads",
+        type=int,
+        default=0,
+        help="Number of CPU threads the prompt model may use, defaults to torch's (or ONNX Runtime's) choice",
+    )
+    parser.add_argument(
+        "--detector-backend",
+        type=str,
+        choices=DETECTOR_BACKENDS,
+        default="eager",
+        help="How the prompt model runs: float32 PyTorch, int8 quantized PyTorch or ONNX Runtime (needs onnxruntime)",
+    )
+    parser.add_argument(
+        "--model-cache",
+        type=str,
+        default="",
+        help="Directory for the converted int8 and ONNX models, defaults to ~/.cache/video-annotation-tool",
+    )
+    parser.add_argument(
+        "--prompt-threshold",
+        type=float,
+        default=0.1,
+        help="Minimum score for a prompt detection to be shown or used as a seed",
+    )
+    parser.add_argument(
+        "--detection-cache-mb",
+        type=int,
+        default=256,
+        help="Size limit of the prompt detection cache kept next to the annotations, 0 disables it",
+    )
+    parser.add_argument(
+        "--prompt-batch",
+        type=int,
+        default=4,
+        help="Headless mode: number of frames the prompt model processes per forward pass",
+    )
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="Track the whole video without a window, starting from --box or --seed-annotations",
+    )
+    parser.add_argument(
+        "--box",
+        type=int,
+        nargs=4,
+        default=None,
+        metavar=("CENTER_X", "CENTER_Y", "WIDTH", "HEIGHT"),
+        help="Headless mode: the object's box on the first frame in the video's pixels, in the same form as a V line",
+    )
+    parser.add_argument(
+        "--seed-annotations",
+        type=str,
+        default="",
+        help="Headless mode: annotation file whose first V line seeds the tracker, its V and I lines are kept. "
+        "Defaults to the video's annotation file, the result then goes to <video-name>.tracked.annotations",
+    )
+    parser.add_argument(
+        "--window-scale",
+        type=float,
+        default=0,
+        help="Headless mode: scale of the window a seed file from before scales were stored was made in, "
+        "required for such a file",
+    )
+    parser.add_argument(
+        "--seed-every-v",
+        action="store_true",
+        help="Headless mode: seed a segment on every V line of the seed annotations, not just the first",
+    )
+    parser.add_argument(
+        "--segment-frames",
+        type=int,
+        default=1800,
+        help="Headless mode: minimum length of the segments that are tracked in parallel, every segment starts on a seed",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Headless mode: number of worker processes, defaults to the number of cores. "
+        "Only a prompt or --seed-every-v give several segments, a single seed is tracked by one process",
+    )
+    parser.add_argument(
+        "--tracker",
+        type=str,
+        choices=list(TRACKER_BACKENDS),
+        default="csrt",
+        help="Tracking backend, trades accuracy (csrt) for speed (kcf, mosse, lk)",
+    )
+    parser.add_argument(
+        "--proxy",
+        type=str,
+        default="",
+        help="Proxy frame file to read frames from, defaults to <video-name>.proxy next to the video when it exists",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default="",
+        metavar="OUT_JSON",
+        help="Time every stage of the frame loop (excluding waiting on keys) and write the report to this JSON file",
+    )
+    parser.add_argument(
+        "--tracks",
+        type=int,
+        default=1,
+        help="Number of objects to annotate in the same pass, each gets its own track in the annotation file",
+    )
+    parser.add_argument(
+        "--track-workers",
+        type=int,
+        default=0,
+        help="Threads the trackers of a multi object session are updated on, defaults to one per track",
+    )
+    parser.add_argument(
+        "--track-scale",
+        type=float,
+        default=0,
+        help="Scale of the video the tracker runs at, e.g. 0.25 for cheaper tracking of 4K sources. "
+        "Defaults to the window's scale, in headless mode to full size up to 1920x1080. "
+        "Boxes are saved in the video's pixels either way",
+    )
+    parser.add_argument(
+        "--redetect-threshold",
+        type=float,
+        default=0.3,
+        help="Score a prompt detection needs to re-seed a track the tracker lost, 0 turns re-detection off",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=CAPTURE_BACKENDS,
+        default="cv2",
+        help="Video decoding backend, pyav (needs PyAV installed) scales frames while converting them",
+    )
+    parser.add_argument(
+        "--decode-threads",
+        type=int,
+        default=0,
+        help="Threads the codec decodes with, 0 lets FFmpeg pick",
+    )
+    parser.add_argument(
+        "--interpolate",
+        type=str,
+        choices=INTERPOLATION_METHODS,
+        default=None,
+        help="Fill skipped frames between two labelled ones with interpolated boxes, and enable the K key",
+    )
+    parser.add_argument(
+        "--keyframe-step",
+        type=int,
+        default=10,
+        help="Frames the K key skips ahead by when interpolating, single track sessions only",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an existing annotation file from its first unannotated frame instead of overwriting it",
+    )
     args = parser.parse_args()
-    video_annotator.StartAnnotations(args.input_file, args.output, args.prompt)
+    if args.headless:
+        video_annotator.StartHeadless(
+            args.input_file,
+            args.output,
+            box=args.box,
+            seed_annotation_path=args.seed_annotations,
+            seed_every_v=args.seed_every_v,
+            segment_frames=args.segment_frames,
+            workers=args.workers,
+            binary=args.format == "binary",
+            prompt_str=args.prompt,
+            model_threads=args.model_threads,
+            prompt_batch=args.prompt_batch,
+            prompt_threshold=args.prompt_threshold,
+            detection_cache_mb=args.detection_cache_mb,
+            tracker=args.tracker,
+            track_scale=args.track_scale,
+            detector_backend=args.detector_backend,
+            model_cache_dir=args.model_cache,
+            seed_window_scale=args.window_scale,
+        )
+        sys.exit(0)
+    video_annotator.StartAnnotations(
+        args.input_file,
+        args.output,
+        args.prompt,
+        flush_every=args.flush_every,
+        flush_interval=args.flush_interval,
+        crash_safe=args.crash_safe,
+        sync_every=args.sync_every,
+        binary=args.format == "binary",
+        lookahead=args.lookahead,
+        model_threads=args.model_threads,
+        prompt_threshold=args.prompt_threshold,
+        detection_cache_mb=args.detection_cache_mb,
+        resume=args.resume,
+        tracker=args.tracker,
+        profile_path=args.profile,
+        tracks=args.tracks,
+        track_workers=args.track_workers,
+        proxy_path=args.proxy,
+        interpolate=args.interpolate or "",
+        keyframe_step=args.keyframe_step,
+        track_scale=args.track_scale,
+        backend=args.backend,
+        decode_threads=args.decode_threads,
+        redetect_threshold=args.redetect_threshold,
+        detector_backend=args.detector_backend,
+        model_cache_dir=args.model_cache,
+    )
@@ -0,0 +1,273 @@
+"""
+Prompt detector backend benchmark and parity check
+
+Samples frames evenly over a video, scaled the way the annotator shows them, and runs every backend over them:
+latency of single frame detections (what a prompt rerun or a re-detection waits on), throughput of batched ones
+(what headless prompt seeding gets) and the time to load the backend, the first load of int8 and onnx includes
+converting the model into the cache
+
+Every backend's output is compared patch by patch with the eager model's: the IoU of the best box per frame and
+of the boxes of the eager model's top scoring patches, and how far their scores drifted. The script exits non zero
+when a backend drifts further than --min-iou / --max-score-drift allow
+
+To run:
+uv run python benchmarks/bench_detectors.py /path/to/video --prompt "a dog" --output detectors.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Dict, List
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+REPO_ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from utils.PromptDetector import (  # noqa: E402
+    DETECTOR_BACKENDS,
+    Detections,
+    PromptDetector,
+)
+from utils.utils import box_iou, get_scaled_image, video_window_scale  # noqa: E402
+
+
+def sample_frames(video_path: str, count: int, window_scale: float) -> List[ndarray]:
+    cap = cv2.VideoCapture(video_path)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    frames: List[ndarray] = []
+    for frame_number in np.linspace(0, max(frame_count - 1, 0), count).astype(int):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, int(frame_number))
+        ret, frame = cap.read()
+        if ret:
+            frames.append(get_scaled_image(frame, window_scale))
+    cap.release()
+    return frames
+
+
+def to_centers(boxes: ndarray) -> ndarray:
+    """
+    (x0, y0, x1, y1) corners to (center x, center y, width, height)
+    """
+    return np.concatenate(
+        [(boxes[:, :2] + boxes[:, 2:]) / 2, boxes[:, 2:] - boxes[:, :2]], axis=1
+    )
+
+
+def compare(
+    reference: List[Detections], detections: List[Detections], top: int
+) -> Dict[str, float]:
+    """
+    Patch by patch drift of a backend from the eager model, over the eager model's top scoring patches of every frame
+    """
+    best_ious: List[float] = []
+    top_ious: List[ndarray] = []
+    score_drift: List[ndarray] = []
+    for expected, found in zip(reference, detections):
+        best = int(np.argmax(expected.scores))
+        best_found = int(np.argmax(found.scores))
+        best_ious.append(
+            float(
+                box_iou(
+                    to_centers(expected.boxes[[best]]),
+                    to_centers(found.boxes[[best_found]]),
+                )[0]
+            )
+        )
+        patches = np.argsort(-expected.scores)[:top]
+        top_ious.append(
+            box_iou(
+                to_centers(expected.boxes[patches]), to_centers(found.boxes[patches])
+            )
+        )
+        score_drift.append(np.abs(expected.scores[patches] - found.scores[patches]))
+    top_iou = np.concatenate(top_ious)
+    drift = np.concatenate(score_drift)
+    return {
+        "min_best_box_iou": float(np.min(best_ious)),
+        "mean_best_box_iou": float(np.mean(best_ious)),
+        "mean_top_iou": float(top_iou.mean()),
+        "max_score_drift": float(drift.max()),
+        "mean_score_drift": float(drift.mean()),
+    }
+
+
+def benchmark_detectors(
+    frames: List[ndarray],
+    prompt_str: str,
+    backends: List[str],
+    num_threads: int = 0,
+    batch_size: int = 4,
+    model_cache_dir: str = "",
+    repeats: int = 3,
+    top: int = 10,
+) -> Dict[str, Dict]:
+    """
+    Load time, single frame latency, batched throughput and parity with the eager model of every backend
+    """
+    results: Dict[str, Dict] = {}
+    reference: List[Detections] | None = None
+    # Eager goes first, it is what the others are compared against
+    for backend in sorted(backends, key=lambda name: name != "eager"):
+        start_time = time.perf_counter()
+        detector = PromptDetector(
+            prompt_str,
+            batch_size=batch_size,
+            num_threads=num_threads,
+            backend=backend,
+            model_cache_dir=model_cache_dir,
+        )
+        # The first call pays for ONNX Runtime's session setup (and the export on a first run)
+        detector.detect(frames[:1])
+        load_seconds = time.perf_counter() - start_time
+
+        latencies: List[float] = []
+        for _ in range(repeats):
+            for frame in frames:
+                start_time = time.perf_counter()
+                detector.detect([frame])
+                latencies.append(time.perf_counter() - start_time)
+        start_time = time.perf_counter()
+        detections = detector.detect(frames)
+        batch_seconds = time.perf_counter() - start_time
+
+        result = {
+            "load_seconds": load_seconds,
+            "latency_ms_p50": float(np.percentile(latencies, 50) * 1000),
+            "latency_ms_p95": float(np.percentile(latencies, 95) * 1000),
+            "batched_fps": len(frames) / max(batch_seconds, 1e-9),
+        }
+        if backend == "eager":
+            reference = detections
+        if reference is not None:
+            result.update(compare(reference, detections, top))
+        results[backend] = result
+        del detector
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_file", type=str, help="Path to the input video file.")
+    parser.add_argument(
+        "--prompt", type=str, required=True, help="The prompt to detect"
+    )
+    parser.add_argument(
+        "--backends",
+        type=str,
+        nargs="+",
+        choices=DETECTOR_BACKENDS,
+        default=list(DETECTOR_BACKENDS),
+        help="Backends to compare, eager is always run as the reference",
+    )
+    parser.add_argument(
+        "--frames", type=int, default=8, help="Frames sampled evenly over the video"
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=3,
+        help="Single frame detections timed per sampled frame",
+    )
+    parser.add_argument(
+        "--model-threads",
+        type=int,
+        default=0,
+        help="Threads of torch and ONNX Runtime, defaults to their own choice",
+    )
+    parser.add_argument(
+        "--prompt-batch",
+        type=int,
+        default=4,
+        help="Frames per forward pass for the batched throughput",
+    )
+    parser.add_argument(
+        "--model-cache",
+        type=str,
+        default="",
+        help="Directory for the converted models, defaults to ~/.cache/video-annotation-tool",
+    )
+    parser.add_argument(
+        "--window-scale",
+        type=float,
+        default=0,
+        help="Scale frames are detected at, defaults to what the annotator would use on this screen",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=10,
+        help="Highest scoring patches of the eager model per frame that boxes and scores are compared on",
+    )
+    parser.add_argument(
+        "--min-iou",
+        type=float,
+        default=0.9,
+        help="Lowest IoU a backend's best box may have with the eager model's on any frame",
+    )
+    parser.add_argument(
+        "--max-score-drift",
+        type=float,
+        default=0.05,
+        help="Largest score difference from the eager model allowed on the compared patches",
+    )
+    parser.add_argument(
+        "--output", type=str, default="", help="Write the results to this JSON file"
+    )
+    args = parser.parse_args()
+
+    window_scale = args.window_scale or video_window_scale(args.input_file)
+    frames = sample_frames(args.input_file, args.frames, window_scale)
+    if not frames:
+        parser.error(f"Couldn't read any frames from {args.input_file}")
+    backends = list(dict.fromkeys(["eager"] + args.backends))
+    results = benchmark_detectors(
+        frames,
+        args.prompt,
+        backends,
+        args.model_threads,
+        args.prompt_batch,
+        args.model_cache,
+        args.repeats,
+        args.top,
+    )
+
+    failed = False
+    print(
+        f"{'backend':<8} {'load s':>7} {'p50 ms':>8} {'p95 ms':>8} {'batch fps':>10} "
+        f"{'min IoU':>8} {'top IoU':>8} {'drift':>7}  parity"
+    )
+    for name, result in results.items():
+        passed = (
+            result["min_best_box_iou"] >= args.min_iou
+            and result["max_score_drift"] <= args.max_score_drift
+        )
+        result["parity"] = passed
+        failed |= not passed
+        print(
+            f"{name:<8} {result['load_seconds']:7.1f} {result['latency_ms_p50']:8.1f} "
+            f"{result['latency_ms_p95']:8.1f} {result['batched_fps']:10.2f} "
+            f"{result['min_best_box_iou']:8.3f} {result['mean_top_iou']:8.3f} "
+            f"{result['max_score_drift']:7.4f}  {'ok' if passed else 'FAILED'}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(
+                {
+                    "frames": len(frames),
+                    "window_scale": window_scale,
+                    "results": results,
+                },
+                file,
+                indent=2,
+            )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,402 @@
+"""
+End to end benchmark of the decode, scale, track, overlay and write hot path
+
+Generates synthetic videos with cv2.VideoWriter (every combination of the given resolutions, lengths and codecs)
+showing a textured object moving over a textured background, so the ground truth box of every frame is known.
+Both tools are then driven without a human: the VideoAnnotator labels the first frame with the ground truth box
+and accepts every prediction (skipping frames the tracker lost), the AnnotationValidator steps through every frame.
+Each run happens in a fresh interpreter with a --profile report, and records wall clock throughput,
+per stage timings and peak memory. The annotator's boxes are also scored against the ground truth
+
+The screen is emulated with --display, so display scaling (and therefore the results) don't depend on the
+machine's monitor. Results go to a JSON file together with the environment, so runs can be compared over time
+
+To run:
+uv run python benchmarks/bench_pipeline.py --resolutions 1280x720 1920x1080 --lengths 300 --output pipeline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+REPO_ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from utils.AnnotationStore import AnnotationStore  # noqa: E402
+from utils.utils import box_iou  # noqa: E402
+
+# Container extension per fourcc
+CODEC_EXTENSIONS: Dict[str, str] = {
+    "mp4v": ".mp4",
+    "avc1": ".mp4",
+    "MJPG": ".avi",
+    "XVID": ".avi",
+}
+
+# Shared by both tools: no window, a fixed screen size and peak memory reported at the end.
+# Whatever the tool printed is followed by one JSON line the parent picks up
+CHILD_PRELUDE: str = """
+import json, resource, sys, time
+import cv2
+
+cv2.imshow = lambda *args: None
+
+def display_scale(width, height):
+    if width < {display_width} and height < {display_height}:
+        return 1
+    return min({display_width} / width, {display_height} / height)
+
+def report(frames, seconds):
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({{"frames": frames, "seconds": seconds, "peak_rss_mb": peak_kb / 1024}}))
+"""
+
+ANNOTATOR_SNIPPET: str = """
+import utils.utils
+import VideoAnnotator as module
+
+# Both tools get their window's scale from the video's dimensions and the (emulated) screen
+utils.utils.get_optimal_window_scaling = display_scale
+annotator = module.VideoAnnotator()
+first_box = {first_box!r}
+cv2.selectROI = lambda *args, **kwargs: first_box
+last_frame = [-1]
+
+def wait_key(delay=0):
+    # Label the first frame, then accept every prediction, and skip when nothing was predicted
+    if annotator.frame_number == 0 and not annotator.tracking:
+        key = "l"
+    elif annotator.frame_number == last_frame[0]:
+        key = "s"
+    else:
+        key = "a"
+    last_frame[0] = annotator.frame_number
+    return ord(key)
+
+cv2.waitKey = wait_key
+start = time.perf_counter()
+annotator.StartAnnotations(
+    {video!r}, {annotations!r}, tracker={tracker!r}, profile_path={profile!r}
+)
+report(annotator.frame_number, time.perf_counter() - start)
+"""
+
+VALIDATOR_SNIPPET: str = """
+import pynput.keyboard
+import utils.utils
+import Validate_Annotation as module
+
+class Listener:
+    # No keyboard hook needed, the keys are scripted
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def start(self):
+        pass
+
+pynput.keyboard.Listener = Listener
+utils.utils.get_optimal_window_scaling = display_scale
+validator = module.AnnotationValidator()
+remaining = [{frames}]
+
+def wait_key(delay=0):
+    remaining[0] -= 1
+    return ord("n") if remaining[0] > 0 else ord("q")
+
+cv2.waitKey = wait_key
+start = time.perf_counter()
+validator.ReadAnnotations({video!r}, {annotations!r}, profile_path={profile!r})
+report(validator.frame_number + 1, time.perf_counter() - start)
+"""
+
+
+def object_path(
+    frame_number: int, frame_count: int, width: int, height: int, size: int
+) -> Tuple[int, int]:
+    """
+    Top left corner of the object, a smooth loop over most of the frame
+    """
+    phase = 2 * np.pi * frame_number / max(frame_count, 1)
+    x = (width - size) * (0.5 + 0.4 * np.sin(phase))
+    y = (height - size) * (0.5 + 0.35 * np.sin(2 * phase))
+    return int(x), int(y)
+
+
+def make_synthetic_video(
+    video_path: str, width: int, height: int, frame_count: int, fourcc: str
+) -> ndarray | None:
+    """
+    Writes the video and returns its ground truth (center x, center y, width, height) boxes in source pixels,
+    None if this OpenCV build can't encode the codec
+    """
+    writer = cv2.VideoWriter(
+        video_path, cv2.VideoWriter_fourcc(*fourcc), 30, (width, height)
+    )
+    if not writer.isOpened():
+        return None
+    rng = np.random.default_rng(0)
+    background = cv2.GaussianBlur(
+        rng.integers(0, 256, (height, width, 3), dtype=np.uint8), (9, 9), 0
+    )
+    size = max(16, height // 6)
+    # Blocky texture gives the trackers (and the optical flow corners) something to hold on to
+    blocks = rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+    sprite = cv2.resize(blocks, (size, size), interpolation=cv2.INTER_NEAREST)
+    boxes = np.empty((frame_count, 4), dtype=np.int32)
+    for frame_number in range(frame_count):
+        x, y = object_path(frame_number, frame_count, width, height, size)
+        frame = background.copy()
+        frame[y : y + size, x : x + size] = sprite
+        writer.write(frame)
+        boxes[frame_number] = (x + size // 2, y + size // 2, size, size)
+    writer.release()
+    return boxes
+
+
+def display_scale(
+    width: int, height: int, display_width: int, display_height: int
+) -> float:
+    """
+    Same rule as get_optimal_window_scaling, for the emulated screen
+    """
+    if width < display_width and height < display_height:
+        return 1
+    return min(display_width / width, display_height / height)
+
+
+def scale_boxes(boxes: ndarray, scale: float) -> ndarray:
+    """
+    Source pixel boxes in display coordinates, the way the annotator would have written them
+    """
+    scaled = np.empty_like(boxes)
+    corners = boxes[:, :2] - boxes[:, 2:] // 2
+    scaled_corners = (corners * scale).astype(np.int32)
+    scaled[:, 2:] = (boxes[:, 2:] * scale).astype(np.int32)
+    scaled[:, :2] = scaled_corners + scaled[:, 2:] // 2
+    return scaled
+
+
+def run_child(snippet: str) -> Dict:
+    result = subprocess.run(
+        [sys.executable, "-c", snippet],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Benchmark run failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def summarise_profile(profile_path: str) -> Dict[str, Dict]:
+    """
+    Keeps the percentiles of the --profile report and adds a throughput per stage
+    """
+    with open(profile_path, "r") as file:
+        stages = json.load(file)["stages"]
+    return {
+        name: {
+            "count": stage["count"],
+            "mean_ms": stage["mean_ms"],
+            "p50_ms": stage["p50_ms"],
+            "p95_ms": stage["p95_ms"],
+            "p99_ms": stage["p99_ms"],
+            "throughput_per_s": 1000 / max(stage["mean_ms"], 1e-9),
+        }
+        for name, stage in stages.items()
+    }
+
+
+def environment() -> Dict:
+    commit = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "system": platform.platform(),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--resolutions",
+        type=str,
+        nargs="+",
+        default=["640x360", "1280x720", "1920x1080"],
+        help="Video sizes as WIDTHxHEIGHT",
+    )
+    parser.add_argument(
+        "--lengths", type=int, nargs="+", default=[300], help="Video lengths in frames"
+    )
+    parser.add_argument(
+        "--codecs",
+        type=str,
+        nargs="+",
+        choices=list(CODEC_EXTENSIONS),
+        default=["mp4v", "MJPG"],
+        help="FourCC codes to encode the videos with, ones this OpenCV build can't write are skipped",
+    )
+    parser.add_argument(
+        "--tools",
+        type=str,
+        nargs="+",
+        choices=["annotator", "validator"],
+        default=["annotator", "validator"],
+    )
+    parser.add_argument("--tracker", type=str, default="csrt")
+    parser.add_argument(
+        "--display",
+        type=str,
+        default="1920x1080",
+        help="Emulated screen size as WIDTHxHEIGHT, decides the display scaling",
+    )
+    parser.add_argument(
+        "--video-dir",
+        type=str,
+        default="",
+        help="Keep (and reuse) the generated videos here instead of a temporary directory",
+    )
+    parser.add_argument(
+        "--output", type=str, default="", help="Write the results to this JSON file"
+    )
+    args = parser.parse_args()
+    display_width, display_height = (int(i) for i in args.display.split("x"))
+    prelude = CHILD_PRELUDE.format(
+        display_width=display_width, display_height=display_height
+    )
+
+    runs: List[Dict] = []
+    with tempfile.TemporaryDirectory() as temp_directory:
+        video_directory = args.video_dir or temp_directory
+        os.makedirs(video_directory, exist_ok=True)
+        for resolution in args.resolutions:
+            width, height = (int(i) for i in resolution.split("x"))
+            for frame_count in args.lengths:
+                for codec in args.codecs:
+                    name = f"synthetic_{width}x{height}_{frame_count}_{codec}"
+                    video_path = os.path.join(
+                        video_directory, name + CODEC_EXTENSIONS[codec]
+                    )
+                    truth_path = os.path.join(video_directory, name + ".truth.npy")
+                    if os.path.exists(video_path) and os.path.exists(truth_path):
+                        truth = np.load(truth_path)
+                    else:
+                        truth = make_synthetic_video(
+                            video_path, width, height, frame_count, codec
+                        )
+                        if truth is None:
+                            print(f"Skipping {codec}, this OpenCV can't encode it")
+                            continue
+                        np.save(truth_path, truth)
+
+                    scale = display_scale(width, height, display_width, display_height)
+                    display_truth = scale_boxes(truth, scale)
+                    # The validator replays the ground truth, so it has a box to draw on every frame
+                    truth_annotations = os.path.join(temp_directory, name + ".truth")
+                    AnnotationStore(
+                        np.full(len(truth), ord("V"), dtype=np.uint8), display_truth
+                    ).to_text(truth_annotations)
+
+                    for tool in args.tools:
+                        profile_path = os.path.join(
+                            temp_directory, f"{name}.{tool}.json"
+                        )
+                        if tool == "annotator":
+                            annotations = os.path.join(
+                                temp_directory, name + ".annotations"
+                            )
+                            x, y, box_width, box_height = (
+                                int(i) for i in display_truth[0]
+                            )
+                            snippet = prelude + ANNOTATOR_SNIPPET.format(
+                                video=video_path,
+                                annotations=annotations,
+                                tracker=args.tracker,
+                                profile=profile_path,
+                                first_box=(
+                                    x - box_width // 2,
+                                    y - box_height // 2,
+                                    box_width,
+                                    box_height,
+                                ),
+                            )
+                        else:
+                            snippet = prelude + VALIDATOR_SNIPPET.format(
+                                video=video_path,
+                                annotations=truth_annotations,
+                                frames=frame_count,
+                                profile=profile_path,
+                            )
+                        result = run_child(snippet)
+                        run = {
+                            "tool": tool,
+                            "video": name,
+                            "width": width,
+                            "height": height,
+                            "frames": frame_count,
+                            "codec": codec,
+                            "display_scale": scale,
+                            "fps": result["frames"] / max(result["seconds"], 1e-9),
+                            "seconds": result["seconds"],
+                            "peak_rss_mb": result["peak_rss_mb"],
+                            "stages": summarise_profile(profile_path),
+                        }
+                        if tool == "annotator":
+                            # Written in the video's pixels, compared at the display's scale
+                            store = AnnotationStore.from_text(annotations).at_scale(
+                                scale
+                            )
+                            visible = store.visible
+                            ious = box_iou(
+                                store.boxes[visible],
+                                display_truth[: len(store)][visible],
+                            )
+                            run["annotated_frames"] = len(store)
+                            run["tracked_share"] = (
+                                float(visible.mean()) if len(store) else 0.0
+                            )
+                            run["mean_iou"] = float(ious.mean()) if len(ious) else 0.0
+                        runs.append(run)
+                        print(
+                            f"{tool:<9} {name:<36} {run['fps']:8.1f} fps  "
+                            f"{run['peak_rss_mb']:7.1f} MB peak"
+                            + (
+                                f"  IoU {run['mean_iou']:.3f}"
+                                if tool == "annotator"
+                                else ""
+                            )
+                        )
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(
+                {"environment": environment(), "tracker": args.tracker, "runs": runs},
+                file,
+                indent=2,
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
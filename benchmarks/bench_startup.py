@@ -0,0 +1,205 @@
+"""
+Startup time benchmark for both CLI tools
+
+Measures how long importing each entry point takes, which modules dominate that import,
+and the time from process start to the first frame being shown. Every measurement runs in a fresh
+interpreter so nothing is already cached in sys.modules
+
+Passing --max-import and/or --max-first-frame turns it into a budget check that exits non zero
+when the median goes over, so startup regressions show up
+
+To run:
+uv run python benchmarks/bench_startup.py --video /optional/path/to/video/
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List
+
+import cv2
+import numpy as np
+
+REPO_ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINTS: Dict[str, str] = {
+    "VideoAnnotator": "VideoAnnotator",
+    "Validate_Annotation": "Validate_Annotation",
+}
+
+IMPORT_SNIPPET: str = """
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+"""
+
+# Starts timing before anything is imported, then scripts a "q" keypress and reports the moment
+# the first frame reaches cv2.imshow
+FIRST_FRAME_SNIPPET: str = """
+import time
+start = time.perf_counter()
+import os
+import cv2
+
+def imshow(window_name, frame):
+    print(time.perf_counter() - start, flush=True)
+    os._exit(0)
+
+cv2.imshow = imshow
+cv2.waitKey = lambda *args: ord("q")
+{launch}
+"""
+
+LAUNCH: Dict[str, str] = {
+    "VideoAnnotator": (
+        "from VideoAnnotator import VideoAnnotator\n"
+        "VideoAnnotator().StartAnnotations({video!r}, {annotations!r}, {prompt!r})"
+    ),
+    "Validate_Annotation": (
+        "from Validate_Annotation import AnnotationValidator\n"
+        "AnnotationValidator().ReadAnnotations({video!r}, {annotations!r})"
+    ),
+}
+
+
+def run_snippet(snippet: str) -> float:
+    result = subprocess.run(
+        [sys.executable, "-c", snippet],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Benchmark run failed:\n{result.stderr}")
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def heaviest_imports(module: str, top: int = 10) -> List[tuple[str, float]]:
+    """
+    Modules with the highest cumulative import time according to python -X importtime
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    timings: List[tuple[str, float]] = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = (part.strip() for part in line[12:].split("|"))
+        timings.append((name, int(cumulative) / 1e6))
+    return sorted(timings, key=lambda timing: timing[1], reverse=True)[:top]
+
+
+def make_synthetic_video(directory: str, frames: int = 30) -> str:
+    video_path = os.path.join(directory, "startup.mp4")
+    writer = cv2.VideoWriter(
+        video_path, cv2.VideoWriter_fourcc(*"mp4v"), 30, (640, 360)
+    )
+    for frame_number in range(frames):
+        frame = np.zeros((360, 640, 3), dtype=np.uint8)
+        cv2.rectangle(
+            frame,
+            (frame_number * 4, 100),
+            (frame_number * 4 + 80, 180),
+            (0, 255, 0),
+            -1,
+        )
+        writer.write(frame)
+    writer.release()
+    return video_path
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--video",
+        type=str,
+        default="",
+        help="Video to open, defaults to a synthetic clip",
+    )
+    parser.add_argument(
+        "--prompt", type=str, default="", help="Also time the annotator with a prompt"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement")
+    parser.add_argument(
+        "--max-import", type=float, default=0, help="Import time budget in seconds"
+    )
+    parser.add_argument(
+        "--max-first-frame",
+        type=float,
+        default=0,
+        help="Time to first frame budget in seconds",
+    )
+    parser.add_argument(
+        "--output", type=str, default="", help="Write the results to this JSON file"
+    )
+    args = parser.parse_args()
+
+    results: Dict[str, Dict] = {}
+    over_budget: List[str] = []
+    with tempfile.TemporaryDirectory() as directory:
+        video_path = args.video or make_synthetic_video(directory)
+        # The validator needs an annotation file to open, the annotator writes one
+        annotation_path = os.path.join(directory, "startup.annotations")
+        frame_count = max(
+            1, int(cv2.VideoCapture(video_path).get(cv2.CAP_PROP_FRAME_COUNT))
+        )
+        with open(annotation_path, "w") as file:
+            file.write("S -1 -1 -1 -1\n" * frame_count)
+
+        for name, module in ENTRY_POINTS.items():
+            import_times = [
+                run_snippet(IMPORT_SNIPPET.format(module=module))
+                for _ in range(args.repeat)
+            ]
+            launch = LAUNCH[name].format(
+                video=video_path,
+                annotations=(
+                    annotation_path
+                    if name == "Validate_Annotation"
+                    else os.path.join(directory, "annotator.annotations")
+                ),
+                prompt=args.prompt,
+            )
+            first_frame_times = [
+                run_snippet(FIRST_FRAME_SNIPPET.format(launch=launch))
+                for _ in range(args.repeat)
+            ]
+            results[name] = {
+                "import_s": statistics.median(import_times),
+                "first_frame_s": statistics.median(first_frame_times),
+                "heaviest_imports": heaviest_imports(module),
+            }
+            print(
+                f"{name}: import {results[name]['import_s'] * 1000:.0f} ms, "
+                f"first frame {results[name]['first_frame_s'] * 1000:.0f} ms"
+            )
+            for import_name, seconds in results[name]["heaviest_imports"]:
+                print(f"    {seconds * 1000:8.1f} ms  {import_name}")
+            if args.max_import and results[name]["import_s"] > args.max_import:
+                over_budget.append(f"{name} import")
+            if (
+                args.max_first_frame
+                and results[name]["first_frame_s"] > args.max_first_frame
+            ):
+                over_budget.append(f"{name} first frame")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if over_budget:
+        print(f"Over budget: {', '.join(over_budget)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+"""
+Tracker backend benchmark
+
+Replays an existing annotation file as ground truth: every run of consecutive V frames is one sequence,
+each backend is initialised on the sequence's first box (like a user labelling it) and then tracks
+the rest of it. Reports per backend tracking speed (update calls only, decoding and scaling are shared
+and not counted), mean IoU against the annotated boxes and how often the tracker reported a loss
+
+Annotations are in display coordinates, so frames are scaled the same way the annotator scaled them,
+pass --window-scale if the annotations were made on a different screen
+
+To run:
+uv run python benchmarks/bench_trackers.py /path/to/video --annotations /optional/path/to/annotations
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Dict, List
+
+import cv2
+import numpy as np
+
+REPO_ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from utils.AnnotationStore import AnnotationStore  # noqa: E402
+from utils.HeadlessTracker import center_to_corner  # noqa: E402
+from utils.Trackers import TRACKER_BACKENDS, create_tracker  # noqa: E402
+from utils.utils import box_iou, get_scaled_image, video_window_scale  # noqa: E402
+
+
+def benchmark_trackers(
+    video_path: str,
+    store: AnnotationStore,
+    tracker_names: List[str],
+    window_scale: float,
+    max_frames: int = 0,
+) -> Dict[str, Dict]:
+    """
+    Runs every backend over the same decoded frames in lockstep, returns fps, mean IoU and loss rate per backend
+    """
+    frame_count = len(store) if max_frames <= 0 else min(len(store), max_frames)
+    visible = store.visible[:frame_count]
+    # A sequence starts on every V frame that doesn't follow another V frame
+    starts = visible & ~np.concatenate([[False], visible[:-1]])
+
+    trackers = {name: create_tracker(name) for name in tracker_names}
+    update_seconds = {name: 0.0 for name in tracker_names}
+    predictions = {
+        name: np.full((frame_count, 4), -1, dtype=np.int32) for name in tracker_names
+    }
+    lost = {name: np.zeros(frame_count, dtype=bool) for name in tracker_names}
+
+    cap = cv2.VideoCapture(video_path)
+    for frame_number in range(frame_count):
+        if not visible[frame_number]:
+            # Nothing to compare against, don't pay for decoding it
+            if not cap.grab():
+                break
+            continue
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frame = get_scaled_image(frame, window_scale)
+        for name, tracker in trackers.items():
+            if starts[frame_number]:
+                tracker.init(
+                    frame,
+                    center_to_corner(*(int(i) for i in store.boxes[frame_number])),
+                )
+                predictions[name][frame_number] = store.boxes[frame_number]
+                continue
+            start_time = time.perf_counter()
+            ok, bbox = tracker.update(frame)
+            update_seconds[name] += time.perf_counter() - start_time
+            if ok:
+                x, y, width, height = (int(i) for i in bbox)
+                predictions[name][frame_number] = (
+                    x + int(width / 2),
+                    y + int(height / 2),
+                    width,
+                    height,
+                )
+            else:
+                lost[name][frame_number] = True
+    cap.release()
+
+    # Sequence starts are given, not predicted, so only the tracked frames count
+    tracked = visible & ~starts
+    results: Dict[str, Dict] = {}
+    for name in tracker_names:
+        ious = box_iou(predictions[name][tracked], store.boxes[:frame_count][tracked])
+        ious[lost[name][tracked]] = 0
+        updates = int(np.count_nonzero(tracked))
+        results[name] = {
+            "fps": updates / max(update_seconds[name], 1e-9),
+            "mean_iou": float(ious.mean()) if updates else 0.0,
+            "success_rate_iou_0.5": float((ious >= 0.5).mean()) if updates else 0.0,
+            "lost_rate": float(lost[name][tracked].mean()) if updates else 0.0,
+            "tracked_frames": updates,
+            "sequences": int(np.count_nonzero(starts)),
+        }
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_file", type=str, help="Path to the input video file.")
+    parser.add_argument(
+        "--annotations",
+        type=str,
+        default="",
+        help="Ground truth annotation file, defaults to the one next to the video",
+    )
+    parser.add_argument(
+        "--trackers",
+        type=str,
+        nargs="+",
+        choices=list(TRACKER_BACKENDS),
+        default=list(TRACKER_BACKENDS),
+        help="Backends to compare",
+    )
+    parser.add_argument(
+        "--window-scale",
+        type=float,
+        default=0,
+        help="Scale the trackers run at (and older, window pixel annotations were made at), defaults to what the annotator would use on this screen",
+    )
+    parser.add_argument(
+        "--max-frames", type=int, default=0, help="Only replay the first N frames"
+    )
+    parser.add_argument(
+        "--output", type=str, default="", help="Write the results to this JSON file"
+    )
+    args = parser.parse_args()
+
+    annotation_path = args.annotations
+    if annotation_path == "":
+        annotation_path = os.path.splitext(args.input_file)[0] + ".annotations"
+        if not os.path.exists(annotation_path):
+            annotation_path += ".bin"
+    window_scale = args.window_scale or video_window_scale(args.input_file)
+    store = AnnotationStore.load(annotation_path).at_scale(window_scale)
+
+    results = benchmark_trackers(
+        args.input_file, store, args.trackers, window_scale, args.max_frames
+    )
+    print(f"{'tracker':<8} {'fps':>9} {'mean IoU':>9} {'IoU>=.5':>8} {'lost':>7}")
+    for name, result in results.items():
+        print(
+            f"{name:<8} {result['fps']:9.1f} {result['mean_iou']:9.3f} "
+            f"{result['success_rate_iou_0.5']:8.1%} {result['lost_rate']:7.1%}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+"""
+Parsing of V/I/S text files by utils.AnnotationStore
+"""
+
+import pytest
+
+from utils.AnnotationStore import FLAG_INTERPOLATED, AnnotationStore
+
+
+def write(tmp_path, text):
+    path = tmp_path / "clip.annotations"
+    path.write_text(text)
+    return str(path)
+
+
+def test_legacy_file_loads_every_line(tmp_path):
+    store = AnnotationStore.load(
+        write(tmp_path, "V 10 20 30 40\nS -1 -1 -1 -1\nI -1 -1 -1 -1\n")
+    )
+    assert bytes(store.types).decode() == "VSI"
+    assert store.boxes[0].tolist() == [10, 20, 30, 40]
+    assert store.scale == 0
+
+
+def test_header_tracks_flags_and_blank_lines(tmp_path):
+    tracks = AnnotationStore.load_tracks(
+        write(
+            tmp_path,
+            "# tracks: 2 flags scale: 1\n"
+            "V 1 2 3 4 0 I -1 -1 -1 -1 0\r\n"
+            "\n"
+            f"V 5 6 7 8 {FLAG_INTERPOLATED} S -1 -1 -1 -1 0",
+        )
+    )
+    assert [bytes(track.types).decode() for track in tracks] == ["VV", "IS"]
+    assert tracks[0].flags.tolist() == [0, FLAG_INTERPOLATED]
+    assert tracks[0].boxes[1].tolist() == [5, 6, 7, 8]
+    assert tracks[1].scale == 1.0
+
+
+@pytest.mark.parametrize(
+    "text, error",
+    [
+        (
+            "V 1 2 3 4\nS -1 -1 -1 -1\nX 1 2 3 4\nV 1 2 3 4\n",
+            "line 3: 'X' is not a value",
+        ),
+        ("V 1 2 3 4\nS -1 -1 -1\n", "line 2: expected 5 values, found 4"),
+        ("V 1 2.5 3 4\nI -1 -1 -1 -1\n", "line 1: '2.5' is not a value"),
+        ("V 1 2 3 4\nV 1 2 3 4x\n", "line 2: '4x' is not a value"),
+        ("V 1 2 3 4\nV 1 2 3 4 5\n", "line 2: expected 5 values, found 6"),
+        ("V 1 2 3 4\n7 1 2 3 4\n", "line 2: every record has to start with V, I or S"),
+        (
+            "# tracks: 1 flags\nV 1 2 3 4 0\nV 1 2 3 4\n",
+            "line 3: expected 6 values, found 5",
+        ),
+    ],
+)
+def test_corrupt_lines_are_reported_instead_of_truncating(tmp_path, text, error):
+    path = write(tmp_path, text)
+    with pytest.raises(ValueError, match=f"^{path} {error}$".replace(".", r"\.")):
+        AnnotationStore.load(path)
@@ -0,0 +1,64 @@
+"""
+Parity of the int8 and ONNX prompt detector backends with the eager model, on a fixed image
+
+Uses the same measures and bounds as benchmarks/bench_detectors.py. Skipped when torch, transformers, onnxruntime
+(for the ONNX backend) or the model are missing. The model is never downloaded here, running the annotator or
+bench_detectors.py with a prompt once puts it in the Hugging Face cache
+"""
+
+import cv2
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+huggingface_hub = pytest.importorskip("huggingface_hub")
+
+from benchmarks.bench_detectors import compare  # noqa: E402
+from utils.PromptDetector import DEFAULT_MODEL_ID, PromptDetector  # noqa: E402
+
+PROMPT: str = "a red circle"
+# The bench_detectors.py defaults
+MIN_IOU: float = 0.9
+MAX_SCORE_DRIFT: float = 0.05
+TOP: int = 10
+
+
+def fixed_image() -> np.ndarray:
+    """
+    A 640x360 frame with a red disc and a blue square on a gradient, the same every run
+    """
+    image = np.zeros((360, 640, 3), dtype=np.uint8)
+    image[:] = np.linspace(40, 200, 640, dtype=np.uint8)[None, :, None]
+    cv2.circle(image, (420, 170), 60, (0, 0, 230), -1)
+    cv2.rectangle(image, (90, 200), (190, 300), (220, 60, 20), -1)
+    return image
+
+
+def load_detector(backend: str) -> PromptDetector:
+    if not isinstance(
+        huggingface_hub.try_to_load_from_cache(DEFAULT_MODEL_ID, "config.json"), str
+    ):
+        pytest.skip(f"{DEFAULT_MODEL_ID} is not in the Hugging Face cache")
+    try:
+        return PromptDetector(PROMPT, num_threads=2, backend=backend)
+    except (OSError, ImportError) as error:
+        # A broken cached model, or a missing optional dependency of the backend
+        pytest.skip(f"{backend} detector unavailable: {error}")
+
+
+@pytest.fixture(scope="module")
+def reference():
+    return load_detector("eager").detect([fixed_image()])
+
+
+@pytest.mark.parametrize("backend", ["int8", "onnx"])
+def test_backend_matches_eager(reference, backend):
+    if backend == "onnx":
+        pytest.importorskip("onnxruntime")
+        pytest.importorskip("onnx")
+        pytest.importorskip("onnxscript")
+    detections = load_detector(backend).detect([fixed_image()])
+    drift = compare(reference, detections, TOP)
+    assert drift["min_best_box_iou"] >= MIN_IOU, drift
+    assert drift["max_score_drift"] <= MAX_SCORE_DRIFT, drift
@@ -0,0 +1,252 @@
+"""
+Gap filling of utils.Interpolation, in batch (interpolate_gaps / interpolate_track) and in session (GapInterpolator)
+"""
+
+import atexit
+
+import numpy as np
+import pytest
+
+from Interpolate_Annotations import interpolate_file
+from utils.AnnotationStore import FLAG_INTERPOLATED, AnnotationStore
+from utils.Annotator import Annotator
+from utils.Interpolation import GapInterpolator, interpolate_gaps, interpolate_track
+
+NO_BOX = (-1, -1, -1, -1)
+
+
+def track(*frames):
+    """
+    Types and boxes from (type, center x) pairs, every V box is 10 x 10 at y 50
+    """
+    types = np.array([ord(annotation_type) for annotation_type, _ in frames], np.uint8)
+    boxes = np.array(
+        [
+            (x, 50, 10, 10) if annotation_type == "V" else NO_BOX
+            for annotation_type, x in frames
+        ],
+        dtype=np.int32,
+    )
+    return types, boxes
+
+
+def hermite(p0, p1, m0, m1, span, t):
+    t2, t3 = t * t, t * t * t
+    return (
+        (2 * t3 - 3 * t2 + 1) * p0
+        + (t3 - 2 * t2 + t) * span * m0
+        + (-2 * t3 + 3 * t2) * p1
+        + (t3 - t2) * span * m1
+    )
+
+
+def test_linear_fills_the_gap_between_two_v_frames():
+    types, boxes = track(("V", 0), ("S", 0), ("S", 0), ("S", 0), ("V", 40))
+    frames, filled = interpolate_gaps(types, boxes, "linear")
+    assert frames.tolist() == [1, 2, 3]
+    assert filled.tolist() == [[10, 50, 10, 10], [20, 50, 10, 10], [30, 50, 10, 10]]
+
+
+def test_cubic_matches_linear_at_constant_speed():
+    types, boxes = track(("V", 0), ("V", 10), ("S", 0), ("S", 0), ("V", 40), ("V", 50))
+    assert interpolate_gaps(types, boxes, "cubic")[1].tolist() == (
+        interpolate_gaps(types, boxes, "linear")[1].tolist()
+    )
+
+
+def test_cubic_takes_catmull_rom_tangents_from_the_keyframes_around_the_gap():
+    # Keyframes 0, 2, 6 and 8 with the gap between 2 and 6, the speed changes on both sides of it
+    types, boxes = track(
+        ("V", 0),
+        ("S", 0),
+        ("V", 20),
+        ("S", 0),
+        ("S", 0),
+        ("S", 0),
+        ("V", 100),
+        ("S", 0),
+        ("V", 100),
+    )
+    frames, filled = interpolate_gaps(types, boxes, "cubic")
+    assert frames.tolist() == [1, 3, 4, 5, 7]
+    tangent_a = (100 - 0) / (6 - 0)
+    tangent_b = (100 - 20) / (8 - 2)
+    expected = [
+        round(hermite(20, 100, tangent_a, tangent_b, 4, t)) for t in (0.25, 0.5, 0.75)
+    ]
+    assert filled[1:4, 0].tolist() == expected
+
+
+def test_cubic_uses_the_secant_where_there_is_no_keyframe_outside_the_gap():
+    types, boxes = track(("V", 0), ("S", 0), ("S", 0), ("S", 0), ("V", 80))
+    frames, filled = interpolate_gaps(types, boxes, "cubic")
+    assert filled[:, 0].tolist() == [20, 40, 60]
+
+
+@pytest.mark.parametrize(
+    "annotation_types",
+    ["VSSI", "ISSV", "VSISV", "SSV", "VSS"],
+)
+def test_gaps_not_between_two_v_frames_are_left_alone(annotation_types):
+    types, boxes = track(
+        *((annotation_type, 10) for annotation_type in annotation_types)
+    )
+    for method in ("linear", "cubic"):
+        frames, filled = interpolate_gaps(types, boxes, method)
+        assert len(frames) == 0
+        assert filled.shape == (0, 4)
+
+
+def test_max_gap_leaves_longer_gaps_alone():
+    types, boxes = track(
+        ("V", 0), ("S", 0), ("S", 0), ("V", 30), ("S", 0), ("S", 0), ("S", 0), ("V", 70)
+    )
+    assert interpolate_gaps(types, boxes, "linear", max_gap=2)[0].tolist() == [1, 2]
+    assert interpolate_gaps(types, boxes, "linear", max_gap=3)[0].tolist() == [
+        1,
+        2,
+        4,
+        5,
+        6,
+    ]
+    assert interpolate_gaps(types, boxes, "linear", max_gap=0)[0].tolist() == [
+        1,
+        2,
+        4,
+        5,
+        6,
+    ]
+
+
+def test_unknown_method_is_rejected():
+    types, boxes = track(("V", 0), ("S", 0), ("V", 20))
+    with pytest.raises(ValueError):
+        interpolate_gaps(types, boxes, "spline")
+
+
+def test_interpolate_track_flags_the_filled_frames():
+    types, boxes = track(("V", 0), ("S", 0), ("V", 20), ("I", 0), ("S", 0), ("V", 50))
+    store, filled = interpolate_track(AnnotationStore(types, boxes, scale=1.0))
+    assert filled == 1
+    assert bytes(store.types).decode() == "VVVISV"
+    assert store.flags.tolist() == [0, FLAG_INTERPOLATED, 0, 0, 0, 0]
+    assert store.scale == 1.0
+
+
+def test_text_files_get_a_flags_column(tmp_path):
+    path = tmp_path / "clip.annotations"
+    types, boxes = track(("V", 0), ("S", 0), ("S", 0), ("V", 30))
+    AnnotationStore(types, boxes, scale=1.0).to_text(str(path))
+    assert interpolate_file(str(path)) == 2
+
+    lines = path.read_text().splitlines()
+    assert lines[0] == "# tracks: 1 flags scale: 1"
+    assert lines[1:] == [
+        "V 0 50 10 10 0",
+        f"V 10 50 10 10 {FLAG_INTERPOLATED}",
+        f"V 20 50 10 10 {FLAG_INTERPOLATED}",
+        "V 30 50 10 10 0",
+    ]
+    store = AnnotationStore.load(str(path))
+    assert store.flags.tolist() == [0, FLAG_INTERPOLATED, FLAG_INTERPOLATED, 0]
+
+
+def test_gap_interpolator_holds_frames_until_the_gap_closes(tmp_path):
+    path = tmp_path / "session.annotations"
+    annotator = Annotator(str(path), flush_every=1, flush_interval=0, with_flags=True)
+    writer = GapInterpolator(annotator, "linear")
+    writer.write_bounding_box(0, 50, 10, 10)
+    writer.write_skipped()
+    writer.write_skipped()
+    # Still open, nothing past the first frame may be on disk yet
+    assert len(AnnotationStore.load(str(path))) == 1
+    writer.write_bounding_box(30, 50, 10, 10)
+    writer.write_invisible()
+    writer.write_skipped()
+    writer.close()
+
+    store = AnnotationStore.load(str(path))
+    assert bytes(store.types).decode() == "VVVVIS"
+    assert store.boxes[1:3, 0].tolist() == [10, 20]
+    assert store.flags.tolist() == [0, FLAG_INTERPOLATED, FLAG_INTERPOLATED, 0, 0, 0]
+
+
+def test_gap_interpolator_writes_an_unclosed_gap_as_skipped(tmp_path):
+    path = tmp_path / "session.annotations"
+    writer = GapInterpolator(
+        Annotator(str(path), flush_interval=0, with_flags=True), "cubic"
+    )
+    writer.write_bounding_box(0, 50, 10, 10)
+    writer.write_skipped()
+    writer.write_skipped()
+    writer.close()
+    store = AnnotationStore.load(str(path))
+    assert bytes(store.types).decode() == "VSS"
+    assert not store.flags.any()
+
+
+def crash(writer):
+    """
+    Leaves a crash safe session the way a crash would, its file and journal as they are
+    """
+    atexit.unregister(writer.close)
+    atexit.unregister(writer.annotator.close)
+    writer.annotator.closed.set()
+    writer.annotator.file.close()
+    writer.annotator.journal.close()
+
+
+def test_gap_interpolator_journals_an_open_gap_in_crash_safe_mode(tmp_path):
+    path = tmp_path / "session.annotations"
+    writer = GapInterpolator(
+        Annotator(str(path), flush_interval=3600, crash_safe=True, with_flags=True),
+        "linear",
+    )
+    writer.write_bounding_box(0, 50, 10, 10)
+    writer.write_skipped()
+    writer.write_skipped()
+    crash(writer)
+    # The open gap comes back from the journal as it was
+    assert Annotator.recover_journal(str(path)) == 3
+    assert bytes(AnnotationStore.load(str(path)).types).decode() == "VSS"
+
+
+def test_gap_interpolator_replaces_the_journaled_gap_once_it_closes(tmp_path):
+    path = tmp_path / "session.annotations"
+    writer = GapInterpolator(
+        Annotator(str(path), flush_interval=3600, crash_safe=True, with_flags=True),
+        "linear",
+    )
+    writer.write_bounding_box(0, 50, 10, 10)
+    writer.write_skipped()
+    writer.write_bounding_box(20, 50, 10, 10)
+    writer.write_skipped()
+    crash(writer)
+    assert Annotator.recover_journal(str(path)) == 4
+    store = AnnotationStore.load(str(path))
+    assert bytes(store.types).decode() == "VVVS"
+    assert store.flags.tolist() == [0, FLAG_INTERPOLATED, 0, 0]
+
+
+def test_gap_interpolator_continues_from_a_resumed_file(tmp_path):
+    path = tmp_path / "session.annotations"
+    writer = GapInterpolator(
+        Annotator(str(path), flush_interval=0, with_flags=True, scale=0.5), "linear"
+    )
+    writer.write_bounding_box(0, 50, 10, 10)
+    writer.write_bounding_box(10, 50, 10, 10)
+    writer.close()
+
+    # A gap right after the resume point is filled from the file's last frame
+    resumed = GapInterpolator(
+        Annotator(str(path), flush_interval=0, append=True, scale=0.5), "linear"
+    )
+    assert resumed.existing_records == 2
+    resumed.write_skipped()
+    resumed.write_bounding_box(40, 50, 10, 10)
+    resumed.close()
+    store = AnnotationStore.load(str(path))
+    assert bytes(store.types).decode() == "VVVV"
+    # Stored in the video's pixels, twice the window's
+    assert store.boxes[2].tolist() == [50, 100, 20, 20]
+    assert store.flags.tolist() == [0, 0, FLAG_INTERPOLATED, 0]
@@ -0,0 +1,245 @@
+"""
+Vectorized agreement between two annotation files of the same video, e.g. from two annotators or from a human and
+the tracker
+
+Both tracks are lined up frame by frame, so every measure works on the paired type and box arrays at once:
+- iou          : the IoU of the two boxes on every frame both files have as V
+- confusion    : how often each V/I/S state of one file meets each state of the other, a single bincount
+- disagreement : frames where the states differ, or both are V with an IoU below min_iou. Consecutive ones form a
+                 run, scored by the sum of its frames' severity (1 for differing states, 1 - IoU for V boxes)
+
+Files are compared track by track over the frames both have. The worst runs are the frames to look at first,
+Validate_Annotation.py --compare starts on them
+"""
+
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+import numpy as np
+from numpy import ndarray
+
+from utils.Paths import (
+    annotation_stem,
+    find_annotation_files,
+    find_video,
+    video_stem,
+)
+from utils.AnnotationStore import INVISIBLE, SKIPPED, VISIBLE, AnnotationStore
+from utils.utils import box_iou, video_window_scale
+
+STATES: str = "VIS"
+# Type code to row (or column) of the confusion matrix
+STATE_INDEX: ndarray = np.zeros(256, dtype=np.intp)
+STATE_INDEX[[VISIBLE, INVISIBLE, SKIPPED]] = [0, 1, 2]
+# Worst runs reported per file pair, agreement and run counts still take every run into account
+MAX_WORST: int = 10
+
+
+@dataclass(frozen=True)
+class DiffThresholds:
+    min_iou: float = 0.5
+    min_agreement: float = 0.95
+
+
+@dataclass
+class TrackDiff:
+    """
+    ious      : the IoU on frames both tracks have as V, NaN elsewhere
+    severity  : 0 where the tracks agree, 1 where their states differ and 1 - IoU where both boxes are too far apart
+    confusion : (3, 3) counts, rows are the first track's V/I/S and columns the second's
+    runs      : (runs, 2) first frame and length of every disagreement run
+    scores    : summed severity of every run
+    """
+
+    ious: ndarray
+    severity: ndarray
+    confusion: ndarray
+    runs: ndarray
+    scores: ndarray
+
+    @property
+    def disagreeing(self) -> int:
+        return int(np.count_nonzero(self.severity))
+
+    def worst(self, count: int = MAX_WORST) -> List[Tuple[int, int, float]]:
+        """
+        (frame, run length, run score) of the count highest scoring runs, worst first
+        The frame is the most severe one of its run
+        """
+        worst: List[Tuple[int, int, float]] = []
+        for run in np.argsort(-self.scores, kind="stable")[:count]:
+            start, length = (int(value) for value in self.runs[run])
+            frame = start + int(np.argmax(self.severity[start : start + length]))
+            worst.append((frame, length, float(self.scores[run])))
+        return worst
+
+
+def disagreement_runs(severity: ndarray) -> Tuple[ndarray, ndarray]:
+    """
+    First frame and length of every run of non zero severity, and the summed severity of each run
+    """
+    mask = np.concatenate(([False], severity > 0, [False]))
+    edges = np.flatnonzero(mask[1:] != mask[:-1])
+    starts, ends = edges[0::2], edges[1::2]
+    if len(starts) == 0:
+        return np.zeros((0, 2), dtype=np.int64), np.zeros(0)
+    # Everything between one run's end and the next run's start is 0, so summing from start to start is the run's sum
+    return np.stack([starts, ends - starts], axis=1), np.add.reduceat(severity, starts)
+
+
+def diff_tracks(
+    track_a: AnnotationStore, track_b: AnnotationStore, min_iou: float = 0.5
+) -> TrackDiff:
+    """
+    Compares two tracks at the same scale over the frames both have
+    """
+    frames = min(len(track_a), len(track_b))
+    types_a, types_b = track_a.types[:frames], track_b.types[:frames]
+    both_visible = (types_a == VISIBLE) & (types_b == VISIBLE)
+    ious = np.full(frames, np.nan)
+    ious[both_visible] = box_iou(
+        track_a.boxes[:frames][both_visible], track_b.boxes[:frames][both_visible]
+    )
+    severity = np.where(types_a != types_b, 1.0, 0.0)
+    far_apart = both_visible & (np.nan_to_num(ious, nan=1.0) < min_iou)
+    severity[far_apart] = 1.0 - ious[far_apart]
+    confusion = np.bincount(
+        STATE_INDEX[types_a] * 3 + STATE_INDEX[types_b], minlength=9
+    ).reshape(3, 3)
+    runs, scores = disagreement_runs(severity)
+    return TrackDiff(ious, severity, confusion, runs, scores)
+
+
+def align_scales(
+    tracks_a: List[AnnotationStore],
+    tracks_b: List[AnnotationStore],
+    window_scale: float = 0,
+    video_path: str = "",
+) -> Tuple[List[AnnotationStore], List[AnnotationStore]]:
+    """
+    Both files' tracks with their boxes at the same scale. Boxes in the video's pixels times a scale are compared at
+    the first file's scale. Files from before scales were stored (in window pixels) are compared at window_scale,
+    or at what the annotator would have used on this screen for the video when it is 0
+    """
+    scale_a, scale_b = tracks_a[0].scale, tracks_b[0].scale
+    if scale_a == scale_b:
+        return tracks_a, tracks_b
+    if scale_a > 0 and scale_b > 0:
+        return tracks_a, [track.at_scale(scale_a) for track in tracks_b]
+    if window_scale <= 0:
+        if not video_path:
+            raise ValueError(
+                "Only one file's boxes are in window pixels, a window scale or the video is needed to compare them"
+            )
+        window_scale = video_window_scale(video_path)
+    return (
+        [track.at_scale(window_scale) for track in tracks_a],
+        [track.at_scale(window_scale) for track in tracks_b],
+    )
+
+
+def diff_files(
+    path_a: str,
+    path_b: str,
+    thresholds: DiffThresholds = DiffThresholds(),
+    video_dirs: List[str] | None = None,
+    window_scale: float = 0,
+) -> Dict:
+    """
+    Compares every track the two files share, returns the agreement measures and the worst frames
+    """
+    result: Dict = {"path": path_a, "other": path_b}
+    try:
+        tracks_a = AnnotationStore.load_tracks(path_a)
+        tracks_b = AnnotationStore.load_tracks(path_b)
+        tracks_a, tracks_b = align_scales(
+            tracks_a,
+            tracks_b,
+            window_scale,
+            find_video(path_a, video_dirs or []) or find_video(path_b, []),
+        )
+    except (OSError, ValueError) as error:
+        result["error"] = str(error)
+        return result
+
+    confusion = np.zeros((3, 3), dtype=np.int64)
+    ious: List[ndarray] = []
+    disagreeing = runs = 0
+    worst: List[Tuple[int, int, int, float]] = []
+    for track, (track_a, track_b) in enumerate(zip(tracks_a, tracks_b)):
+        diff = diff_tracks(track_a, track_b, thresholds.min_iou)
+        confusion += diff.confusion
+        ious.append(diff.ious[~np.isnan(diff.ious)])
+        disagreeing += diff.disagreeing
+        runs += len(diff.runs)
+        worst.extend((track, *run) for run in diff.worst())
+    worst.sort(key=lambda run: -run[3])
+    all_ious = np.concatenate(ious)
+    frames = min(len(tracks_a[0]), len(tracks_b[0]))
+    compared = frames * min(len(tracks_a), len(tracks_b))
+    agreement = 1.0 - disagreeing / compared if compared else 1.0
+    result.update(
+        {
+            "frames": frames,
+            "frame_count_difference": len(tracks_a[0]) - len(tracks_b[0]),
+            "tracks": min(len(tracks_a), len(tracks_b)),
+            "track_count_difference": len(tracks_a) - len(tracks_b),
+            "agreement": agreement,
+            "mean_iou": float(all_ious.mean()) if len(all_ious) else None,
+            "disagreeing_frames": disagreeing,
+            "disagreement_runs": runs,
+            "confusion": {
+                state_a: {
+                    state_b: int(confusion[row, column])
+                    for column, state_b in enumerate(STATES)
+                }
+                for row, state_a in enumerate(STATES)
+            },
+            "worst": [
+                {"track": track, "frame": frame, "length": length, "score": score}
+                for track, frame, length, score in worst[:MAX_WORST]
+            ],
+            "passed": agreement >= thresholds.min_agreement
+            and len(tracks_a[0]) == len(tracks_b[0])
+            and len(tracks_a) == len(tracks_b),
+        }
+    )
+    return result
+
+
+def pair_annotation_files(
+    path_a: str, path_b: str
+) -> Tuple[List[Tuple[str, str]], List[str]]:
+    """
+    Two files are one pair. For two directories, every annotation file under the first is paired with the one at the
+    same relative directory and video name under the second, text or binary, by a human or tracked (so a batch's
+    <video-name>.tracked.annotations pair with the human files). A directory holding both for a video is compared on
+    the human one. Also returns the files without a partner
+    """
+    if os.path.isfile(path_a) and os.path.isfile(path_b):
+        return [(path_a, path_b)], []
+
+    unmatched: List[str] = []
+
+    def by_video(root: str) -> Dict[str, str]:
+        files: Dict[str, str] = {}
+        for path in find_annotation_files([root]):
+            key = os.path.join(
+                os.path.relpath(os.path.dirname(path), root), video_stem(path)
+            )
+            # A video with both a human and a tracked file is compared on the human one
+            if key in files and annotation_stem(path) != video_stem(path):
+                unmatched.append(path)
+                continue
+            if key in files:
+                unmatched.append(files[key])
+            files[key] = path
+        return files
+
+    files_a, files_b = by_video(path_a), by_video(path_b)
+    pairs = [(files_a[key], files_b[key]) for key in files_a if key in files_b]
+    unmatched += [files_a[key] for key in files_a if key not in files_b] + [
+        files_b[key] for key in files_b if key not in files_a
+    ]
+    return pairs, unmatched
@@ -0,0 +1,170 @@
+"""
+Vectorized quality checks for annotation files
+
+Each check compares a track's V frames with their neighbours through shifted slices of its type and box arrays:
+- out_of_frame : V boxes reaching outside the frame, or with no area
+- jump         : the center moving further between consecutive V frames than max_jump times the box's size
+- size         : the width or height changing by more than max_size_ratio between consecutive V frames
+- gap          : runs of at most max_gap S frames with V frames on both sides, usually a missed accept
+- frame_count  : the file not having a line per frame of the video
+
+Box and frame count checks need the video, found next to the annotation file (or in the given video directories)
+under the same name. Boxes are checked against the video's frame size times the file's scale, or for files from
+before scales were stored (in window pixels) times the scale the annotator would have used on this screen,
+unless a window scale is given
+"""
+
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+from utils.AnnotationStore import SKIPPED, VISIBLE, AnnotationStore
+from utils.Paths import find_video
+from utils.utils import video_window_scale
+
+CHECKS: Tuple[str, ...] = ("out_of_frame", "jump", "size", "gap", "frame_count")
+# Frame numbers listed per check and file as examples, the issue counts cover every frame
+MAX_EXAMPLES: int = 10
+
+
+@dataclass(frozen=True)
+class QAThresholds:
+    max_jump: float = 0.5
+    max_size_ratio: float = 1.5
+    max_gap: int = 1
+
+
+def check_track(
+    store: AnnotationStore,
+    frame_size: Tuple[int, int] | None,
+    thresholds: QAThresholds,
+) -> Dict[str, ndarray]:
+    """
+    Frame numbers failing each check for one track, frame_size is the (width, height) boxes must fit in
+    """
+    visible = store.visible
+    boxes = store.boxes.astype(np.int64)
+    center_x, center_y, width, height = boxes.T
+    issues: Dict[str, ndarray] = {}
+
+    # Same integer halving as the tools use to draw the box
+    no_area = (width <= 0) | (height <= 0)
+    if frame_size is not None:
+        frame_width, frame_height = frame_size
+        outside = (
+            (center_x - width // 2 < 0)
+            | (center_y - height // 2 < 0)
+            | (center_x + width // 2 > frame_width)
+            | (center_y + height // 2 > frame_height)
+        )
+        issues["out_of_frame"] = np.flatnonzero(visible & (no_area | outside))
+    else:
+        issues["out_of_frame"] = np.flatnonzero(visible & no_area)
+
+    # Consecutive V frames, compared with the frame before
+    pairs = visible[1:] & visible[:-1]
+    previous, current = boxes[:-1], boxes[1:]
+    box_size = np.sqrt(np.maximum(previous[:, 2] * previous[:, 3], 1))
+    jump = np.hypot(current[:, 0] - previous[:, 0], current[:, 1] - previous[:, 1])
+    issues["jump"] = np.flatnonzero(pairs & (jump > thresholds.max_jump * box_size)) + 1
+    log_ratio = np.abs(
+        np.log(np.maximum(current[:, 2:], 1) / np.maximum(previous[:, 2:], 1))
+    )
+    issues["size"] = (
+        np.flatnonzero(
+            pairs & (log_ratio > np.log(thresholds.max_size_ratio)).any(axis=1)
+        )
+        + 1
+    )
+
+    # Run length encoding of the types, a gap is a short S run between two V runs
+    types = store.types
+    if len(types) > 2:
+        starts = np.concatenate([[0], np.flatnonzero(types[1:] != types[:-1]) + 1])
+        lengths = np.diff(np.concatenate([starts, [len(types)]]))
+        run_types = types[starts]
+        inner = np.arange(1, len(starts) - 1)
+        gaps = inner[
+            (run_types[inner] == SKIPPED)
+            & (lengths[inner] <= thresholds.max_gap)
+            & (run_types[inner - 1] == VISIBLE)
+            & (run_types[inner + 1] == VISIBLE)
+        ]
+        issues["gap"] = starts[gaps]
+    else:
+        issues["gap"] = np.zeros(0, dtype=np.int64)
+    return issues
+
+
+def video_geometry(
+    video_path: str, window_scale: float = 0, scale: float = 0
+) -> Tuple[int, int, int]:
+    """
+    Width and height of the frames at the given scale, or as the annotator showed them when there is none,
+    and the video's frame count. Raises a ValueError when that needs the screen and there is none
+    """
+    cap = cv2.VideoCapture(video_path)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    if scale <= 0:
+        scale = window_scale if window_scale > 0 else video_window_scale(video_path)
+    return int(width * scale), int(height * scale), frame_count
+
+
+def check_file(
+    annotation_path: str,
+    video_dirs: List[str],
+    thresholds: QAThresholds,
+    window_scale: float = 0,
+) -> Dict:
+    """
+    Runs every check on every track of a file, returns its issue counts and the first few frames of each
+    """
+    result: Dict = {"path": annotation_path}
+    try:
+        stores = AnnotationStore.load_tracks(annotation_path)
+    except (OSError, ValueError) as error:
+        result["error"] = str(error)
+        return result
+    video_path = find_video(annotation_path, video_dirs)
+    frame_size: Tuple[int, int] | None = None
+    video_frames = -1
+    if video_path:
+        try:
+            frame_width, frame_height, video_frames = video_geometry(
+                video_path, window_scale, stores[0].scale
+            )
+        except ValueError as error:
+            # Boxes in window pixels with no screen to size the window, only this file can't be checked
+            result["error"] = f"{error}, pass --window-scale for files without a scale"
+            return result
+        frame_size = (frame_width, frame_height)
+
+    counts = {check: 0 for check in CHECKS}
+    examples: Dict[str, List[Tuple[int, int]]] = {check: [] for check in CHECKS}
+    for track, store in enumerate(stores):
+        for check, frames in check_track(store, frame_size, thresholds).items():
+            counts[check] += len(frames)
+            examples[check].extend(
+                (track, int(frame))
+                for frame in frames[: MAX_EXAMPLES - len(examples[check])]
+            )
+    if video_frames > 0 and len(stores[0]) != video_frames:
+        counts["frame_count"] = abs(len(stores[0]) - video_frames)
+
+    result.update(
+        {
+            "video": video_path,
+            "frames": len(stores[0]),
+            "video_frames": video_frames,
+            "tracks": len(stores),
+            "issues": counts,
+            "examples": {check: frames for check, frames in examples.items() if frames},
+        }
+    )
+    return result
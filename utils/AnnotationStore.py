@@ -0,0 +1,479 @@
+"""
+Columnar storage for annotation files
+
+Instead of one Annotation object per frame, an AnnotationStore keeps the annotation types and the
+four box values of every frame in NumPy arrays, so loading multi hour videos doesn't create millions
+of small python objects
+
+Besides the V/I/S text format, the store can be written to a compact fixed width binary format:
+a 32 byte header followed by one 18 byte record per frame. The binary file can be memory mapped,
+so opening it costs nothing no matter how long the video is
+
+Files can hold several tracks (objects). A text file then starts with a "# tracks: N" line and every frame's
+line holds N records in a row, a binary file stores the track count in its header and N records per frame.
+Each track loads as its own AnnotationStore
+
+Records have flags (e.g. interpolated rather than labelled), in the binary record's flags byte. Text files only
+carry them when their header has " flags", every record then has its flags as a sixth value
+
+Boxes are stored in the video's own pixels times the file's scale (1 for everything the tools write now), so files
+don't depend on the screen they were made on. The scale is in the binary header, marked valid by a header flag,
+and in the text header as " scale: S". Files without one are from before, their boxes are in the pixels of the
+window they were annotated in and are used as they are
+"""
+
+import argparse
+import os
+import struct
+import warnings
+from typing import List, Tuple
+
+import numpy as np
+from numpy import ndarray
+
+from utils.utils import Annotation, scale_boxes
+
+BINARY_MAGIC: bytes = b"VATB"
+BINARY_VERSION: int = 1
+# magic, version, header flags, scale, track count, reserved
+# Files from before multi object tracking have a zero track count, which means a single track
+BINARY_HEADER = struct.Struct("<4sHHdH14x")
+# Bit of the header flags marking the scale as the one the boxes are stored at, relative to the video's pixels
+HEADER_SCALED: int = 1
+# annotation type, record flags, center x, center y, width, height
+BINARY_RECORD = struct.Struct("<BBiiii")
+RECORD_DTYPE = np.dtype(
+    [
+        ("type", "u1"),
+        ("flags", "u1"),
+        ("center_x", "<i4"),
+        ("center_y", "<i4"),
+        ("width", "<i4"),
+        ("height", "<i4"),
+    ]
+)
+
+# First line of a text file with more than one track, every line after it holds each track's record in turn
+TRACKS_HEADER: str = "# tracks: "
+
+# Annotation types are stored as their ASCII code, so a hexdump of a binary file is still readable
+VISIBLE: int = ord("V")
+INVISIBLE: int = ord("I")
+SKIPPED: int = ord("S")
+# Type letters as single digits while parsing text, and back to their codes
+TYPE_DIGITS: bytes = bytes.maketrans(b"SIV", b"012")
+TYPE_CODES: ndarray = np.array([SKIPPED, INVISIBLE, VISIBLE], dtype=np.uint8)
+# Put at the end of every line of a text file while parsing it, no box value is ever this small
+LINE_END: int = int(np.iinfo(np.int32).min)
+# Bits of a record's flags, kept in the binary record's flags byte and in the flags column of text files that have one
+FLAG_INTERPOLATED: int = 1
+# In the header of a text file whose records carry their flags as a sixth value
+FLAGS_HEADER_SUFFIX: str = " flags"
+# In the header of a text file whose boxes are the video's pixels times the scale that follows it
+SCALE_HEADER: str = " scale: "
+
+
+def is_binary_annotation_file(annotation_path: str) -> bool:
+    with open(annotation_path, "rb") as file:
+        return file.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def encode_binary_header(
+    scale: float = 0.0, flags: int = 0, track_count: int = 1
+) -> bytes:
+    """
+    A scale of 0 leaves the boxes in window pixels, like files from before scales were stored
+    """
+    if scale > 0:
+        flags |= HEADER_SCALED
+    return BINARY_HEADER.pack(
+        BINARY_MAGIC, BINARY_VERSION, flags, max(scale, 0.0), track_count
+    )
+
+
+def read_binary_header(annotation_path: str) -> Tuple[float, int]:
+    """
+    Validates a binary annotation file's header, returns its scale (0 when the boxes are in window pixels)
+    and track count
+    """
+    with open(annotation_path, "rb") as file:
+        magic, version, flags, scale, track_count = BINARY_HEADER.unpack(
+            file.read(BINARY_HEADER.size)
+        )
+    if magic != BINARY_MAGIC:
+        raise ValueError(f"{annotation_path} is not a binary annotation file")
+    if version != BINARY_VERSION:
+        raise ValueError(
+            f"{annotation_path} has unsupported binary annotation version {version}"
+        )
+    return (scale if flags & HEADER_SCALED else 0.0), max(1, track_count)
+
+
+def encode_tracks_header(
+    track_count: int, flags: bool = False, scale: float = 0.0
+) -> str:
+    return (
+        f"{TRACKS_HEADER}{track_count}{FLAGS_HEADER_SUFFIX if flags else ''}"
+        f"{f'{SCALE_HEADER}{scale:g}' if scale > 0 else ''}\n"
+    )
+
+
+def parse_text_header(header: str) -> Tuple[int, bool, float]:
+    """
+    Track count, whether records carry their flags and the scale of the boxes (0 when they are in window pixels),
+    from the first line of a text file that has a header
+    """
+    if not header.startswith(TRACKS_HEADER):
+        raise ValueError(f"Unknown annotation file header {header!r}")
+    header, _, scale = header.rstrip().partition(SCALE_HEADER)
+    flags = header.endswith(FLAGS_HEADER_SUFFIX)
+    return (
+        max(1, int(header[len(TRACKS_HEADER) :].removesuffix(FLAGS_HEADER_SUFFIX))),
+        flags,
+        float(scale) if scale else 0.0,
+    )
+
+
+def parse_tracks_header(header: str) -> int:
+    """
+    Track count from the first line of a text file that has a header
+    """
+    return parse_text_header(header)[0]
+
+
+def text_line_error(
+    data: bytes, line: int, annotation_path: str, first_line: int, problem: str = ""
+) -> ValueError:
+    """
+    The error for the line-th line of the records of a text file, naming its first value that isn't one, or problem
+    """
+    if not problem:
+        problem = "unreadable line"
+        for value in data.split(b"\n")[line].split():
+            try:
+                int(value.translate(TYPE_DIGITS))
+            except ValueError:
+                problem = f"{value.decode('ascii', 'replace')!r} is not a value"
+                break
+    return ValueError(f"{annotation_path} line {first_line + line}: {problem}")
+
+
+def encode_binary_record(
+    annotation_type: str,
+    center_x: int,
+    center_y: int,
+    width: int,
+    height: int,
+    flags: int = 0,
+) -> bytes:
+    return BINARY_RECORD.pack(
+        ord(annotation_type), flags, center_x, center_y, width, height
+    )
+
+
+class AnnotationStore:
+    """
+    Holds every frame's annotation as columns
+    types : uint8 array of annotation type codes (ord("V"), ord("I"), ord("S"))
+    boxes : int32 array of shape (frames, 4) holding center x, center y, width and height
+    flags : uint8 array of per record flags
+    scale : the boxes are the video's pixels times scale, 0 when they are in the pixels of the annotation window
+    """
+
+    def __init__(
+        self,
+        types: ndarray,
+        boxes: ndarray,
+        flags: ndarray | None = None,
+        scale: float = 0.0,
+    ):
+        self.types: ndarray = types
+        self.boxes: ndarray = boxes
+        self.flags: ndarray = (
+            flags if flags is not None else np.zeros(len(types), dtype=np.uint8)
+        )
+        self.scale: float = scale
+
+    def __len__(self) -> int:
+        return len(self.types)
+
+    def __getitem__(self, frame_number: int) -> Annotation:
+        center_x, center_y, width, height = (int(i) for i in self.boxes[frame_number])
+        return Annotation(
+            chr(self.types[frame_number]), center_x, center_y, width, height
+        )
+
+    @property
+    def visible(self) -> ndarray:
+        return self.types == VISIBLE
+
+    def at_scale(self, scale: float) -> "AnnotationStore":
+        """
+        The track with its boxes at the given scale of the video, e.g. a window's, in one array operation
+        Boxes already in window pixels are assumed to be at that window's scale and kept as they are
+        """
+        if self.scale <= 0 or scale == self.scale:
+            return self
+        return AnnotationStore(
+            self.types,
+            scale_boxes(self.boxes, scale / self.scale, self.visible),
+            self.flags,
+            scale,
+        )
+
+    @classmethod
+    def from_annotations(cls, annotations: List[Annotation]) -> "AnnotationStore":
+        types = np.array(
+            [ord(annotation.annotation_type) for annotation in annotations],
+            dtype=np.uint8,
+        )
+        boxes = np.array(
+            [(a.center_x, a.center_y, a.width, a.height) for a in annotations],
+            dtype=np.int32,
+        ).reshape(-1, 4)
+        return cls(types, boxes)
+
+    @classmethod
+    def from_text(cls, annotation_path: str) -> "AnnotationStore":
+        """
+        The first (for single object files, the only) track of a text file
+        """
+        return cls.tracks_from_text(annotation_path)[0]
+
+    @classmethod
+    def tracks_from_text(cls, annotation_path: str) -> List["AnnotationStore"]:
+        """
+        Parses a V/I/S text file without a python level loop over the lines,
+        the type letters get swapped for digits byte by byte and numpy parses the whole file in one go
+        Returns one store per track, a line that isn't a full set of records raises a ValueError naming it
+        """
+        with open(annotation_path, "rb") as file:
+            data = file.read()
+        track_count, with_flags, scale = 1, False, 0.0
+        first_line = 1
+        if data.startswith(b"#"):
+            header, _, data = data.partition(b"\n")
+            track_count, with_flags, scale = parse_text_header(header.decode("ascii"))
+            first_line = 2
+        columns = 6 if with_flags else 5
+        with warnings.catch_warnings(record=True) as stopped:
+            # numpy only warns when it stops at something that isn't an integer, that is reported below with its line
+            warnings.simplefilter("always", DeprecationWarning)
+            values = np.fromstring(
+                data.translate(TYPE_DIGITS).replace(b"\n", b" %d\n" % LINE_END)
+                + b" %d" % LINE_END,
+                dtype=np.int32,
+                sep=" ",
+            )
+        line_ends = np.flatnonzero(values == LINE_END)
+        if stopped:
+            raise text_line_error(data, len(line_ends), annotation_path, first_line)
+        # Every line has to be a full set of records, empty ones aside
+        counts = np.diff(line_ends, prepend=-1) - 1
+        per_line = columns * track_count
+        wrong = np.flatnonzero((counts != 0) & (counts != per_line))
+        if len(wrong):
+            raise text_line_error(
+                data,
+                wrong[0],
+                annotation_path,
+                first_line,
+                f"expected {per_line} values, found {counts[wrong[0]]}",
+            )
+        values = values[values != LINE_END].reshape(-1, per_line)
+        wrong = np.flatnonzero(
+            (values[:, ::columns] > 2).any(axis=1)
+            | (values[:, ::columns] < 0).any(axis=1)
+        )
+        if len(wrong):
+            line = np.flatnonzero(counts)[wrong[0]]
+            raise text_line_error(
+                data,
+                line,
+                annotation_path,
+                first_line,
+                "every record has to start with V, I or S",
+            )
+        return [
+            cls(
+                TYPE_CODES[values[:, columns * track]],
+                np.ascontiguousarray(
+                    values[:, columns * track + 1 : columns * track + 5]
+                ),
+                (
+                    values[:, columns * track + 5].astype(np.uint8)
+                    if with_flags
+                    else None
+                ),
+                scale,
+            )
+            for track in range(track_count)
+        ]
+
+    @classmethod
+    def from_binary(cls, annotation_path: str, mmap: bool = True) -> "AnnotationStore":
+        """
+        The first (for single object files, the only) track of a binary file
+        """
+        return cls.tracks_from_binary(annotation_path, mmap)[0]
+
+    @classmethod
+    def tracks_from_binary(
+        cls, annotation_path: str, mmap: bool = True
+    ) -> List["AnnotationStore"]:
+        """
+        Opens a binary annotation file, by default the records are memory mapped rather than read
+        Returns one store per track, each a strided view into the same records
+        """
+        scale, track_count = read_binary_header(annotation_path)
+        frame_count = (os.path.getsize(annotation_path) - BINARY_HEADER.size) // (
+            RECORD_DTYPE.itemsize * track_count
+        )
+        if frame_count == 0:
+            return [
+                cls(
+                    np.zeros(0, dtype=np.uint8),
+                    np.zeros((0, 4), dtype=np.int32),
+                    scale=scale,
+                )
+                for _ in range(track_count)
+            ]
+        if mmap:
+            records = np.memmap(
+                annotation_path,
+                dtype=RECORD_DTYPE,
+                mode="r",
+                offset=BINARY_HEADER.size,
+                shape=(frame_count * track_count,),
+            )
+        else:
+            records = np.fromfile(
+                annotation_path,
+                dtype=RECORD_DTYPE,
+                count=frame_count * track_count,
+                offset=BINARY_HEADER.size,
+            )
+        stores: List[AnnotationStore] = []
+        for track in range(track_count):
+            # The four box fields sit next to each other in every record, so they can be viewed
+            # as one (frames, 4) array straight out of the mapping without copying anything
+            boxes = np.ndarray(
+                shape=(frame_count, 4),
+                dtype="<i4",
+                buffer=records,
+                offset=track * RECORD_DTYPE.itemsize
+                + RECORD_DTYPE.fields["center_x"][1],
+                strides=(track_count * RECORD_DTYPE.itemsize, 4),
+            )
+            track_records = records[track::track_count]
+            stores.append(
+                cls(track_records["type"], boxes, track_records["flags"], scale)
+            )
+        return stores
+
+    @classmethod
+    def load(cls, annotation_path: str) -> "AnnotationStore":
+        """
+        The first (for single object files, the only) track of an annotation file in either format
+        """
+        return cls.load_tracks(annotation_path)[0]
+
+    @classmethod
+    def load_tracks(cls, annotation_path: str) -> List["AnnotationStore"]:
+        """
+        Loads every track of an annotation file in either format
+        For a text file, a binary sidecar (<annotation_path>.bin) that is at least as new is preferred
+        """
+        if is_binary_annotation_file(annotation_path):
+            return cls.tracks_from_binary(annotation_path)
+        sidecar_path = annotation_path + ".bin"
+        if os.path.exists(sidecar_path) and os.path.getmtime(
+            sidecar_path
+        ) >= os.path.getmtime(annotation_path):
+            return cls.tracks_from_binary(sidecar_path)
+        return cls.tracks_from_text(annotation_path)
+
+    def to_text(self, annotation_path: str, with_flags: bool | None = None) -> None:
+        self.tracks_to_text([self], annotation_path, with_flags)
+
+    def to_binary(self, annotation_path: str) -> None:
+        self.tracks_to_binary([self], annotation_path)
+
+    @staticmethod
+    def tracks_to_text(
+        stores: List["AnnotationStore"],
+        annotation_path: str,
+        with_flags: bool | None = None,
+    ) -> None:
+        """
+        Writes one line per frame holding every track's record, files with more than one track get a header
+        Records get their flags as a sixth value (and the file a header saying so) when with_flags is set,
+        by default only when some record has a flag
+        """
+        if with_flags is None:
+            with_flags = any(bool(store.flags.any()) for store in stores)
+        annotation_types: List[str] = [
+            np.ascontiguousarray(store.types).tobytes().decode("ascii")
+            for store in stores
+        ]
+        boxes = [
+            (
+                np.column_stack([store.boxes, store.flags])
+                if with_flags
+                else store.boxes
+            ).tolist()
+            for store in stores
+        ]
+        scale = stores[0].scale
+        with open(annotation_path, "w") as file:
+            if len(stores) > 1 or with_flags or scale > 0:
+                file.write(encode_tracks_header(len(stores), with_flags, scale))
+            file.writelines(
+                " ".join(
+                    f"{annotation_type} " + " ".join(str(value) for value in values)
+                    for annotation_type, values in zip(frame_types, frame_boxes)
+                )
+                + "\n"
+                for frame_types, frame_boxes in zip(zip(*annotation_types), zip(*boxes))
+            )
+
+    @staticmethod
+    def tracks_to_binary(stores: List["AnnotationStore"], annotation_path: str) -> None:
+        """
+        Writes every track's record of a frame back to back, frame after frame
+        """
+        track_count = len(stores)
+        records = np.empty(len(stores[0]) * track_count, dtype=RECORD_DTYPE)
+        for track, store in enumerate(stores):
+            track_records = records[track::track_count]
+            track_records["type"] = store.types
+            track_records["flags"] = store.flags
+            track_records["center_x"] = store.boxes[:, 0]
+            track_records["center_y"] = store.boxes[:, 1]
+            track_records["width"] = store.boxes[:, 2]
+            track_records["height"] = store.boxes[:, 3]
+        with open(annotation_path, "wb") as file:
+            file.write(encode_binary_header(stores[0].scale, track_count=track_count))
+            records.tofile(file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Converts annotation files between the text and binary formats"
+    )
+    parser.add_argument("input_file", type=str, help="Annotation file to convert")
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="",
+        help="Converted file, defaults to <input>.bin for text input and the input without .bin for binary input",
+    )
+    args = parser.parse_args()
+    stores = AnnotationStore.load_tracks(args.input_file)
+    if is_binary_annotation_file(args.input_file):
+        output = args.output or args.input_file.removesuffix(".bin")
+        AnnotationStore.tracks_to_text(stores, output)
+    else:
+        output = args.output or args.input_file + ".bin"
+        AnnotationStore.tracks_to_binary(stores, output)
+    print(f"Wrote {len(stores[0])} frames of {len(stores)} track(s) to {output}")
@@ -1,32 +1,412 @@
+import atexit
 import os
-from typing import List
+import threading
+import time
+from typing import BinaryIO, List, Tuple
+
+import numpy as np
+
+from utils.AnnotationStore import (
+    BINARY_HEADER,
+    BINARY_RECORD,
+    AnnotationStore,
+    encode_binary_header,
+    encode_binary_record,
+    encode_tracks_header,
+    is_binary_annotation_file,
+    parse_text_header,
+    read_binary_header,
+)
+from utils.utils import scale_boxes
 
 """
 Annotator class that is responsible for the I/O with the annotation file
+
+Records are buffered in memory and written through a single open handle, either once
+flush_every records have piled up or flush_interval seconds have passed, and always on close
+
+In crash safe mode every record is also appended to a journal file next to the annotations,
+which is fsync'd every sync_every records, so a crash never loses more than that many frames
+
+Annotations are written either in the V/I/S text format or in the binary format of AnnotationStore
+
+In append mode an existing annotation file is continued instead of wiped, after recovering its journal
+and dropping a torn last record, in whichever format the file already has
+
+With more than one track, every frame is written as one record per track with write_frame
+
+With with_flags, text records carry their flags as a sixth value (binary records always have them), so interpolated
+frames can be told apart. Filling gaps as they close is up to utils.Interpolation.GapInterpolator in front of this.
+It holds a gap's frames back until the gap closes, in crash safe mode they are journaled with hold_frame meanwhile
+(as they were, S) and replaced in the journal by the filled frames once they are written
+
+With scale set to the scale of the video the boxes are handed over at (the window's), they are stored in the video's
+own pixels and new files record a scale of 1. Files from before scales were stored keep getting window pixels
 """
 
+# annotation type, center x, center y, width, height and optionally the record's flags
+Record = Tuple[str, int, int, int, int] | Tuple[str, int, int, int, int, int]
+
 
 class Annotator:
-    def __init__(self, output_path):
+    def __init__(
+        self,
+        output_path,
+        flush_every: int = 64,
+        flush_interval: float = 5.0,
+        crash_safe: bool = False,
+        sync_every: int = 1,
+        binary: bool = False,
+        append: bool = False,
+        tracks: int = 1,
+        with_flags: bool = False,
+        scale: float = 0.0,
+    ):
         self.output_file: str = output_path
-        self.create_annotation_file(self.output_file)
+        # Scale of the boxes handed over and the one the file stores, boxes are converted between them when both are known
+        self.scale: float = scale
+        self.file_scale: float = 1.0 if scale > 0 else 0.0
+        self.binary: bool = binary
+        self.tracks: int = max(1, tracks)
+        self.text_flags: bool = with_flags
+        self.journal_file: str = output_path + ".journal"
+        self.flush_every: int = max(1, flush_every)
+        self.flush_interval: float = flush_interval
+        self.crash_safe: bool = crash_safe
+        self.sync_every: int = max(1, sync_every)
+        self.buffer: List[bytes] = []
+        # Held frames journaled by hold_frame, and where in the journal they start
+        self.held: List[bytes] = []
+        self.held_offset: int = 0
+        self.unsynced: int = 0
+        self.last_flush: float = time.monotonic()
+        self.file: BinaryIO | None = None
+        self.journal: BinaryIO | None = None
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        # Number of frames already in the file when appending
+        self.existing_records: int = 0
+        if append and os.path.exists(self.output_file):
+            self.append_annotation_file(self.output_file)
+        else:
+            self.create_annotation_file(self.output_file)
+
+        # Make sure that whatever is still buffered makes it to disk, even if the user never quits
+        atexit.register(self.close)
+        if self.flush_interval > 0:
+            threading.Thread(target=self.__flush_loop, daemon=True).start()
 
     def create_annotation_file(self, output_file) -> None:
-        open(output_file, "w")
+        if os.path.exists(self.journal_file):
+            # Frames of a crashed crash safe session that never made it into the file, wiping it would lose them
+            raise ValueError(
+                f"{self.journal_file} holds frames of a session that didn't finish, "
+                "continue it with --resume (which recovers them) or move the journal away"
+            )
+        self.file = open(output_file, "wb")
+        if self.binary:
+            self.file.write(
+                encode_binary_header(self.file_scale, track_count=self.tracks)
+            )
+        elif self.tracks > 1 or self.text_flags or self.file_scale > 0:
+            self.file.write(
+                encode_tracks_header(
+                    self.tracks, self.text_flags, self.file_scale
+                ).encode("ascii")
+            )
+        if self.crash_safe:
+            self.journal = open(self.journal_file, "wb")
+            self.__start_journal()
+
+    def append_annotation_file(self, output_file) -> None:
+        """
+        Reopens an existing annotation file for writing at its end
+        """
+        self.recover_journal(output_file)
+        self.binary = is_binary_annotation_file(output_file)
+        self.file = open(output_file, "r+b")
+        size = self.file.seek(0, os.SEEK_END)
+        if self.binary:
+            if size < BINARY_HEADER.size:
+                # Crashed before the header made it out, start the file over
+                self.file.truncate(0)
+                self.file.seek(0)
+                self.file.write(
+                    encode_binary_header(self.file_scale, track_count=self.tracks)
+                )
+                size = self.file.tell()
+            else:
+                self.file_scale, file_tracks = read_binary_header(output_file)
+                self.__check_tracks(file_tracks)
+            frame_bytes = BINARY_RECORD.size * self.tracks
+            self.existing_records = (size - BINARY_HEADER.size) // frame_bytes
+            complete = BINARY_HEADER.size + self.existing_records * frame_bytes
+        else:
+            self.file.seek(0)
+            text = self.file.read()
+            complete = text.rfind(b"\n") + 1
+            self.existing_records = text.count(b"\n", 0, complete)
+            file_flags = False
+            if text.startswith(b"#"):
+                file_tracks, file_flags, self.file_scale = parse_text_header(
+                    text[: text.find(b"\n")].decode("ascii")
+                )
+                self.__check_tracks(file_tracks)
+                self.existing_records -= 1
+            else:
+                # Single track file from before headers, its boxes are in window pixels
+                self.file_scale = 0.0
+                self.__check_tracks(1)
+        # A record that was only partially written when the previous session died is dropped
+        self.file.truncate(complete)
+        self.file.seek(complete)
+        if not self.binary:
+            if self.text_flags and not file_flags:
+                # Interpolated records need the flags column, the existing records get one first
+                self.file.close()
+                AnnotationStore.tracks_to_text(
+                    AnnotationStore.tracks_from_text(output_file),
+                    output_file,
+                    with_flags=True,
+                )
+                self.file = open(output_file, "r+b")
+                self.file.seek(0, os.SEEK_END)
+            self.text_flags = self.text_flags or file_flags
+        if self.crash_safe:
+            self.journal = open(self.journal_file, "wb")
+            self.__start_journal()
+
+    def __check_tracks(self, file_tracks: int) -> None:
+        if file_tracks != self.tracks:
+            raise ValueError(
+                f"{self.output_file} has {file_tracks} track(s), but {self.tracks} were asked for"
+            )
 
     def write_bounding_box(
         self, x_center: int, y_center: int, width: int, height: int
     ) -> None:
-        txt_str: str = f"V {x_center} {y_center} {width} {height}\n"
-        with open(self.output_file, "a") as file:
-            file.write(txt_str)
+        self.write_record("V", x_center, y_center, width, height)
 
     def write_skipped(self) -> None:
-        txt_str: str = f"S -1 -1 -1 -1\n"
-        with open(self.output_file, "a") as file:
-            file.write(txt_str)
+        self.write_record("S", -1, -1, -1, -1)
 
     def write_invisible(self) -> None:
-        txt_str: str = f"I -1 -1 -1 -1\n"
-        with open(self.output_file, "a") as file:
-            file.write(txt_str)
+        self.write_record("I", -1, -1, -1, -1)
+
+    def write_record(
+        self,
+        annotation_type: str,
+        x_center: int,
+        y_center: int,
+        width: int,
+        height: int,
+    ) -> None:
+        """
+        Buffers a single annotation, journaling it first when in crash safe mode
+        """
+        self.write_frame([(annotation_type, x_center, y_center, width, height)])
+
+    def write_frame(self, records: List[Record]) -> None:
+        """
+        Buffers one frame's annotations, a (type, center x, center y, width, height[, flags]) record per track
+        """
+        self.write_frames([records])
+
+    def write_frames(self, frames: List[List[Record]]) -> None:
+        """
+        Buffers consecutive frames, replacing whatever hold_frame journaled, e.g. a gap's frames once it is filled
+        """
+        frames = [self.__file_records(records) for records in frames]
+        with self.lock:
+            replaced = self.__drop_held()
+            for records in frames:
+                self.__write_locked(records)
+            if replaced and self.journal is not None and self.unsynced:
+                # The held frames are gone from the journal, what replaced them can't wait on sync_every
+                self.__sync(self.journal)
+                self.unsynced = 0
+
+    def hold_frame(self, records: List[Record]) -> None:
+        """
+        Journals a frame that is held back from the file, so a crash safe session that dies recovers it as it is
+        The next write_frame(s) replaces every held frame. Nothing to do without a journal
+        """
+        records = self.__file_records(records)
+        with self.lock:
+            if self.journal is None:
+                return
+            if not self.held:
+                self.held_offset = self.journal.tell()
+            record = self.__encode(records)
+            self.held.append(record)
+            self.__journal(record)
+
+    def __file_records(self, records: List[Record]) -> List[Record]:
+        """
+        A frame's records with their flags, and their boxes at the file's scale
+        """
+        if len(records) != self.tracks:
+            raise ValueError(
+                f"Expected {self.tracks} record(s) per frame, got {len(records)}"
+            )
+        records = [
+            tuple(track_record) if len(track_record) == 6 else (*track_record, 0)
+            for track_record in records
+        ]
+        if self.scale > 0 and self.file_scale > 0 and self.scale != self.file_scale:
+            boxes = scale_boxes(
+                [track_record[1:5] for track_record in records],
+                self.file_scale / self.scale,
+                np.array([track_record[0] == "V" for track_record in records]),
+            ).tolist()
+            records = [
+                (track_record[0], *box, track_record[5])
+                for track_record, box in zip(records, boxes)
+            ]
+        return records
+
+    def __encode(self, records: List[Record]) -> bytes:
+        if self.binary:
+            return b"".join(
+                encode_binary_record(*track_record) for track_record in records
+            )
+        # Flags are the sixth value of a record, only written when the file has the column
+        values = 6 if self.text_flags else 5
+        return (
+            " ".join(
+                " ".join(str(value) for value in track_record[:values])
+                for track_record in records
+            )
+            + "\n"
+        ).encode("ascii")
+
+    def __write_locked(self, records: List[Record]) -> None:
+        """
+        Journals and buffers one frame, the lock has to be held
+        """
+        record = self.__encode(records)
+        if self.journal is not None:
+            self.__journal(record)
+        self.buffer.append(record)
+        if (
+            len(self.buffer) >= self.flush_every
+            or time.monotonic() - self.last_flush >= self.flush_interval
+        ):
+            self.__flush()
+
+    def __journal(self, record: bytes) -> None:
+        self.journal.write(record)
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.__sync(self.journal)
+            self.unsynced = 0
+
+    def __drop_held(self) -> bool:
+        """
+        Cuts the held frames off the end of the journal, the lock has to be held. Returns whether there were any
+        """
+        if not self.held:
+            return False
+        self.held.clear()
+        self.journal.seek(self.held_offset)
+        self.journal.truncate()
+        return True
+
+    def flush(self) -> None:
+        with self.lock:
+            self.__flush()
+
+    def close(self) -> None:
+        """
+        Flushes anything that is still buffered and releases the file handles, safe to call more than once
+        """
+        with self.lock:
+            if self.file is None:
+                return
+            self.closed.set()
+            # Closed by hand, the exit handler would only keep this annotator and its buffers alive
+            atexit.unregister(self.close)
+            self.__flush()
+            self.file.close()
+            self.file = None
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+                os.remove(self.journal_file)
+
+    def __flush(self) -> None:
+        self.last_flush = time.monotonic()
+        if self.file is None or not self.buffer:
+            return
+        self.file.write(b"".join(self.buffer))
+        self.buffer.clear()
+        if self.journal is None:
+            self.file.flush()
+            return
+        # Annotations have to be durable before the journal that covers them can be dropped
+        self.__sync(self.file)
+        self.journal.seek(0)
+        self.journal.truncate()
+        self.__start_journal()
+        self.unsynced = 0
+        if self.held:
+            # Held frames come right after what was just written, in the new journal too
+            self.held_offset = self.journal.tell()
+            self.journal.write(b"".join(self.held))
+            self.__sync(self.journal)
+
+    def __start_journal(self) -> None:
+        """
+        Every journal starts with the size the annotation file had when it was started,
+        so recovery knows exactly where the journaled records belong
+        """
+        self.journal.write(f"@{self.file.tell()}\n".encode("ascii"))
+        self.__sync(self.journal)
+
+    def __flush_loop(self) -> None:
+        """
+        Background flush so records don't sit in memory while the user is deciding on a frame
+        """
+        while not self.closed.wait(self.flush_interval):
+            with self.lock:
+                if time.monotonic() - self.last_flush >= self.flush_interval:
+                    self.__flush()
+
+    @staticmethod
+    def __sync(file: BinaryIO) -> None:
+        file.flush()
+        os.fsync(file.fileno())
+
+    @staticmethod
+    def recover_journal(output_path: str) -> int:
+        """
+        Appends the records of a journal left behind by a crashed crash safe session to its annotation file
+        Returns the number of recovered frames
+        """
+        journal_path = output_path + ".journal"
+        if not os.path.exists(journal_path):
+            return 0
+        with open(journal_path, "rb") as journal:
+            header = journal.readline()
+            records = journal.read()
+        if not header.startswith(b"@") or not header.endswith(b"\n"):
+            os.remove(journal_path)
+            return 0
+        # A crash can leave a torn last record behind, only keep the complete ones
+        if is_binary_annotation_file(output_path):
+            frame_bytes = BINARY_RECORD.size * read_binary_header(output_path)[1]
+            record_count = len(records) // frame_bytes
+            records = records[: record_count * frame_bytes]
+        else:
+            records = records[: records.rfind(b"\n") + 1]
+            record_count = records.count(b"\n")
+        # Drop anything past the journal start, those records were written again in the journal
+        offset = int(header[1:])
+        with open(output_path, "r+b") as file:
+            file.truncate(offset)
+            file.seek(offset)
+            file.write(records)
+            file.flush()
+            os.fsync(file.fileno())
+        os.remove(journal_path)
+        return record_count
@@ -0,0 +1,197 @@
+"""
+Persistent cache of prompt detection results
+
+Detections are keyed by the video's content hash, the frame number, the prompt and the model id, so rerunning
+the model on a frame, restarting a session on the same video or pre annotating it headlessly only ever runs
+inference once per frame. Every box above a low score floor is kept (not just the best one), so the detection
+threshold can be changed later without running the model again
+
+The cache is a single append only file next to the annotations:
+a 16 byte header, then records of (16 byte key digest, box count) followed by the boxes as float32
+(x0, y0, x1, y1) corners normalised to the frame size and their float32 scores.
+The index (key to file offset) is rebuilt on open by hopping over the record headers.
+Once the file grows past max_bytes, the oldest records are dropped
+"""
+
+import hashlib
+import os
+import struct
+from typing import Dict, Tuple
+
+import numpy as np
+
+from utils.PromptDetector import Detections
+
+CACHE_MAGIC: bytes = b"VATD"
+CACHE_VERSION: int = 1
+CACHE_HEADER = struct.Struct("<4sH10x")
+RECORD_HEADER = struct.Struct("<16sI")
+# Bytes used per box, four corner values and a score
+BOX_BYTES: int = 5 * 4
+
+
+def video_content_hash(video_path: str, sample_bytes: int = 1024 * 1024) -> str:
+    """
+    Hashes the file size and a few evenly spaced chunks of the video, which identifies its content
+    without reading multi GB files end to end
+    """
+    size = os.path.getsize(video_path)
+    digest = hashlib.blake2b(str(size).encode("ascii"), digest_size=16)
+    with open(video_path, "rb") as file:
+        for position in np.linspace(0, max(0, size - sample_bytes), 4).astype(int):
+            file.seek(int(position))
+            digest.update(file.read(sample_bytes))
+    return digest.hexdigest()
+
+
+class DetectionCache:
+    def __init__(
+        self,
+        cache_path: str,
+        video_hash: str,
+        max_bytes: int = 256 * 1024 * 1024,
+        min_score: float = 0.01,
+    ):
+        self.cache_path: str = cache_path
+        self.video_hash: str = video_hash
+        self.max_bytes: int = max_bytes
+        self.min_score: float = min_score
+        # key digest to (offset of the box data, box count), in file order
+        self.index: Dict[bytes, Tuple[int, int]] = {}
+        self.__open()
+
+    def __open(self) -> None:
+        if not os.path.exists(self.cache_path):
+            with open(self.cache_path, "wb") as file:
+                file.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION))
+        self.file = open(self.cache_path, "r+b")
+        magic, version = CACHE_HEADER.unpack(self.file.read(CACHE_HEADER.size))
+        if magic != CACHE_MAGIC or version != CACHE_VERSION:
+            # Not something we can read, start over rather than fail the session
+            self.file.seek(0)
+            self.file.truncate()
+            self.file.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION))
+        self.__build_index()
+
+    def __build_index(self) -> None:
+        self.index.clear()
+        file_size = os.fstat(self.file.fileno()).st_size
+        offset = CACHE_HEADER.size
+        while offset + RECORD_HEADER.size <= file_size:
+            self.file.seek(offset)
+            digest, count = RECORD_HEADER.unpack(self.file.read(RECORD_HEADER.size))
+            data_offset = offset + RECORD_HEADER.size
+            next_offset = data_offset + count * BOX_BYTES
+            if next_offset > file_size:
+                # Torn record from an interrupted write
+                self.file.truncate(offset)
+                break
+            # A key written again later supersedes (and is newer than) its earlier record
+            self.index.pop(digest, None)
+            self.index[digest] = (data_offset, count)
+            offset = next_offset
+
+    def key(self, frame_number: int, prompt_str: str, model_id: str) -> bytes:
+        return hashlib.blake2b(
+            f"{self.video_hash}\0{frame_number}\0{prompt_str}\0{model_id}".encode(
+                "utf-8"
+            ),
+            digest_size=16,
+        ).digest()
+
+    def get(
+        self,
+        frame_number: int,
+        prompt_str: str,
+        model_id: str,
+        frame_shape: Tuple[int, ...],
+    ) -> Detections | None:
+        """
+        Cached detections for the frame scaled to the given frame shape, None on a miss
+        """
+        entry = self.index.get(self.key(frame_number, prompt_str, model_id))
+        if entry is None:
+            return None
+        data_offset, count = entry
+        self.file.seek(data_offset)
+        data = np.frombuffer(self.file.read(count * BOX_BYTES), dtype="<f4")
+        boxes = data[: count * 4].reshape(count, 4)
+        scores = data[count * 4 :]
+        height, width = frame_shape[:2]
+        scale = np.array([width, height, width, height], dtype=np.float32)
+        return Detections(boxes * scale, scores.copy())
+
+    def put(
+        self,
+        frame_number: int,
+        prompt_str: str,
+        model_id: str,
+        frame_shape: Tuple[int, ...],
+        detections: Detections,
+    ) -> None:
+        kept = detections.above(self.min_score)
+        height, width = frame_shape[:2]
+        scale = np.array([width, height, width, height], dtype=np.float32)
+        boxes = (kept.boxes / scale).astype("<f4")
+        scores = kept.scores.astype("<f4")
+        digest = self.key(frame_number, prompt_str, model_id)
+
+        self.file.seek(0, os.SEEK_END)
+        offset = self.file.tell()
+        self.file.write(RECORD_HEADER.pack(digest, len(scores)))
+        self.file.write(boxes.tobytes())
+        self.file.write(scores.tobytes())
+        self.file.flush()
+        # Re-inserting moves the key to the end, the index stays in oldest to newest order
+        self.index.pop(digest, None)
+        self.index[digest] = (offset + RECORD_HEADER.size, len(scores))
+        if offset + RECORD_HEADER.size + len(scores) * BOX_BYTES > self.max_bytes:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        Rewrites the cache with only the newest records that fit in half of max_bytes,
+        so eviction doesn't have to run again on the very next write
+        """
+        kept: list[Tuple[bytes, int, int]] = []
+        total = CACHE_HEADER.size
+        for digest, (data_offset, count) in reversed(list(self.index.items())):
+            record_size = RECORD_HEADER.size + count * BOX_BYTES
+            if total + record_size > self.max_bytes // 2:
+                break
+            kept.append((digest, data_offset, count))
+            total += record_size
+
+        temp_path = self.cache_path + ".tmp"
+        with open(temp_path, "wb") as temp_file:
+            temp_file.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION))
+            for digest, data_offset, count in reversed(kept):
+                self.file.seek(data_offset)
+                temp_file.write(RECORD_HEADER.pack(digest, count))
+                temp_file.write(self.file.read(count * BOX_BYTES))
+        self.file.close()
+        os.replace(temp_path, self.cache_path)
+        self.__open()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def open_detection_cache(
+    video_path: str, annotation_path: str, detection_cache_mb: int = 256
+) -> DetectionCache | None:
+    """
+    The video's detection cache, <video-name>.detections next to the annotation file, None if its size is 0
+    """
+    if detection_cache_mb <= 0:
+        return None
+    full_video_name: str = os.path.basename(video_path)
+    video_name: str = os.path.splitext(full_video_name)[0]
+    cache_path = os.path.join(
+        os.path.dirname(annotation_path), video_name + ".detections"
+    )
+    return DetectionCache(
+        cache_path,
+        video_content_hash(video_path),
+        max_bytes=detection_cache_mb * 1024 * 1024,
+    )
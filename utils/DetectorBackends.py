@@ -0,0 +1,220 @@
+"""
+Selectable CPU inference backends for the image side of the prompt detector
+
+eager : the model as loaded, float32 PyTorch
+int8  : every Linear layer dynamically quantized to int8 (int8 weights, activations quantized on the fly), which is
+        where nearly all of OwlViT's compute is. Converted once into the model cache and loaded from there afterwards
+        without reading the float weights
+onnx  : the image side exported to ONNX once per input size into the model cache, and run with ONNX Runtime.
+        Needs onnxruntime, plus onnx and onnxscript for the export: pip install onnxruntime onnx onnxscript
+
+Every backend takes the processor's pixel values and the prompt's query embedding and returns each patch's score
+and (center x, center y, width, height) box relative to the image, so PromptDetector doesn't care which one runs.
+The prompt itself is always encoded by the PyTorch model
+
+torch and transformers are imported with this module, it is only imported once a detector is created
+"""
+
+import os
+from typing import Dict, Tuple
+
+import numpy as np
+import torch
+from numpy import ndarray
+from transformers import OwlViTConfig, OwlViTForObjectDetection
+
+# Bumped whenever ImageHead changes, so stale exports in the model cache are not picked up
+EXPORT_VERSION: int = 1
+
+
+def default_model_cache_dir() -> str:
+    return os.path.join(os.path.expanduser("~"), ".cache", "video-annotation-tool")
+
+
+def model_cache_path(cache_dir: str, model_id: str, suffix: str) -> str:
+    return os.path.join(
+        cache_dir or default_model_cache_dir(), model_id.replace("/", "--") + suffix
+    )
+
+
+class ImageHead(torch.nn.Module):
+    """
+    OwlViT's image side against a single text query, the graph every backend runs
+    Inputs that aren't the model's own size get interpolated position embeddings
+    """
+
+    def __init__(self, model: OwlViTForObjectDetection):
+        super().__init__()
+        self.model: OwlViTForObjectDetection = model
+        self.native_size: int = model.config.vision_config.image_size
+
+    def forward(
+        self, pixel_values: torch.Tensor, query_embeds: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        interpolate = tuple(pixel_values.shape[-2:]) != (
+            self.native_size,
+            self.native_size,
+        )
+        feature_map, _ = self.model.image_embedder(
+            pixel_values=pixel_values, interpolate_pos_encoding=interpolate
+        )
+        batch_size, patches_height, patches_width, hidden_dim = feature_map.shape
+        image_feats = feature_map.reshape(
+            batch_size, patches_height * patches_width, hidden_dim
+        )
+        logits, _ = self.model.class_predictor(
+            image_feats, query_embeds.expand(batch_size, -1, -1)
+        )
+        pred_boxes = self.model.box_predictor(
+            image_feats, feature_map, interpolate_pos_encoding=interpolate
+        )
+        # Single query, so each patch's score is just the sigmoid of its only logit
+        return torch.sigmoid(logits[..., 0]), pred_boxes
+
+
+class TorchImageBackend:
+    """
+    Runs the head in PyTorch with gradient tracking off, for the eager and int8 models alike
+    """
+
+    def __init__(self, model: OwlViTForObjectDetection):
+        self.head: ImageHead = ImageHead(model).eval()
+
+    def __call__(
+        self, pixel_values: torch.Tensor, query_embeds: torch.Tensor
+    ) -> Tuple[ndarray, ndarray]:
+        with torch.inference_mode():
+            scores, boxes = self.head(pixel_values, query_embeds)
+        return scores.numpy(), boxes.numpy()
+
+
+class OnnxImageBackend:
+    """
+    Runs the head with ONNX Runtime, one session per input size, each exported the first time that size is asked for
+    intra_op_threads above 0 caps the threads a session runs on, by default ONNX Runtime uses one per core
+    """
+
+    def __init__(
+        self,
+        model: OwlViTForObjectDetection,
+        model_id: str,
+        cache_dir: str = "",
+        intra_op_threads: int = 0,
+    ):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ValueError(
+                "The onnx detector backend needs ONNX Runtime, install it with pip install onnxruntime onnx onnxscript"
+            ) from None
+        self.onnxruntime = onnxruntime
+        self.head: ImageHead = ImageHead(model).eval()
+        self.model_id: str = model_id
+        self.cache_dir: str = cache_dir
+        self.intra_op_threads: int = intra_op_threads
+        self.sessions: Dict[int, "onnxruntime.InferenceSession"] = {}
+
+    def __export(self, onnx_path: str, input_size: int) -> None:
+        """
+        Exports the head at input_size with a dynamic batch, written aside and swapped in so a killed export is redone
+        and workers exporting at once never write the same file
+        """
+        os.makedirs(os.path.dirname(onnx_path), exist_ok=True)
+        print(f"Exporting the detector to {onnx_path}, only done once per input size")
+        query_dim = self.head.model.config.projection_dim
+        temporary_path = f"{onnx_path}.{os.getpid()}.tmp"
+        batch = torch.export.Dim("batch", min=1, max=1024)
+        torch.onnx.export(
+            self.head,
+            (
+                torch.zeros(2, 3, input_size, input_size),
+                torch.zeros(1, 1, query_dim),
+            ),
+            temporary_path,
+            input_names=["pixel_values", "query_embeds"],
+            output_names=["scores", "boxes"],
+            dynamic_shapes={"pixel_values": {0: batch}, "query_embeds": None},
+            external_data=False,
+        )
+        os.replace(temporary_path, onnx_path)
+
+    def __session(self, input_size: int) -> "onnxruntime.InferenceSession":
+        session = self.sessions.get(input_size)
+        if session is None:
+            onnx_path = model_cache_path(
+                self.cache_dir,
+                self.model_id,
+                f".v{EXPORT_VERSION}.{input_size}.onnx",
+            )
+            if not os.path.exists(onnx_path):
+                self.__export(onnx_path, input_size)
+            options = self.onnxruntime.SessionOptions()
+            options.graph_optimization_level = (
+                self.onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            )
+            if self.intra_op_threads > 0:
+                options.intra_op_num_threads = self.intra_op_threads
+            session = self.onnxruntime.InferenceSession(
+                onnx_path, options, providers=["CPUExecutionProvider"]
+            )
+            self.sessions[input_size] = session
+        return session
+
+    def __call__(
+        self, pixel_values: torch.Tensor, query_embeds: torch.Tensor
+    ) -> Tuple[ndarray, ndarray]:
+        scores, boxes = self.__session(int(pixel_values.shape[-1])).run(
+            ["scores", "boxes"],
+            {
+                "pixel_values": pixel_values.numpy().astype(np.float32, copy=False),
+                "query_embeds": query_embeds.numpy().astype(np.float32, copy=False),
+            },
+        )
+        return scores, boxes
+
+
+ImageBackend = TorchImageBackend | OnnxImageBackend
+
+
+def quantize_int8(model: OwlViTForObjectDetection) -> OwlViTForObjectDetection:
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def load_model(
+    model_id: str, backend: str = "eager", cache_dir: str = ""
+) -> OwlViTForObjectDetection:
+    """
+    The PyTorch model of the backend, int8 models are quantized on first use and read back from the cache after that
+    """
+    if backend != "int8":
+        return OwlViTForObjectDetection.from_pretrained(model_id).eval()
+    int8_path = model_cache_path(cache_dir, model_id, ".int8.pt")
+    if os.path.exists(int8_path):
+        # Only the architecture is needed, the weights all come from the cache
+        model = quantize_int8(
+            OwlViTForObjectDetection(OwlViTConfig.from_pretrained(model_id)).eval()
+        )
+        model.load_state_dict(torch.load(int8_path, weights_only=True))
+        return model
+    model = quantize_int8(OwlViTForObjectDetection.from_pretrained(model_id).eval())
+    os.makedirs(os.path.dirname(int8_path), exist_ok=True)
+    temporary_path = f"{int8_path}.{os.getpid()}.tmp"
+    torch.save(model.state_dict(), temporary_path)
+    os.replace(temporary_path, int8_path)
+    return model
+
+
+def create_image_backend(
+    backend: str,
+    model: OwlViTForObjectDetection,
+    model_id: str,
+    cache_dir: str = "",
+    num_threads: int = 0,
+) -> ImageBackend:
+    if backend in ("eager", "int8"):
+        return TorchImageBackend(model)
+    if backend == "onnx":
+        return OnnxImageBackend(model, model_id, cache_dir, num_threads)
+    raise ValueError(f"Unknown detector backend {backend!r}")
@@ -0,0 +1,190 @@
+"""
+Decoded frame caching for scrubbing through a video
+
+FrameCache is a bounded LRU of frames that have already been decoded and scaled, limited by the
+number of bytes it holds rather than the number of frames
+
+FramePrefetcher owns a second capture and fills the cache from a worker thread, decoding ahead
+of the current position in the direction the user is moving (and a little bit behind it), so stepping
+through frames that are already cached never has to seek or decode
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any
+
+import cv2
+from numpy import dtype, floating, integer, ndarray
+
+from utils.FrameIndex import FrameIndex
+from utils.Profiler import NullProfiler, Profiler
+from utils.utils import get_scaled_image
+from utils.VideoBackend import Capture, PyAVCapture, open_capture
+
+
+class FrameCache:
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024):
+        self.max_bytes: int = max_bytes
+        self.cur_bytes: int = 0
+        self.frames: OrderedDict[
+            int, cv2.Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]]
+        ] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, frame_number: int) -> bool:
+        with self.lock:
+            return frame_number in self.frames
+
+    def get(
+        self, frame_number: int
+    ) -> cv2.Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]] | None:
+        """
+        Returns the cached frame (to be treated as read only) and marks it as most recently used
+        """
+        with self.lock:
+            frame = self.frames.get(frame_number)
+            if frame is not None:
+                self.frames.move_to_end(frame_number)
+            return frame
+
+    def put(
+        self,
+        frame_number: int,
+        frame: cv2.Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]],
+    ) -> None:
+        with self.lock:
+            if frame_number in self.frames:
+                self.frames.move_to_end(frame_number)
+                return
+            self.frames[frame_number] = frame
+            self.cur_bytes += frame.nbytes
+            # Evict least recently used frames, but always keep the one that was just added
+            while self.cur_bytes > self.max_bytes and len(self.frames) > 1:
+                _, evicted = self.frames.popitem(last=False)
+                self.cur_bytes -= evicted.nbytes
+
+
+class FramePrefetcher:
+    def __init__(
+        self,
+        video_path: str,
+        cache: FrameCache,
+        window_scale: float,
+        ahead: int = 30,
+        behind: int = 10,
+        max_grab: int = 8,
+        profiler: Profiler = NullProfiler(),
+        index: FrameIndex | None = None,
+        backend: str = "cv2",
+        decode_threads: int = 0,
+    ):
+        self.cache: FrameCache = cache
+        self.profiler: Profiler = profiler
+        self.window_scale: float = window_scale
+        self.ahead: int = ahead
+        self.behind: int = behind
+        self.max_grab: int = max_grab
+        # Seeks through the keyframe index when there is one
+        self.cap: Capture = open_capture(video_path, index, backend, decode_threads)
+        self.frame_count: int = self.cap.frame_count
+        self.width: int = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH) * window_scale)
+        self.height: int = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT) * window_scale)
+        # Only the scaled frames are cached, the full size ones are all decoded into this one
+        self.decode_buffer: ndarray | None = None
+        # Frame the worker's capture will decode next, so it only seeks when it has to
+        self.next_decode: int = 0
+        self.position: int = 0
+        self.direction: int = 1
+        self.generation: int = 0
+        self.done_generation: int = -1
+        self.running: bool = True
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.__prefetch_loop, daemon=True)
+        self.thread.start()
+
+    def request(self, frame_number: int, direction: int) -> None:
+        """
+        Tells the worker where the user currently is and which way they are moving,
+        whatever it was decoding for the previous position is abandoned
+        """
+        with self.condition:
+            self.position = frame_number
+            if direction != 0:
+                self.direction = 1 if direction > 0 else -1
+            self.generation += 1
+            self.condition.notify()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+        self.cap.release()
+
+    def __wanted_ranges(self, position: int, direction: int) -> list[range]:
+        """
+        The stretch in the direction of movement comes first, then the shorter one behind the user
+        """
+        if direction > 0:
+            ranges = [
+                range(position + 1, position + 1 + self.ahead),
+                range(max(0, position - self.behind), position),
+            ]
+        else:
+            ranges = [
+                range(max(0, position - self.ahead), position),
+                range(position + 1, position + 1 + self.behind),
+            ]
+        if self.frame_count > 0:
+            ranges = [range(r.start, min(r.stop, self.frame_count)) for r in ranges]
+        return ranges
+
+    def __prefetch_loop(self) -> None:
+        while True:
+            with self.condition:
+                while self.running and self.generation == self.done_generation:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                generation = self.generation
+                position = self.position
+                direction = self.direction
+
+            for wanted in self.__wanted_ranges(position, direction):
+                if not self.__fill(wanted, generation):
+                    break
+            else:
+                self.done_generation = generation
+
+    def __fill(self, wanted: range, generation: int) -> bool:
+        """
+        Decodes the frames of the range that are missing from the cache, returns False
+        if the user moved on in the meantime
+        """
+        for frame_number in wanted:
+            if self.generation != generation or not self.running:
+                return False
+            if frame_number in self.cache:
+                continue
+            gap = frame_number - self.next_decode
+            with self.profiler.stage("prefetch_decode", frame_number):
+                if self.next_decode < 0 or not 0 <= gap <= self.max_grab:
+                    self.cap.seek(frame_number)
+                else:
+                    # Stepping over a few already cached frames is cheaper than a seek
+                    for _ in range(gap):
+                        self.cap.grab()
+                if isinstance(self.cap, PyAVCapture):
+                    ret, frame = self.cap.read_scaled(self.width, self.height)
+                else:
+                    ret, frame = self.cap.read(self.decode_buffer)
+            if not ret:
+                self.next_decode = -1
+                return True
+            self.next_decode = frame_number + 1
+            if not isinstance(self.cap, PyAVCapture):
+                self.decode_buffer = frame
+                with self.profiler.stage("prefetch_scale", frame_number):
+                    frame = get_scaled_image(frame, self.window_scale)
+            self.cache.put(frame_number, frame)
+        return True
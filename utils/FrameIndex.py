@@ -0,0 +1,261 @@
+"""
+Keyframe and timestamp index for accurate, bounded cost seeks
+
+cap.set(CAP_PROP_POS_FRAMES, n) guesses a timestamp from the frame rate, seeks to a keyframe before it and
+decodes forward until it thinks it got there. On long GOP files that decodes far more than needed, and on files
+whose timestamps don't follow the frame rate it lands on the wrong frame, shifting boxes against the video
+
+The index holds every frame's presentation timestamp and the frame numbers of the keyframes. It is built once per
+video from a demux only pass over the packets (OpenCV's raw mode, nothing is decoded) and kept in a sidecar next
+to the video: a 32 byte header (magic, version, the video's content hash, frame and keyframe counts) followed by
+the frames' int64 pts, their float64 timestamps in milliseconds and the keyframes' int64 frame numbers
+
+IndexedCapture seeks to frame n by landing on the closest keyframe at or before it, identifying the frame it
+actually landed on from its pts, and grabbing forward a counted number of frames, so a seek decodes at most one
+GOP and frame numbers always match the order frames are read in, i.e. the annotation line numbers
+"""
+
+import os
+import struct
+from dataclasses import dataclass
+from typing import Any, Tuple
+
+import cv2
+import numpy as np
+from numpy import dtype, floating, integer, ndarray
+
+from utils.DetectionCache import video_content_hash
+
+INDEX_MAGIC: bytes = b"VAFI"
+INDEX_VERSION: int = 1
+# magic, version, reserved, video content hash, frame count, keyframe count
+INDEX_HEADER = struct.Struct("<4sHH16sII")
+
+
+def default_index_path(video_path: str) -> str:
+    return os.path.splitext(video_path)[0] + ".frameindex"
+
+
+@dataclass
+class FrameIndex:
+    # Per frame, in presentation (i.e. read) order
+    pts: ndarray
+    timestamps_ms: ndarray
+    # Frame numbers of the keyframes, ascending
+    keyframes: ndarray
+
+    def __len__(self) -> int:
+        return len(self.pts)
+
+    def keyframe_before(self, frame_number: int) -> int:
+        """
+        Position in keyframes of the last keyframe at or before the frame
+        """
+        return max(
+            0, int(np.searchsorted(self.keyframes, frame_number, side="right")) - 1
+        )
+
+    def frame_at_pts(self, pts: float) -> int:
+        """
+        Frame number of the frame with this pts, -1 if no frame has it
+        """
+        frame_number = int(np.searchsorted(self.pts, pts))
+        if frame_number < len(self.pts) and self.pts[frame_number] == pts:
+            return frame_number
+        return -1
+
+    @classmethod
+    def build(cls, video_path: str) -> "FrameIndex":
+        """
+        Reads every packet of the video without decoding it
+        Packets come in decode order, sorting their pts gives the order frames are presented in
+        """
+        cap = cv2.VideoCapture(video_path)
+        if not cap.set(cv2.CAP_PROP_FORMAT, -1):
+            cap.release()
+            raise ValueError(f"Can't read the packets of {video_path}")
+        packets = []
+        while cap.grab():
+            packets.append(
+                (
+                    cap.get(cv2.CAP_PROP_PTS),
+                    cap.get(cv2.CAP_PROP_POS_MSEC),
+                    cap.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME) != 0,
+                )
+            )
+        cap.release()
+        if not packets:
+            raise ValueError(f"{video_path} has no video packets")
+        pts = np.array([packet[0] for packet in packets], dtype=np.int64)
+        order = np.argsort(pts, kind="stable")
+        # Frame number of every packet
+        frame_numbers = np.empty(len(order), dtype=np.int64)
+        frame_numbers[order] = np.arange(len(order))
+        keyframes = np.sort(
+            frame_numbers[np.array([packet[2] for packet in packets], dtype=bool)]
+        )
+        if len(keyframes) == 0 or keyframes[0] != 0:
+            # Decoding can always start from the first frame
+            keyframes = np.concatenate([[0], keyframes]).astype(np.int64)
+        timestamps_ms = np.array([packet[1] for packet in packets], dtype=np.float64)
+        return cls(pts[order], timestamps_ms[order], keyframes)
+
+    @classmethod
+    def from_file(cls, index_path: str) -> Tuple["FrameIndex", bytes]:
+        """
+        Reads a sidecar, returns the index and the content hash of the video it was built from
+        """
+        with open(index_path, "rb") as file:
+            magic, version, _, video_hash, frame_count, keyframe_count = (
+                INDEX_HEADER.unpack(file.read(INDEX_HEADER.size))
+            )
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"{index_path} is not a frame index")
+        if version != INDEX_VERSION:
+            raise ValueError(
+                f"{index_path} has unsupported frame index version {version}"
+            )
+        offset = INDEX_HEADER.size
+        pts = np.fromfile(index_path, dtype="<i8", count=frame_count, offset=offset)
+        offset += pts.nbytes
+        timestamps_ms = np.fromfile(
+            index_path, dtype="<f8", count=frame_count, offset=offset
+        )
+        offset += timestamps_ms.nbytes
+        keyframes = np.fromfile(
+            index_path, dtype="<i8", count=keyframe_count, offset=offset
+        )
+        if len(keyframes) != keyframe_count:
+            raise ValueError(f"{index_path} is truncated")
+        return cls(pts, timestamps_ms, keyframes), video_hash
+
+    def to_file(self, index_path: str, video_hash: bytes) -> None:
+        temporary_path = index_path + ".tmp"
+        with open(temporary_path, "wb") as file:
+            file.write(
+                INDEX_HEADER.pack(
+                    INDEX_MAGIC,
+                    INDEX_VERSION,
+                    0,
+                    video_hash,
+                    len(self.pts),
+                    len(self.keyframes),
+                )
+            )
+            file.write(self.pts.astype("<i8").tobytes())
+            file.write(self.timestamps_ms.astype("<f8").tobytes())
+            file.write(self.keyframes.astype("<i8").tobytes())
+        os.replace(temporary_path, index_path)
+
+
+def load_frame_index(video_path: str, index_path: str = "") -> FrameIndex | None:
+    """
+    The video's index from its sidecar, built (and the sidecar written) on first open or when the video changed
+    None if the video's packets can't be read, seeks then fall back to OpenCV's own
+    """
+    index_path = index_path or default_index_path(video_path)
+    video_hash = bytes.fromhex(video_content_hash(video_path))
+    if os.path.exists(index_path):
+        try:
+            index, index_hash = FrameIndex.from_file(index_path)
+            if index_hash == video_hash:
+                return index
+        except ValueError as error:
+            print(f"Rebuilding frame index: {error}")
+    print(f"Indexing the keyframes of {video_path}, this only happens once")
+    try:
+        index = FrameIndex.build(video_path)
+    except ValueError as error:
+        print(f"No frame index, seeking without one: {error}")
+        return None
+    try:
+        index.to_file(index_path, video_hash)
+    except OSError as error:
+        # A read only video directory still gets accurate seeks, just not a persisted index
+        print(f"Couldn't save the frame index: {error}")
+    return index
+
+
+class IndexedCapture:
+    """
+    A VideoCapture whose seeks go through a FrameIndex, falls back to cap.set when there is no index
+    decode_threads above 0 sets the number of threads FFmpeg decodes with, by default it picks one per core
+    """
+
+    def __init__(
+        self, video_path: str, index: FrameIndex | None = None, decode_threads: int = 0
+    ):
+        self.cap: cv2.VideoCapture = cv2.VideoCapture(video_path)
+        if decode_threads > 0:
+            # Only settable while opening, the plain capture above is kept if FFmpeg can't open the file
+            threaded = cv2.VideoCapture(
+                video_path, cv2.CAP_FFMPEG, [cv2.CAP_PROP_N_THREADS, decode_threads]
+            )
+            if threaded.isOpened():
+                self.cap.release()
+                self.cap = threaded
+        self.index: FrameIndex | None = index
+        # A seek grabs the frame it was asked for to identify it, the next read only has to retrieve it
+        self.grabbed: bool = False
+
+    @property
+    def frame_count(self) -> int:
+        if self.index is not None:
+            return len(self.index)
+        return int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    def get(self, prop: int) -> float:
+        return self.cap.get(prop)
+
+    def isOpened(self) -> bool:
+        return self.cap.isOpened()
+
+    def seek(self, frame_number: int) -> None:
+        """
+        The next read returns frame_number
+        """
+        self.grabbed = False
+        if self.index is None or not 0 <= frame_number < len(self.index):
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+            return
+        keyframe = self.index.keyframe_before(frame_number)
+        while True:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, int(self.index.keyframes[keyframe]))
+            landed = (
+                self.index.frame_at_pts(self.cap.get(cv2.CAP_PROP_PTS))
+                if self.cap.grab()
+                else -1
+            )
+            if 0 <= landed <= frame_number:
+                break
+            if keyframe == 0:
+                # Can't place the frame OpenCV landed on, trust its own seek
+                self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+                return
+            # Landed past the frame, start from the keyframe before
+            keyframe -= 1
+        for _ in range(frame_number - landed):
+            if not self.cap.grab():
+                return
+        self.grabbed = True
+
+    def grab(self) -> bool:
+        if self.grabbed:
+            self.grabbed = False
+            return True
+        return self.cap.grab()
+
+    def read(
+        self,
+        image: ndarray | None = None,
+    ) -> Tuple[bool, cv2.Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]]]:
+        """
+        Decodes into image when it has the frame's size, instead of allocating a new frame
+        """
+        if self.grabbed:
+            self.grabbed = False
+            return self.cap.retrieve(image)
+        return self.cap.read(image)
+
+    def release(self) -> None:
+        self.cap.release()
@@ -0,0 +1,390 @@
+"""
+Where the tools get their scaled frames from
+
+VideoFrameSource decodes the video with one of the video backends (OpenCV by default, or PyAV) and scales every
+frame to the display scale, as the tools always have. ThreadedFrameSource runs a VideoFrameSource on a producer
+thread that keeps a few frames decoded and scaled ahead of the reader, so decoding overlaps tracking.
+ProxyFrameSource reads a proxy instead: the whole video decoded once at the display scale and stored as raw
+uint8 frames in one file that is memory mapped, so any frame is an O(1) slice with no decode, seek or resize
+
+A proxy is a 64 byte header (magic, version, channels, width, height, frame count, scale and the video's
+content hash) followed by frame_count * height * width * channels bytes. It is only used while it matches
+the video and the scale the session would display it at, otherwise the tools fall back to decoding
+
+To build one next to the video:
+uv run python -m utils.FrameSource /path/to/video
+"""
+
+import argparse
+import os
+import struct
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Tuple
+
+import cv2
+import numpy as np
+from numpy import dtype, floating, integer, ndarray
+
+from utils.DetectionCache import video_content_hash
+from utils.FrameIndex import FrameIndex, load_frame_index
+from utils.Profiler import NullProfiler, Profiler
+from utils.utils import get_scaled_image
+from utils.VideoBackend import CAPTURE_BACKENDS, Capture, PyAVCapture, open_capture
+
+Frame = cv2.Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]]
+
+PROXY_MAGIC: bytes = b"VAPX"
+PROXY_VERSION: int = 1
+# magic, version, channels, width, height, frame count, scale, video content hash
+PROXY_HEADER = struct.Struct("<4sHHIIId16s20x")
+
+
+def default_proxy_path(video_path: str) -> str:
+    return os.path.splitext(video_path)[0] + ".proxy"
+
+
+def read_proxy_header(proxy_path: str) -> Tuple[int, int, int, int, float, bytes]:
+    """
+    Validates a proxy's header, returns its channels, width, height, frame count, scale and video hash
+    """
+    with open(proxy_path, "rb") as file:
+        magic, version, channels, width, height, frame_count, scale, video_hash = (
+            PROXY_HEADER.unpack(file.read(PROXY_HEADER.size))
+        )
+    if magic != PROXY_MAGIC:
+        raise ValueError(f"{proxy_path} is not a proxy frame file")
+    if version != PROXY_VERSION:
+        raise ValueError(f"{proxy_path} has unsupported proxy version {version}")
+    return channels, width, height, frame_count, scale, video_hash
+
+
+class VideoFrameSource:
+    """
+    Decodes and scales frames one after the other, seeking (through the keyframe index when there is one)
+    only when asked to
+    """
+
+    def __init__(
+        self,
+        video_path: str,
+        window_scale: float,
+        profiler: Profiler = NullProfiler(),
+        index: FrameIndex | None = None,
+        backend: str = "cv2",
+        decode_threads: int = 0,
+    ):
+        self.cap: Capture = open_capture(video_path, index, backend, decode_threads)
+        self.window_scale: float = window_scale
+        self.profiler: Profiler = profiler
+        self.width: int = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH) * window_scale)
+        self.height: int = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT) * window_scale)
+        self.frame_count: int = self.cap.frame_count
+        # Frame number the next read returns
+        self.position: int = 0
+        # Full size frames only live until they are scaled (into a new array), so they are all decoded into this one
+        self.decode_buffer: Frame | None = None
+
+    def seek(self, frame_number: int) -> None:
+        if frame_number != self.position:
+            with self.profiler.stage("seek", frame_number):
+                self.cap.seek(frame_number)
+            self.position = frame_number
+
+    def read(self) -> Tuple[bool, Frame | None]:
+        if isinstance(self.cap, PyAVCapture):
+            # Converted and scaled in one pass, there is no full size frame to scale afterwards
+            with self.profiler.stage("decode", self.position):
+                ret, frame = self.cap.read_scaled(self.width, self.height)
+            if not ret:
+                return False, None
+            self.position += 1
+            return True, frame
+        with self.profiler.stage("decode", self.position):
+            ret, frame = self.cap.read(self.decode_buffer)
+        if not ret:
+            return False, None
+        self.decode_buffer = frame
+        with self.profiler.stage("scale", self.position):
+            frame = get_scaled_image(frame, self.window_scale)
+        self.position += 1
+        return True, frame
+
+    def release(self) -> None:
+        self.cap.release()
+
+
+class ProxyFrameSource:
+    """
+    Frames of a proxy as read only views into its memory map, callers copy before drawing on them
+    """
+
+    def __init__(self, proxy_path: str, profiler: Profiler = NullProfiler()):
+        channels, width, height, frame_count, scale, video_hash = read_proxy_header(
+            proxy_path
+        )
+        self.proxy_path: str = proxy_path
+        self.window_scale: float = scale
+        self.video_hash: bytes = video_hash
+        self.profiler: Profiler = profiler
+        self.width: int = width
+        self.height: int = height
+        self.frame_count: int = frame_count
+        self.frames: ndarray = np.memmap(
+            proxy_path,
+            dtype=np.uint8,
+            mode="r",
+            offset=PROXY_HEADER.size,
+            shape=(frame_count, height, width, channels),
+        )
+        self.position: int = 0
+
+    def __len__(self) -> int:
+        return self.frame_count
+
+    def __getitem__(self, frame_number: int) -> Frame:
+        return self.frames[frame_number]
+
+    def seek(self, frame_number: int) -> None:
+        self.position = frame_number
+
+    def read(self) -> Tuple[bool, Frame | None]:
+        if self.position >= self.frame_count:
+            return False, None
+        with self.profiler.stage("proxy_read", self.position):
+            frame = self.frames[self.position]
+        self.position += 1
+        return True, frame
+
+    def release(self) -> None:
+        del self.frames
+
+
+class ThreadedFrameSource:
+    """
+    Reads a VideoFrameSource on a producer thread, keeping up to depth frames ready for read
+    A seek drops the frames decoded past the old position and restarts the producer from the new one
+    """
+
+    def __init__(self, source: VideoFrameSource, depth: int = 8):
+        self.source: VideoFrameSource = source
+        self.window_scale: float = source.window_scale
+        self.profiler: Profiler = source.profiler
+        self.width: int = source.width
+        self.height: int = source.height
+        self.frame_count: int = source.frame_count
+        self.depth: int = max(1, depth)
+        # Frame number the next read returns, the queued frames follow on from it
+        self.position: int = source.position
+        self.frames: Deque[Frame] = deque()
+        self.seek_to: int | None = None
+        # Bumped by every seek, so a frame decoded for the old position is never queued
+        self.generation: int = 0
+        self.end_of_video: bool = False
+        self.running: bool = True
+        self.error: BaseException | None = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.__decode_loop, daemon=True)
+        self.thread.start()
+
+    def seek(self, frame_number: int) -> None:
+        with self.condition:
+            if frame_number == self.position:
+                return
+            self.position = frame_number
+            self.seek_to = frame_number
+            self.generation += 1
+            self.frames.clear()
+            self.end_of_video = False
+            self.condition.notify_all()
+
+    def read(self) -> Tuple[bool, Frame | None]:
+        with self.profiler.stage("decode_wait", self.position), self.condition:
+            while True:
+                if self.error is not None:
+                    raise RuntimeError("Decode worker failed") from self.error
+                if self.frames:
+                    frame = self.frames.popleft()
+                    self.position += 1
+                    self.condition.notify_all()
+                    return True, frame
+                if self.end_of_video:
+                    return False, None
+                self.condition.wait()
+
+    def release(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+        self.source.release()
+
+    def __decode_loop(self) -> None:
+        try:
+            while True:
+                with self.condition:
+                    while self.running and (
+                        self.seek_to is None
+                        and (self.end_of_video or len(self.frames) >= self.depth)
+                    ):
+                        self.condition.wait()
+                    if not self.running:
+                        return
+                    seek_to, self.seek_to = self.seek_to, None
+                    generation = self.generation
+                # Only this thread touches the wrapped source, it times its own decode and scale stages
+                if seek_to is not None:
+                    self.source.seek(seek_to)
+                ret, frame = self.source.read()
+                with self.condition:
+                    if generation != self.generation:
+                        continue
+                    if ret:
+                        self.frames.append(frame)
+                    else:
+                        self.end_of_video = True
+                    self.condition.notify_all()
+        except BaseException as error:
+            with self.condition:
+                self.error = error
+                self.condition.notify_all()
+
+
+FrameSource = VideoFrameSource | ProxyFrameSource | ThreadedFrameSource
+
+
+def open_frame_source(
+    video_path: str,
+    window_scale: float,
+    proxy_path: str = "",
+    profiler: Profiler = NullProfiler(),
+    backend: str = "cv2",
+    decode_threads: int = 0,
+    threaded: bool = False,
+) -> FrameSource:
+    """
+    Reads from the video's proxy when there is one built from this video at this scale, decodes otherwise,
+    seeking through the video's keyframe index (built on first open)
+    threaded decodes on a producer thread, for callers that read on while doing work of their own
+    """
+    proxy_path = proxy_path or default_proxy_path(video_path)
+    if os.path.exists(proxy_path):
+        try:
+            proxy = ProxyFrameSource(proxy_path, profiler)
+        except ValueError as error:
+            print(f"Ignoring proxy: {error}")
+        else:
+            if abs(proxy.window_scale - window_scale) > 1e-6:
+                print(
+                    f"Ignoring proxy {proxy_path}, it was built at scale {proxy.window_scale:.4f}"
+                    f" but frames are shown at {window_scale:.4f}"
+                )
+            elif proxy.video_hash != bytes.fromhex(video_content_hash(video_path)):
+                print(f"Ignoring proxy {proxy_path}, it was built from another video")
+            else:
+                return proxy
+            proxy.release()
+    source = VideoFrameSource(
+        video_path,
+        window_scale,
+        profiler,
+        load_frame_index(video_path),
+        backend,
+        decode_threads,
+    )
+    return ThreadedFrameSource(source) if threaded else source
+
+
+def build_proxy(
+    video_path: str,
+    proxy_path: str,
+    window_scale: float,
+    backend: str = "cv2",
+    decode_threads: int = 0,
+) -> int:
+    """
+    Decodes the whole video once at window_scale into a proxy, returns the number of frames written
+    Written to a temporary file first, so an interrupted build never leaves a proxy that looks valid
+    """
+    # Decoding runs ahead on its own thread while frames are written out
+    source = ThreadedFrameSource(
+        VideoFrameSource(
+            video_path, window_scale, backend=backend, decode_threads=decode_threads
+        )
+    )
+    temporary_path = proxy_path + ".tmp"
+    frame_count = 0
+    channels = 3
+    with open(temporary_path, "wb") as file:
+        # The header is rewritten once the frame count is known
+        file.write(bytes(PROXY_HEADER.size))
+        while True:
+            ret, frame = source.read()
+            if not ret:
+                break
+            channels = frame.shape[2] if frame.ndim == 3 else 1
+            file.write(np.ascontiguousarray(frame, dtype=np.uint8).data)
+            frame_count += 1
+        file.seek(0)
+        file.write(
+            PROXY_HEADER.pack(
+                PROXY_MAGIC,
+                PROXY_VERSION,
+                channels,
+                source.width,
+                source.height,
+                frame_count,
+                window_scale,
+                bytes.fromhex(video_content_hash(video_path)),
+            )
+        )
+    source.release()
+    os.replace(temporary_path, proxy_path)
+    return frame_count
+
+
+if __name__ == "__main__":
+    from utils.utils import video_window_scale
+
+    parser = argparse.ArgumentParser(
+        description="Decodes a video once at the display scale into a memory mapped proxy both tools read from"
+    )
+    parser.add_argument("input_file", type=str, help="Path to the input video file.")
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="",
+        help="Proxy file, defaults to <video-name>.proxy next to the video",
+    )
+    parser.add_argument(
+        "--window-scale",
+        type=float,
+        default=0,
+        help="Scale to store frames at, defaults to what the tools would use on this screen",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=CAPTURE_BACKENDS,
+        default="cv2",
+        help="Video decoding backend, pyav needs PyAV installed",
+    )
+    parser.add_argument(
+        "--decode-threads",
+        type=int,
+        default=0,
+        help="Threads the codec decodes with, 0 lets FFmpeg pick",
+    )
+    args = parser.parse_args()
+    output = args.output or default_proxy_path(args.input_file)
+    window_scale = args.window_scale or video_window_scale(args.input_file)
+    start_time = time.perf_counter()
+    frame_count = build_proxy(
+        args.input_file, output, window_scale, args.backend, args.decode_threads
+    )
+    elapsed = time.perf_counter() - start_time
+    print(
+        f"Wrote {frame_count} frames at scale {window_scale:.4f} to {output} "
+        f"({os.path.getsize(output) / 1024**2:.0f} MB, {frame_count / max(elapsed, 1e-9):.1f} fps)"
+    )
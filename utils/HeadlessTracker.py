@@ -0,0 +1,267 @@
+"""
+Headless auto tracking of whole videos, over several processes when there are several seeds
+
+Runs the same tracker the VideoAnnotator uses over a video with no window and writes the annotation file,
+so long videos can be pre annotated overnight and only reviewed in the UI
+
+A tracker can only start from a known box (a seed), so the video is split into segments that each start
+on a seed frame: the box given on the command line, the first (or every) V line of a seed annotation file and,
+with a prompt, the detector's best box on each segment boundary.
+Segments are tracked in parallel in a process pool, each one re-seeded at its own boundary.
+Where there is no seed near a boundary, the segment simply keeps going until the next one, so a single seed
+(a box, or the first V line on its own) is always a single segment tracked by one process
+
+Frames are tracked at window_scale of the video, by default at full size up to 1920x1080 (see headless_track_scale),
+and the boxes are written back in the video's own pixels. Nothing here needs a display
+Frames a seed annotation file labels V or I keep its labels, the tracker only fills its S and missing frames
+"""
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+from utils.AnnotationStore import SKIPPED, VISIBLE, AnnotationStore
+from utils.FrameIndex import FrameIndex, IndexedCapture, load_frame_index
+from utils.PromptDetector import PromptDetector
+from utils.Trackers import create_tracker
+from utils.utils import get_scaled_image, scale_boxes
+
+# Frames bigger than this are tracked scaled down to fit, about what a window would show them at
+HEADLESS_MAX_SIZE: Tuple[int, int] = (1920, 1080)
+
+
+def center_to_corner(
+    center_x: int, center_y: int, width: int, height: int
+) -> Tuple[int, int, int, int]:
+    """
+    Inverse of the center computation in VideoAnnotator.onAccept
+    """
+    return (center_x - int(width / 2), center_y - int(height / 2), width, height)
+
+
+def plan_segments(
+    seeds: Dict[int, Tuple[int, int, int, int]], segment_frames: int
+) -> List[Tuple[int, int]]:
+    """
+    Splits the video from the first seed on into segments of at least segment_frames frames,
+    every segment starts at a seed frame, the last one runs until the end of the video (stop of -1)
+    """
+    seed_frames = sorted(seeds)
+    starts: List[int] = [seed_frames[0]]
+    for seed_frame in seed_frames[1:]:
+        if seed_frame - starts[-1] >= segment_frames:
+            starts.append(seed_frame)
+    stops = starts[1:] + [-1]
+    return list(zip(starts, stops))
+
+
+def track_segment(
+    video_path: str,
+    start: int,
+    stop: int,
+    seed_box: Tuple[int, int, int, int],
+    window_scale: float,
+    tracker_name: str = "csrt",
+    index: FrameIndex | None = None,
+) -> Tuple[int, ndarray, ndarray]:
+    """
+    Tracks frames [start, stop) starting from the seed box on the start frame, stop of -1 means the end of the video
+    Returns the start frame, the annotation type codes and the (center x, center y, width, height) boxes
+    """
+    cap = IndexedCapture(video_path, index)
+    if start > 0:
+        cap.seek(start)
+    tracker = create_tracker(tracker_name)
+    types: List[int] = []
+    boxes: List[Tuple[int, int, int, int]] = []
+
+    ret, frame = cap.read()
+    if ret:
+        tracker.init(get_scaled_image(frame, window_scale), seed_box)
+        x, y, width, height = seed_box
+        types.append(VISIBLE)
+        boxes.append((x + int(width / 2), y + int(height / 2), width, height))
+    frame_number = start + 1
+    while ret and (stop < 0 or frame_number < stop):
+        ret, frame = cap.read()
+        if not ret:
+            break
+        ok, bbox = tracker.update(get_scaled_image(frame, window_scale))
+        if ok:
+            x, y, width, height = (int(i) for i in bbox)
+            types.append(VISIBLE)
+            boxes.append((x + int(width / 2), y + int(height / 2), width, height))
+        else:
+            # Lost track, a human has to decide during review
+            types.append(SKIPPED)
+            boxes.append((-1, -1, -1, -1))
+        frame_number += 1
+    cap.release()
+    return (
+        start,
+        np.array(types, dtype=np.uint8),
+        np.array(boxes, dtype=np.int32).reshape(-1, 4),
+    )
+
+
+def run_headless(
+    video_path: str,
+    annotation_path: str,
+    seeds: Dict[int, Tuple[int, int, int, int]],
+    segment_frames: int = 1800,
+    workers: int = 0,
+    window_scale: float = 0,
+    binary: bool = False,
+    tracker_name: str = "csrt",
+    labelled: AnnotationStore | None = None,
+) -> AnnotationStore:
+    """
+    Tracks the whole video from the given seeds (frame number to top left x, y, width and height box)
+    and writes the resulting annotation file, frames before the first seed are written as skipped
+    The V and I frames of labelled (in the video's pixels) are written as they are, the tracker's output only
+    goes to the frames it skipped or doesn't reach
+    With a single worker the segments are tracked in this process, e.g. when it already is a pool's worker
+    """
+    if not seeds:
+        raise ValueError("Headless tracking needs at least one seed box")
+    if window_scale <= 0:
+        window_scale = headless_track_scale(video_path)
+
+    segments = plan_segments(seeds, segment_frames)
+    # Built (or read) once here, every segment start seeks through it
+    index = load_frame_index(video_path)
+    if workers > 1 and len(segments) == 1:
+        print(
+            f"A single seed makes a single segment, the {workers} workers can't split it. "
+            "Seeds at least segment_frames apart (a prompt, or every V line) split the video up"
+        )
+    workers = workers if workers > 0 else (os.cpu_count() or 1)
+    print(
+        f"Tracking {video_path} in {len(segments)} segment(s) with {min(workers, len(segments))} worker(s)"
+    )
+
+    start_time = time.perf_counter()
+    if workers == 1:
+        results = [
+            track_segment(
+                video_path, start, stop, seeds[start], window_scale, tracker_name, index
+            )
+            for start, stop in segments
+        ]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(segments))) as pool:
+            futures = [
+                pool.submit(
+                    track_segment,
+                    video_path,
+                    start,
+                    stop,
+                    seeds[start],
+                    window_scale,
+                    tracker_name,
+                    index,
+                )
+                for start, stop in segments
+            ]
+            results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start_time
+
+    first_seed = segments[0][0]
+    types = np.concatenate(
+        [np.full(first_seed, SKIPPED, dtype=np.uint8)] + [r[1] for r in results]
+    )
+    boxes = np.concatenate(
+        [np.full((first_seed, 4), -1, dtype=np.int32)] + [r[2] for r in results]
+    )
+    # Tracked at window_scale, stored in the video's pixels
+    boxes = scale_boxes(boxes, 1 / window_scale, types == VISIBLE)
+    if labelled is not None:
+        frames = min(len(labelled), len(types))
+        keep = labelled.types[:frames] != SKIPPED
+        types[:frames][keep] = labelled.types[:frames][keep]
+        boxes[:frames][keep] = labelled.boxes[:frames][keep]
+    store = AnnotationStore(types, boxes, scale=1.0)
+    if binary:
+        store.to_binary(annotation_path)
+    else:
+        store.to_text(annotation_path)
+
+    tracked = len(store) - first_seed
+    print(
+        f"Tracked {tracked} frames in {elapsed:.1f}s ({tracked / max(elapsed, 1e-9):.1f} fps), "
+        f"{int(np.count_nonzero(store.visible))} visible, wrote {annotation_path}"
+    )
+    return store
+
+
+def headless_track_scale(video_path: str) -> float:
+    """
+    Scale frames are tracked at when none is given: full size, or down to fit HEADLESS_MAX_SIZE
+    Boxes are stored in the video's pixels, so unlike a window's scale this doesn't depend on the screen
+    """
+    cap = cv2.VideoCapture(video_path)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+    if width <= 0 or height <= 0:
+        return 1.0
+    return min(1.0, HEADLESS_MAX_SIZE[0] / width, HEADLESS_MAX_SIZE[1] / height)
+
+
+def seeds_from_prompt(
+    video_path: str,
+    detector: PromptDetector,
+    segment_frames: int,
+    window_scale: float = 0,
+    threshold: float = 0.1,
+) -> Dict[int, Tuple[int, int, int, int]]:
+    """
+    Runs the prompt detector on every segment boundary frame in batches, boundaries where
+    nothing clears the threshold don't get a seed
+    """
+    if window_scale <= 0:
+        window_scale = headless_track_scale(video_path)
+    cap = IndexedCapture(video_path, load_frame_index(video_path))
+    frame_count = cap.frame_count
+    boundaries: List[int] = []
+    frames: List[ndarray] = []
+    for frame_number in range(0, max(frame_count, 1), max(segment_frames, 1)):
+        cap.seek(frame_number)
+        ret, frame = cap.read()
+        if not ret:
+            break
+        boundaries.append(frame_number)
+        frames.append(get_scaled_image(frame, window_scale))
+    cap.release()
+
+    seeds: Dict[int, Tuple[int, int, int, int]] = {}
+    for frame_number, detections in zip(
+        boundaries, detector.detect(frames, boundaries)
+    ):
+        valid, box, _ = detections.best(threshold)
+        if valid:
+            seeds[frame_number] = box
+    print(f"Prompt found the object on {len(seeds)} of {len(boundaries)} boundaries")
+    return seeds
+
+
+def seeds_from_annotations(
+    store: AnnotationStore, window_scale: float, every_v: bool = False
+) -> Dict[int, Tuple[int, int, int, int]]:
+    """
+    The first V line of an annotation track, or every one with every_v, as top left boxes at window_scale
+    keyed by frame number
+    """
+    store = store.at_scale(window_scale)
+    visible = np.flatnonzero(store.visible)
+    return {
+        int(frame_number): center_to_corner(
+            *(int(i) for i in store.boxes[frame_number])
+        )
+        for frame_number in (visible if every_v else visible[:1])
+    }
@@ -0,0 +1,248 @@
+"""
+Fills skipped frames between two labelled frames by interpolating the box
+
+Only S runs with a V frame on both sides are filled, I frames (and S runs touching one) are left alone since
+the object really wasn't there. Every gap of a track is filled at once with array operations: each skipped frame
+gets the V frames before (a) and after (b) it from running maxima/minima over the frame numbers, and its box is
+interpolated between theirs
+
+linear : straight line between the boxes at a and b
+cubic  : cubic Hermite curve between them, with Catmull-Rom tangents taken from the V frames around a and b,
+         so the motion keeps its speed through the gap instead of changing abruptly at its ends
+
+Filled frames become V records flagged FLAG_INTERPOLATED
+
+GapInterpolator does the same while annotating, for the frames on their way into an Annotator
+"""
+
+import atexit
+from typing import List, Tuple
+
+import numpy as np
+from numpy import ndarray
+
+from utils.AnnotationStore import FLAG_INTERPOLATED, SKIPPED, VISIBLE, AnnotationStore
+from utils.Annotator import Annotator, Record
+
+INTERPOLATION_METHODS: Tuple[str, ...] = ("linear", "cubic")
+
+
+def interpolate_gaps(
+    types: ndarray, boxes: ndarray, method: str = "linear", max_gap: int = 0
+) -> Tuple[ndarray, ndarray]:
+    """
+    Frame numbers of the skipped frames that can be filled and their interpolated
+    (center x, center y, width, height) boxes, gaps longer than max_gap frames are left alone unless it is 0
+    """
+    if method not in INTERPOLATION_METHODS:
+        raise ValueError(
+            f"Unknown interpolation method {method!r}, expected one of {', '.join(INTERPOLATION_METHODS)}"
+        )
+    frame_count = len(types)
+    frame_numbers = np.arange(frame_count)
+    labelled = types != SKIPPED
+    # Closest frame that isn't skipped at or before / at or after every frame
+    before = np.maximum.accumulate(np.where(labelled, frame_numbers, -1))
+    after = np.minimum.accumulate(np.where(labelled, frame_numbers, frame_count)[::-1])[
+        ::-1
+    ]
+    fillable = ~labelled & (before >= 0) & (after < frame_count)
+    if max_gap > 0:
+        fillable &= after - before - 1 <= max_gap
+    frames = np.flatnonzero(fillable)
+    frames = frames[
+        (types[before[frames]] == VISIBLE) & (types[after[frames]] == VISIBLE)
+    ]
+    if len(frames) == 0:
+        return frames, np.zeros((0, 4), dtype=np.int32)
+
+    a, b = before[frames], after[frames]
+    box_a = boxes[a].astype(np.float64)
+    box_b = boxes[b].astype(np.float64)
+    span = (b - a)[:, None].astype(np.float64)
+    t = (frames - a)[:, None] / span
+    if method == "linear":
+        values = box_a + (box_b - box_a) * t
+    else:
+        keyframes = np.flatnonzero(types == VISIBLE)
+        # Only skipped frames lie between a and b, so b is the keyframe right after a
+        position = np.searchsorted(keyframes, a)
+        has_previous = position > 0
+        has_next = position + 2 < len(keyframes)
+        previous = keyframes[np.maximum(position - 1, 0)]
+        following = keyframes[np.minimum(position + 2, len(keyframes) - 1)]
+        secant = (box_b - box_a) / span
+        # Tangents per frame, the secant stands in where there is no keyframe on that side
+        tangent_a = np.where(
+            has_previous[:, None],
+            (box_b - boxes[previous]) / np.maximum(b - previous, 1)[:, None],
+            secant,
+        )
+        tangent_b = np.where(
+            has_next[:, None],
+            (boxes[following] - box_a) / np.maximum(following - a, 1)[:, None],
+            secant,
+        )
+        t2, t3 = t * t, t * t * t
+        values = (
+            (2 * t3 - 3 * t2 + 1) * box_a
+            + (t3 - 2 * t2 + t) * span * tangent_a
+            + (-2 * t3 + 3 * t2) * box_b
+            + (t3 - t2) * span * tangent_b
+        )
+    filled = np.rint(values).astype(np.int32)
+    # A cubic can overshoot, a box never gets smaller than a pixel
+    filled[:, 2:] = np.maximum(filled[:, 2:], 1)
+    return frames, filled
+
+
+def interpolate_track(
+    store: AnnotationStore, method: str = "linear", max_gap: int = 0
+) -> Tuple[AnnotationStore, int]:
+    """
+    A copy of the track with its gaps filled, and how many frames were filled
+    """
+    frames, filled = interpolate_gaps(store.types, store.boxes, method, max_gap)
+    types = np.array(store.types, dtype=np.uint8)
+    boxes = np.array(store.boxes, dtype=np.int32)
+    flags = np.array(store.flags, dtype=np.uint8)
+    types[frames] = VISIBLE
+    boxes[frames] = filled
+    flags[frames] |= FLAG_INTERPOLATED
+    return AnnotationStore(types, boxes, flags, store.scale), len(frames)
+
+
+class GapInterpolator:
+    """
+    Sits in front of an Annotator and fills gaps as they close, so the file stays append only
+    Frames are held back from the moment a track is skipped right after a V record, until every track is labelled
+    again. If a track's gap ends on a V record, its skipped frames are written as interpolated boxes, otherwise
+    as they were. Held frames only reach the file once their gap closes, a crash safe annotator journals them as
+    they are meanwhile (see Annotator.hold_frame), so a crash gives them back as S frames rather than losing them
+    When the annotator continues a file, the interpolation starts from the file's last two frames
+    """
+
+    def __init__(self, annotator: Annotator, method: str = "linear"):
+        if method not in INTERPOLATION_METHODS:
+            raise ValueError(
+                f"Unknown interpolation method {method!r}, expected one of {', '.join(INTERPOLATION_METHODS)}"
+            )
+        self.annotator: Annotator = annotator
+        self.method: str = method
+        self.tracks: int = annotator.tracks
+        # Frames waiting on a gap to close, and the last two written frames for the interpolation to start from
+        self.held: List[List[Record]] = []
+        self.context: List[List[Record]] = self.__file_tail()
+        # Type of every track's last record that wasn't skipped. A file that ends on an S, ends on a gap that was
+        # written as it was, so it isn't continued
+        self.last_labelled: List[str] = [
+            (
+                self.context[-1][track][0]
+                if self.context and self.context[-1][track][0] != "S"
+                else ""
+            )
+            for track in range(self.tracks)
+        ]
+        # Registered after the annotator's, so it runs first and the held frames still make it in
+        atexit.register(self.close)
+
+    @property
+    def existing_records(self) -> int:
+        return self.annotator.existing_records
+
+    def __file_tail(self) -> List[List[Record]]:
+        """
+        The last two frames of the file the annotator continues, at the scale it is handed boxes at
+        """
+        if self.annotator.existing_records == 0:
+            return []
+        self.annotator.flush()
+        path = self.annotator.output_file
+        stores = (
+            AnnotationStore.tracks_from_binary(path, mmap=False)
+            if self.annotator.binary
+            else AnnotationStore.tracks_from_text(path)
+        )
+        if self.annotator.scale > 0:
+            stores = [store.at_scale(self.annotator.scale) for store in stores]
+        frame_count = len(stores[0])
+        return [
+            [
+                (
+                    chr(store.types[frame]),
+                    *(int(value) for value in store.boxes[frame]),
+                    int(store.flags[frame]),
+                )
+                for store in stores
+            ]
+            for frame in range(max(0, frame_count - 2), frame_count)
+        ]
+
+    def write_bounding_box(
+        self, x_center: int, y_center: int, width: int, height: int
+    ) -> None:
+        self.write_frame([("V", x_center, y_center, width, height)])
+
+    def write_skipped(self) -> None:
+        self.write_frame([("S", -1, -1, -1, -1)])
+
+    def write_invisible(self) -> None:
+        self.write_frame([("I", -1, -1, -1, -1)])
+
+    def write_frame(self, records: List[Record]) -> None:
+        """
+        Holds one frame's records while a gap is open, otherwise hands them and every held frame to the annotator
+        """
+        if len(records) != self.tracks:
+            raise ValueError(
+                f"Expected {self.tracks} record(s) per frame, got {len(records)}"
+            )
+        records = [
+            tuple(track_record) if len(track_record) == 6 else (*track_record, 0)
+            for track_record in records
+        ]
+        for track, track_record in enumerate(records):
+            if track_record[0] != "S":
+                self.last_labelled[track] = track_record[0]
+        self.held.append(records)
+        if any(
+            track_record[0] == "S" and self.last_labelled[track] == "V"
+            for track, track_record in enumerate(records)
+        ):
+            # A gap is open, wait for the frame that closes it
+            self.annotator.hold_frame(records)
+            return
+        self.annotator.write_frames(self.__interpolate_held())
+
+    def __interpolate_held(self) -> List[List[Record]]:
+        """
+        Fills the closed gaps of the held frames, returns them and starts holding afresh
+        """
+        frames = self.context + self.held
+        for track in range(self.tracks):
+            types = np.array([ord(frame[track][0]) for frame in frames], dtype=np.uint8)
+            boxes = np.array(
+                [frame[track][1:5] for frame in frames], dtype=np.int32
+            ).reshape(-1, 4)
+            filled_frames, filled_boxes = interpolate_gaps(types, boxes, self.method)
+            for frame_number, box in zip(filled_frames, filled_boxes.tolist()):
+                flags = frames[frame_number][track][5] | FLAG_INTERPOLATED
+                frames[frame_number][track] = ("V", *box, flags)
+        held = frames[len(self.context) :]
+        # The frame before a gap and the one before that give the cubic its starting tangent
+        self.context = frames[-2:]
+        self.held = []
+        return held
+
+    def flush(self) -> None:
+        self.annotator.flush()
+
+    def close(self) -> None:
+        """
+        Writes the frames of a gap that never closed as they were and closes the annotator, safe to call more than once
+        Interpolate_Annotations.py can still fill such a gap later
+        """
+        atexit.unregister(self.close)
+        self.annotator.write_frames(self.held)
+        self.held = []
+        self.annotator.close()
@@ -0,0 +1,262 @@
+"""
+Speculative look-ahead tracking for the VideoAnnotator
+
+While the UI is blocked waiting on the user's key, a worker thread reads the next frames from the
+frame source (decoded and scaled, or straight from a proxy) and keeps running the tracker on them, so accepting a prediction shows the next one instantly
+
+A tracker only ever changes course when it is re-initialised (labelling, fixing or accepting a
+prompt prediction). Skipping, marking invisible or accepting all keep the same tracker state, so
+speculative results stay valid until a reinit, which throws them away and tracks again from the new box
+
+Several objects can be tracked at once, one tracker per track. Every frame is decoded and scaled once and
+handed to all of them, optionally updating them in parallel on a thread pool (OpenCV releases the GIL
+while tracking). Each track keeps its own results, so relabelling one object leaves the others' alone
+
+With a track_ratio below 1 the trackers run on a smaller copy of every frame, which is much cheaper for CSRT on
+large displays. Boxes go in and come out in the displayed frame's coordinates either way
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+import cv2
+from numpy import dtype, floating, integer, ndarray
+
+from utils.FrameSource import FrameSource
+from utils.Profiler import NullProfiler, Profiler
+from utils.utils import get_scaled_image, scale_boxes
+from utils.Trackers import Tracker
+
+Frame = cv2.Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]]
+Prediction = Tuple[bool, Tuple[int, int, int, int]]
+
+
+class LookaheadTracker:
+    def __init__(
+        self,
+        source: FrameSource,
+        trackers: List[Tracker],
+        first_frame: Frame,
+        lookahead: int = 8,
+        start_frame: int = 0,
+        trackers_ready: List[bool] | None = None,
+        profiler: Profiler = NullProfiler(),
+        track_workers: int = 1,
+        track_ratio: float = 1.0,
+    ):
+        """
+        source should be positioned right after first_frame, which is frame start_frame and already scaled
+        trackers_ready marks trackers that have already been initialised and followed their object up to the
+        frame before start_frame, as when resuming a session
+        track_workers above 1 updates the trackers of a frame in parallel
+        track_ratio is the size of the frames the trackers see relative to the source's frames
+        """
+        self.source: FrameSource = source
+        self.trackers: List[Tracker] = trackers
+        self.lookahead: int = max(0, lookahead)
+        self.profiler: Profiler = profiler
+        self.track_ratio: float = track_ratio
+        self.pool: ThreadPoolExecutor | None = (
+            ThreadPoolExecutor(max_workers=track_workers)
+            if track_workers > 1 and len(trackers) > 1
+            else None
+        )
+
+        track_count = len(trackers)
+        self.frames: Dict[int, Frame] = {start_frame: first_frame}
+        self.results: List[Dict[int, Prediction]] = [{} for _ in range(track_count)]
+        self.current: int = start_frame
+        self.decoded_upto: int = start_frame
+        self.end_of_video: bool = False
+        self.tracking: List[bool] = (
+            list(trackers_ready) if trackers_ready else [False] * track_count
+        )
+        # Last frame each tracker has seen for the current generation of its results
+        self.tracked_upto: List[int] = [start_frame - 1] * track_count
+        self.pending_inits: Dict[int, Tuple[int, Frame, Tuple[int, int, int, int]]] = {}
+        self.generation: List[int] = [0] * track_count
+        self.running: bool = True
+        self.error: BaseException | None = None
+
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.__worker_loop, daemon=True)
+        self.thread.start()
+
+    def get(self, frame_number: int) -> Tuple[Frame | None, List[Prediction | None]]:
+        """
+        Returns the scaled frame and, for every track, whether tracking succeeded and the predicted box,
+        or None for tracks that haven't been initialised. Blocks only if the worker hasn't got there yet
+        Frame is None past the end of the video
+        """
+        with self.profiler.stage("lookahead_wait", frame_number), self.condition:
+            self.current = frame_number
+            for stale in [n for n in self.frames if n < frame_number]:
+                del self.frames[stale]
+            for results in self.results:
+                for stale in [n for n in results if n < frame_number]:
+                    del results[stale]
+            self.condition.notify_all()
+            while True:
+                if self.error is not None:
+                    raise RuntimeError(
+                        "Look-ahead tracking worker failed"
+                    ) from self.error
+                if frame_number in self.frames:
+                    if all(
+                        not tracking or frame_number in results
+                        for tracking, results in zip(self.tracking, self.results)
+                    ):
+                        return self.frames[frame_number], [
+                            results[frame_number] if tracking else None
+                            for tracking, results in zip(self.tracking, self.results)
+                        ]
+                elif self.end_of_video and frame_number > self.decoded_upto:
+                    return None, [None] * len(self.trackers)
+                self.condition.wait()
+
+    def reinit(
+        self,
+        frame_number: int,
+        frame: Frame,
+        bbox: Tuple[int, int, int, int],
+        track: int = 0,
+    ) -> None:
+        """
+        Re-initialises a track's tracker on the given frame, every speculative result of that track
+        is discarded and tracking restarts from the new box
+        """
+        with self.condition:
+            self.pending_inits[track] = (frame_number, frame, bbox)
+            self.generation[track] += 1
+            self.results[track].clear()
+            self.tracking[track] = True
+            self.condition.notify_all()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def __worker_loop(self) -> None:
+        try:
+            self.__work()
+        except BaseException as error:
+            # Hand the failure over to the UI thread instead of leaving it waiting forever
+            with self.condition:
+                self.error = error
+                self.running = False
+                self.condition.notify_all()
+
+    def __work(self) -> None:
+        while True:
+            with self.condition:
+                while self.running and not self.__has_work():
+                    self.condition.wait()
+                if not self.running:
+                    return
+                init = None
+                tracks: List[int] = []
+                if self.pending_inits:
+                    track, init = self.pending_inits.popitem()
+                    generation = self.generation[track]
+                else:
+                    trackable = self.__trackable()
+                    if trackable:
+                        # Trackers waiting on the same frame are updated together
+                        track_number = min(self.tracked_upto[k] + 1 for k in trackable)
+                        tracks = [
+                            k
+                            for k in trackable
+                            if self.tracked_upto[k] + 1 == track_number
+                        ]
+                        generations = [self.generation[k] for k in tracks]
+                        track_frame = self.frames[track_number]
+
+            # The expensive work happens outside of the lock, so the UI can keep reading results
+            if init is not None:
+                init_number, init_frame, init_bbox = init
+                with self.profiler.stage("track_init", init_number):
+                    self.trackers[track].init(
+                        self.__track_frame(init_frame), self.__to_track(init_bbox)
+                    )
+                with self.condition:
+                    if generation == self.generation[track]:
+                        # The labelled box is the track's result on the frame it was labelled on
+                        self.results[track][init_number] = (True, tuple(init_bbox))
+                        self.tracked_upto[track] = init_number
+                        self.condition.notify_all()
+            elif tracks:
+                track_frame = self.__track_frame(track_frame)
+                with self.profiler.stage("track", track_number):
+                    if self.pool is not None and len(tracks) > 1:
+                        predictions = list(
+                            self.pool.map(
+                                lambda k: self.trackers[k].update(track_frame), tracks
+                            )
+                        )
+                    else:
+                        predictions = [
+                            self.trackers[k].update(track_frame) for k in tracks
+                        ]
+                # Some backends report sub pixel boxes, annotations are whole pixels
+                boxes = scale_boxes(
+                    [bbox for _, bbox in predictions], 1 / self.track_ratio
+                ).tolist()
+                with self.condition:
+                    for k, generation, (ok, _), bbox in zip(
+                        tracks, generations, predictions, boxes
+                    ):
+                        if generation == self.generation[k]:
+                            self.results[k][track_number] = (ok, tuple(bbox))
+                            self.tracked_upto[k] = track_number
+                    self.condition.notify_all()
+            else:
+                self.__decode_next()
+
+    def __track_frame(self, frame: Frame) -> Frame:
+        if self.track_ratio == 1:
+            return frame
+        with self.profiler.stage("track_scale"):
+            return get_scaled_image(frame, self.track_ratio)
+
+    def __to_track(self, bbox: Tuple[int, int, int, int]) -> Tuple[int, int, int, int]:
+        if self.track_ratio == 1:
+            return bbox
+        return tuple(scale_boxes([bbox], self.track_ratio)[0].tolist())
+
+    def __has_work(self) -> bool:
+        return (
+            bool(self.pending_inits) or bool(self.__trackable()) or self.__can_decode()
+        )
+
+    def __trackable(self) -> List[int]:
+        trackable: List[int] = []
+        for track, tracking in enumerate(self.tracking):
+            next_track = self.tracked_upto[track] + 1
+            if (
+                tracking
+                and next_track <= self.current + self.lookahead
+                and next_track in self.frames
+            ):
+                trackable.append(track)
+        return trackable
+
+    def __can_decode(self) -> bool:
+        return (
+            not self.end_of_video and self.decoded_upto < self.current + self.lookahead
+        )
+
+    def __decode_next(self) -> None:
+        # Only this thread reads the source, it times its own decode and scale stages
+        ret, frame = self.source.read()
+        with self.condition:
+            if ret:
+                self.decoded_upto += 1
+                self.frames[self.decoded_upto] = frame
+            else:
+                self.end_of_video = True
+            self.condition.notify_all()
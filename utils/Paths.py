@@ -0,0 +1,84 @@
+"""
+Where annotation files and their videos live: the file names the tools derive from a video, and finding annotation
+files under directories and the video an annotation file belongs to
+
+A video's own annotations are <video-name>.annotations (.annotations.bin in the binary format) next to it. Headless
+and batch tracking write <video-name>.tracked.annotations instead, so they never replace what a human labelled
+"""
+
+import os
+from typing import List, Tuple
+
+VIDEO_EXTENSIONS: Tuple[str, ...] = (".mp4", ".avi", ".mov", ".mkv", ".m4v", ".webm")
+# Between the video's name and the extension of annotations written by the tracker rather than a human
+TRACKED_SUFFIX: str = ".tracked"
+
+
+def annotation_stem(annotation_path: str) -> str:
+    name = os.path.basename(annotation_path)
+    return name.removesuffix(".bin").removesuffix(".annotations")
+
+
+def video_stem(annotation_path: str) -> str:
+    """
+    Name of the video an annotation file belongs to, without its extension, for tracked files too
+    """
+    return annotation_stem(annotation_path).removesuffix(TRACKED_SUFFIX)
+
+
+def default_annotation_path(video_path: str, binary: bool = False) -> str:
+    """
+    if no annotation path is provided, put it in same location as video
+    """
+    full_video_name: str = os.path.basename(video_path)
+    video_name: str = os.path.splitext(full_video_name)[0]
+    directory_path = os.path.dirname(video_path)
+    # Add the ".annotations" extension, binary files get the sidecar ".annotations.bin" one
+    video_name += ".annotations.bin" if binary else ".annotations"
+    return os.path.join(directory_path, video_name)
+
+
+def tracked_annotation_path(annotation_path: str, binary: bool = False) -> str:
+    """
+    Where headless tracking writes by default, next to the given annotation file (the seed or the video's own)
+    """
+    return os.path.join(
+        os.path.dirname(annotation_path),
+        annotation_stem(annotation_path)
+        + TRACKED_SUFFIX
+        + ".annotations"
+        + (".bin" if binary else ""),
+    )
+
+
+def find_annotation_files(paths: List[str]) -> List[str]:
+    """
+    Every annotation file in the given files and directories (recursively), binary sidecars of
+    text files are skipped since loading the text file already prefers them
+    """
+    found: List[str] = []
+    for path in paths:
+        if os.path.isfile(path):
+            found.append(path)
+            continue
+        for directory, _, files in os.walk(path):
+            for name in sorted(files):
+                if name.endswith(".annotations") or (
+                    name.endswith(".annotations.bin")
+                    and name.removesuffix(".bin") not in files
+                ):
+                    found.append(os.path.join(directory, name))
+    return found
+
+
+def find_video(annotation_path: str, video_dirs: List[str]) -> str:
+    """
+    The video an annotation file belongs to, empty if there is none
+    """
+    stem = video_stem(annotation_path)
+    for directory in [os.path.dirname(annotation_path)] + video_dirs:
+        for extension in VIDEO_EXTENSIONS:
+            video_path = os.path.join(directory, stem + extension)
+            if os.path.exists(video_path):
+                return video_path
+    return ""
@@ -0,0 +1,120 @@
+"""
+Per stage latency instrumentation for the frame loops
+
+Stages (decode, scale, track, prompt, overlay, imshow, write, ...) are timed with perf_counter around
+the code that runs them, from whichever thread runs them, and attributed to the frame they were for.
+Time spent in waitKey is never inside a stage, so the user's thinking time doesn't show up
+
+When profiling is off the tools use NullProfiler, whose stage() hands back one shared no-op context
+"""
+
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Iterator, List
+
+import numpy as np
+
+# Histogram bucket edges in milliseconds, log spaced from 10 microseconds to 10 seconds
+HISTOGRAM_EDGES_MS: List[float] = np.logspace(-2, 4, 25).tolist()
+
+
+class StageProfiler:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        # frame number to stage to seconds spent on that frame
+        self.frames: Dict[int, Dict[str, float]] = defaultdict(
+            lambda: defaultdict(float)
+        )
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str, frame_number: int = -1) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, frame_number)
+
+    def add(self, name: str, seconds: float, frame_number: int = -1) -> None:
+        with self.lock:
+            self.samples[name].append(seconds)
+            if frame_number >= 0:
+                self.frames[frame_number][name] += seconds
+
+    def report(self) -> Dict:
+        """
+        Percentiles and a histogram per stage, plus every frame's per stage timings, all in milliseconds
+        """
+        with self.lock:
+            stages: Dict[str, Dict] = {}
+            for name, samples in self.samples.items():
+                samples_ms = np.array(samples) * 1000
+                p50, p95, p99 = np.percentile(samples_ms, [50, 95, 99])
+                counts, _ = np.histogram(
+                    np.clip(samples_ms, HISTOGRAM_EDGES_MS[0], HISTOGRAM_EDGES_MS[-1]),
+                    bins=HISTOGRAM_EDGES_MS,
+                )
+                stages[name] = {
+                    "count": len(samples),
+                    "total_ms": float(samples_ms.sum()),
+                    "mean_ms": float(samples_ms.mean()),
+                    "p50_ms": float(p50),
+                    "p95_ms": float(p95),
+                    "p99_ms": float(p99),
+                    "max_ms": float(samples_ms.max()),
+                    "histogram": {
+                        "edges_ms": HISTOGRAM_EDGES_MS,
+                        "counts": counts.tolist(),
+                    },
+                }
+            frames = {
+                str(frame_number): {
+                    name: seconds * 1000 for name, seconds in timings.items()
+                }
+                for frame_number, timings in sorted(self.frames.items())
+            }
+        return {"stages": stages, "frames": frames}
+
+    def write(self, output_path: str) -> None:
+        report = self.report()
+        with open(output_path, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"{'stage':<18} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        for name, stage in sorted(
+            report["stages"].items(), key=lambda item: -item[1]["total_ms"]
+        ):
+            print(
+                f"{name:<18} {stage['count']:>7} {stage['p50_ms']:9.2f} "
+                f"{stage['p95_ms']:9.2f} {stage['p99_ms']:9.2f}"
+            )
+        print(f"Wrote profile to {output_path}")
+
+
+class NullProfiler:
+    """
+    Same interface as StageProfiler, costs next to nothing
+    """
+
+    null_stage = nullcontext()
+
+    def stage(self, name: str, frame_number: int = -1) -> nullcontext:
+        return self.null_stage
+
+    def add(self, name: str, seconds: float, frame_number: int = -1) -> None:
+        pass
+
+    def write(self, output_path: str) -> None:
+        pass
+
+
+Profiler = StageProfiler | NullProfiler
+
+
+def create_profiler(output_path: str = "") -> Profiler:
+    """
+    A real profiler only when there is somewhere to write its report
+    """
+    return StageProfiler() if output_path else NullProfiler()
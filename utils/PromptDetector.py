@@ -0,0 +1,218 @@
+"""
+Prompt driven object detection with OwlViT
+
+The prompt never changes during a session, so it is encoded once and its query embedding is reused.
+Every detection after that is an image only forward pass, run on batches of frames with gradient
+tracking off and a configurable number of threads, in one of the backends of utils.DetectorBackends
+(float32 PyTorch, int8 quantized PyTorch or ONNX Runtime)
+
+Crops of a frame can be detected at a smaller input size than the model's own, the position embeddings are
+interpolated to the smaller grid of patches, which makes a small crop a fraction of the cost of a full frame
+
+torch and transformers take seconds to import, so they are only imported once a detector is created
+"""
+
+from dataclasses import dataclass
+from typing import Any, Dict, List, Sequence, Tuple
+
+import cv2
+import numpy as np
+from numpy import dtype, floating, integer, ndarray
+
+DEFAULT_MODEL_ID: str = "google/owlvit-base-patch32"
+# Smallest side a crop is fed to the model at, in pixels
+MIN_CROP_INPUT: int = 256
+DETECTOR_BACKENDS: Tuple[str, ...] = ("eager", "int8", "onnx")
+
+
+@dataclass
+class Detections:
+    """
+    Every box the model proposed for one frame, as (x0, y0, x1, y1) pixel corners, with its score
+    """
+
+    boxes: ndarray
+    scores: ndarray
+
+    def best(
+        self, threshold: float = 0.1
+    ) -> Tuple[bool, Tuple[int, int, int, int], float]:
+        """
+        Highest scoring box as (x, y, width, height), if it clears the threshold
+        """
+        if len(self.scores) == 0:
+            return False, (-1, -1, -1, -1), 0.0
+        best_idx = int(np.argmax(self.scores))
+        score = float(self.scores[best_idx])
+        if score <= threshold:
+            return False, (-1, -1, -1, -1), score
+        x0, y0, x1, y1 = (int(i) for i in self.boxes[best_idx])
+        return True, (x0, y0, x1 - x0, y1 - y0), score
+
+    def above(self, threshold: float) -> "Detections":
+        keep = self.scores > threshold
+        return Detections(self.boxes[keep], self.scores[keep])
+
+
+class PromptDetector:
+    def __init__(
+        self,
+        prompt_str: str,
+        model_id: str = DEFAULT_MODEL_ID,
+        batch_size: int = 4,
+        num_threads: int = 0,
+        cache: "DetectionCache | None" = None,
+        backend: str = "eager",
+        model_cache_dir: str = "",
+    ):
+        """
+        With a DetectionCache, frames that come with a frame number are looked up before running the model
+        backend picks how the frames go through the model, converted models are kept in model_cache_dir
+        (by default ~/.cache/video-annotation-tool). num_threads caps the threads of torch and ONNX Runtime alike
+        """
+        if backend not in DETECTOR_BACKENDS:
+            raise ValueError(
+                f"Unknown detector backend {backend!r}, choose one of {', '.join(DETECTOR_BACKENDS)}"
+            )
+        import torch
+        from transformers import OwlViTForObjectDetection, OwlViTProcessor
+
+        from utils.DetectorBackends import create_image_backend, load_model
+
+        self.prompt_str: str = prompt_str
+        self.model_id: str = model_id
+        self.backend: str = backend
+        # Backends don't detect exactly alike, so their detections are cached apart. Eager keeps the plain model id
+        # so caches written before there were backends stay valid
+        self.cache_model_id: str = (
+            model_id if backend == "eager" else f"{model_id}:{backend}"
+        )
+        self.batch_size: int = max(1, batch_size)
+        self.cache = cache
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+        self.processor: OwlViTProcessor = OwlViTProcessor.from_pretrained(model_id)
+        self.model: OwlViTForObjectDetection = load_model(
+            model_id, backend, model_cache_dir
+        )
+        self.image_backend = create_image_backend(
+            backend, self.model, model_id, model_cache_dir, num_threads
+        )
+        self.query_embeds: torch.Tensor = self.encode_prompt(prompt_str)
+
+    def encode_prompt(self, prompt_str: str) -> "torch.Tensor":
+        """
+        Text embedding of the prompt, shaped (1, 1, dim) to be broadcast over a batch of frames
+        """
+        import torch
+
+        text_inputs = self.processor(text=[prompt_str], return_tensors="pt")
+        with torch.inference_mode():
+            text_features = self.model.owlvit.get_text_features(
+                input_ids=text_inputs["input_ids"],
+                attention_mask=text_inputs["attention_mask"],
+            )
+        if not isinstance(text_features, torch.Tensor):
+            # Newer transformers versions return the projected embedding as the pooler output
+            text_features = text_features.pooler_output
+        return text_features.reshape(1, 1, -1)
+
+    def detect(
+        self,
+        frames: List[cv2.Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]]],
+        frame_numbers: Sequence[int] | None = None,
+    ) -> List[Detections]:
+        """
+        Runs the model over the given BGR frames in batches, returns every frame's detections
+        When frame numbers are given and there is a cache, only frames missing from it go through the model
+        """
+        detections: List[Detections | None] = [None] * len(frames)
+        if self.cache is not None and frame_numbers is not None:
+            for idx, (frame, frame_number) in enumerate(zip(frames, frame_numbers)):
+                detections[idx] = self.cache.get(
+                    frame_number, self.prompt_str, self.cache_model_id, frame.shape
+                )
+        missing = [idx for idx, detection in enumerate(detections) if detection is None]
+        for batch_start in range(0, len(missing), self.batch_size):
+            batch = missing[batch_start : batch_start + self.batch_size]
+            for idx, detection in zip(
+                batch, self.__detect_batch([frames[idx] for idx in batch])
+            ):
+                detections[idx] = detection
+                if self.cache is not None and frame_numbers is not None:
+                    self.cache.put(
+                        frame_numbers[idx],
+                        self.prompt_str,
+                        self.cache_model_id,
+                        frames[idx].shape,
+                        detection,
+                    )
+        return detections
+
+    def detect_regions(
+        self,
+        frame: cv2.Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]],
+        regions: Sequence[Tuple[int, int, int, int]],
+    ) -> List[Detections]:
+        """
+        Runs the model over (x0, y0, x1, y1) crops of one frame, returns each crop's detections in the frame's pixels
+        Each crop goes in at its own size rounded up to whole patches (at least MIN_CROP_INPUT, at most the model's
+        input size), crops of the same input size share a forward pass. Crops are never cached
+        """
+        patch_size = self.model.config.vision_config.patch_size
+        native_size = self.model.config.vision_config.image_size
+        crops: Dict[int, List[int]] = {}
+        for idx, (x0, y0, x1, y1) in enumerate(regions):
+            side = -(-max(x1 - x0, y1 - y0, MIN_CROP_INPUT) // patch_size) * patch_size
+            crops.setdefault(min(side, native_size), []).append(idx)
+        detections: List[Detections | None] = [None] * len(regions)
+        for input_size, indices in crops.items():
+            for batch_start in range(0, len(indices), self.batch_size):
+                batch = indices[batch_start : batch_start + self.batch_size]
+                found = self.__detect_batch(
+                    [
+                        frame[
+                            regions[idx][1] : regions[idx][3],
+                            regions[idx][0] : regions[idx][2],
+                        ]
+                        for idx in batch
+                    ],
+                    input_size,
+                )
+                for idx, detection in zip(batch, found):
+                    x0, y0 = regions[idx][:2]
+                    offset = np.array([x0, y0, x0, y0], dtype=np.float32)
+                    detections[idx] = Detections(
+                        detection.boxes + offset, detection.scores
+                    )
+        return detections
+
+    def __detect_batch(
+        self,
+        frames: List[cv2.Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]]],
+        input_size: int = 0,
+    ) -> List[Detections]:
+        """
+        input_size other than 0 resizes the frames to input_size x input_size instead of the model's own input size
+        """
+        images = [cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) for frame in frames]
+        if input_size > 0:
+            size = {"height": input_size, "width": input_size}
+            pixel_values = self.processor.image_processor(
+                images=images, size=size, crop_size=size, return_tensors="pt"
+            )["pixel_values"]
+        else:
+            pixel_values = self.processor(images=images, return_tensors="pt")[
+                "pixel_values"
+            ]
+        scores, pred_boxes = self.image_backend(pixel_values, self.query_embeds)
+        centers, sizes = pred_boxes[..., :2], pred_boxes[..., 2:]
+        corners = np.concatenate([centers - sizes / 2, centers + sizes / 2], axis=-1)
+        detections: List[Detections] = []
+        for frame, frame_scores, frame_corners in zip(frames, scores, corners):
+            frame_height, frame_width = frame.shape[:2]
+            scale = np.array(
+                [frame_width, frame_height, frame_width, frame_height], dtype=np.float32
+            )
+            detections.append(Detections(frame_corners * scale, frame_scores))
+        return detections
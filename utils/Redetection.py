@@ -0,0 +1,157 @@
+"""
+Finds a lost object again with the prompt model, searching around where it was heading before the whole frame
+
+When the tracker loses the object, its last known box is moved along its recent motion to where the object should
+be by now, and the model looks at a crop around that, a few times the box's size. When nothing in the crop clears
+the threshold the crop grows by a constant factor, up to the whole frame, which is looked up in the detection
+cache like any other full frame detection
+
+Crops go through the model at their own size rather than its full input size (see PromptDetector.detect_regions),
+so an object found close to where it was lost costs a fraction of a full frame pass
+
+Once a search came up empty on the whole frame, the object is most likely out of view, so searching again on every
+following frame would only stall the window. Searches stay off until a box is confirmed again (see gave_up)
+"""
+
+import math
+from collections import deque
+from typing import Any, Deque, List, Sequence, Tuple
+
+import cv2
+from numpy import dtype, floating, integer, ndarray
+
+from utils.PromptDetector import PromptDetector
+
+Box = Tuple[int, int, int, int]
+Frame = cv2.Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]]
+
+# A crop covering at least this much of the frame costs about as much as the frame itself, so the frame is searched
+FULL_FRAME_FRACTION: float = 0.5
+
+
+def estimate_velocity(history: Sequence[Tuple[int, Box]]) -> Tuple[float, float]:
+    """
+    Average motion of the box center in pixels per frame, over (frame number, top left box) pairs in frame order
+    """
+    if len(history) < 2:
+        return 0.0, 0.0
+    (first_frame, first_box), (last_frame, last_box) = history[0], history[-1]
+    frames = last_frame - first_frame
+    if frames <= 0:
+        return 0.0, 0.0
+    return (
+        (last_box[0] + last_box[2] / 2 - first_box[0] - first_box[2] / 2) / frames,
+        (last_box[1] + last_box[3] / 2 - first_box[1] - first_box[3] / 2) / frames,
+    )
+
+
+def search_regions(
+    box: Box,
+    velocity: Tuple[float, float],
+    frames_since: int,
+    frame_width: int,
+    frame_height: int,
+    margin: float = 3.0,
+    growth: float = 2.0,
+) -> List[Box]:
+    """
+    The (x0, y0, x1, y1) crops to search, smallest first, for an object last seen at the top left box
+    (x, y, width, height) frames_since frames ago, moving by velocity pixels per frame
+    The first crop is centered on where the motion puts the object and is margin times the box's size plus the
+    distance it was expected to move, every further one growth times bigger. The last one is the whole frame
+    """
+    x, y, width, height = box
+    move_x, move_y = velocity[0] * frames_since, velocity[1] * frames_since
+    center_x = x + width / 2 + move_x
+    center_y = y + height / 2 + move_y
+    half_width = (max(width, 1) * margin + abs(move_x)) / 2
+    half_height = (max(height, 1) * margin + abs(move_y)) / 2
+    regions: List[Box] = []
+    while True:
+        x0 = max(0, int(center_x - half_width))
+        y0 = max(0, int(center_y - half_height))
+        x1 = min(frame_width, math.ceil(center_x + half_width))
+        y1 = min(frame_height, math.ceil(center_y + half_height))
+        if (max(x1 - x0, 0) * max(y1 - y0, 0)) >= (
+            FULL_FRAME_FRACTION * frame_width * frame_height
+        ) or (half_width >= frame_width and half_height >= frame_height):
+            break
+        # A crop the motion pushed off the frame is empty, the bigger ones after it may not be
+        if x1 > x0 and y1 > y0:
+            regions.append((x0, y0, x1, y1))
+        half_width *= growth
+        half_height *= growth
+    regions.append((0, 0, frame_width, frame_height))
+    return regions
+
+
+class RegionRedetector:
+    """
+    Remembers the last few confirmed boxes of a track and searches for the object from there once it is lost
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.3,
+        margin: float = 3.0,
+        growth: float = 2.0,
+        history: int = 8,
+    ):
+        self.threshold: float = threshold
+        self.margin: float = margin
+        self.growth: float = growth
+        self.history: Deque[Tuple[int, Box]] = deque(maxlen=max(2, history))
+        # Set when a search found nothing on the whole frame, cleared by the next confirmed box
+        self.gave_up: bool = False
+
+    def remember(self, frame_number: int, box: Box) -> None:
+        """
+        Records a confirmed top left box, boxes from before an earlier frame would fake the motion so they are dropped
+        """
+        if self.history and frame_number <= self.history[-1][0]:
+            self.history.clear()
+        self.history.append((frame_number, box))
+        self.gave_up = False
+
+    def find(
+        self, detector: PromptDetector, frame: Frame, frame_number: int
+    ) -> Tuple[bool, Box, float]:
+        """
+        Searches the frame step by step, returns whether the object was found above the threshold, its top left box
+        (clipped to the frame) and score. Without a remembered box the whole frame is searched straight away
+        Finding nothing on the whole frame sets gave_up
+        """
+        frame_height, frame_width = frame.shape[:2]
+        regions: List[Box] = [(0, 0, frame_width, frame_height)]
+        if self.history:
+            last_frame, last_box = self.history[-1]
+            regions = search_regions(
+                last_box,
+                estimate_velocity(self.history),
+                frame_number - last_frame,
+                frame_width,
+                frame_height,
+                self.margin,
+                self.growth,
+            )
+        for region in regions[:-1]:
+            valid, box, score = detector.detect_regions(frame, [region])[0].best(
+                threshold=self.threshold
+            )
+            if valid:
+                return True, self.__clip(box, frame_width, frame_height), score
+        # The whole frame goes through the cache, as the prompt's own detections do
+        valid, box, score = detector.detect([frame], [frame_number])[0].best(
+            threshold=self.threshold
+        )
+        if valid:
+            return True, self.__clip(box, frame_width, frame_height), score
+        self.gave_up = True
+        return False, box, score
+
+    @staticmethod
+    def __clip(box: Box, frame_width: int, frame_height: int) -> Box:
+        x, y, width, height = box
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(frame_width, x + width), min(frame_height, y + height)
+        return x0, y0, max(1, x1 - x0), max(1, y1 - y0)
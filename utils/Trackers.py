@@ -0,0 +1,149 @@
+"""
+Selectable single object trackers
+
+Every backend has the cv2.Tracker interface, init(frame, box) and update(frame) -> (ok, box)
+with boxes as top left x, y, width and height, so the annotator, look-ahead and headless tracking
+don't care which one they drive
+
+csrt   : most accurate of the OpenCV trackers, but also one of the slowest
+kcf    : much faster, handles little scale change
+mosse  : fastest correlation filter, from the contrib legacy module
+mil    : robust to partial occlusion, slow
+lk     : sparse Lucas-Kanade optical flow on corners inside the box, very fast on textured objects
+"""
+
+from typing import Any, Callable, Dict, Tuple
+
+import cv2
+import numpy as np
+from numpy import dtype, floating, integer, ndarray
+
+Frame = cv2.Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]]
+
+
+class OpticalFlowTracker:
+    """
+    Tracks corners found inside the box with pyramidal Lucas-Kanade, checked forwards and backwards,
+    and moves (and scales) the box by the median motion of the corners that survived, like MedianFlow
+    """
+
+    def __init__(
+        self,
+        max_corners: int = 100,
+        min_points: int = 8,
+        max_fb_error: float = 1.0,
+    ):
+        self.max_corners: int = max_corners
+        self.min_points: int = min_points
+        self.max_fb_error: float = max_fb_error
+        self.lk_params: Dict[str, Any] = dict(
+            winSize=(15, 15),
+            maxLevel=3,
+            criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03),
+        )
+        self.previous: ndarray | None = None
+        self.points: ndarray | None = None
+        self.box: Tuple[float, float, float, float] = (0, 0, 0, 0)
+
+    def init(self, frame: Frame, box: Tuple[int, int, int, int]) -> None:
+        self.previous = self.__gray(frame)
+        self.box = tuple(float(i) for i in box)
+        self.points = self.__find_points(self.previous, self.box)
+
+    def update(self, frame: Frame) -> Tuple[bool, Tuple[int, int, int, int]]:
+        gray = self.__gray(frame)
+        if self.points is None or len(self.points) < self.min_points:
+            # Too little texture left in the box to follow it, look for fresh corners where it last was
+            self.points = self.__find_points(self.previous, self.box)
+            if self.points is None or len(self.points) < self.min_points:
+                self.previous = gray
+                return False, (-1, -1, -1, -1)
+
+        forward, status, _ = cv2.calcOpticalFlowPyrLK(
+            self.previous, gray, self.points, None, **self.lk_params
+        )
+        backward, back_status, _ = cv2.calcOpticalFlowPyrLK(
+            gray, self.previous, forward, None, **self.lk_params
+        )
+        fb_error = np.linalg.norm(self.points - backward, axis=-1).reshape(-1)
+        good = (
+            (status.reshape(-1) == 1)
+            & (back_status.reshape(-1) == 1)
+            & (fb_error <= self.max_fb_error)
+        )
+        self.previous = gray
+        if np.count_nonzero(good) < self.min_points:
+            self.points = None
+            return False, (-1, -1, -1, -1)
+
+        old = self.points.reshape(-1, 2)[good]
+        new = forward.reshape(-1, 2)[good]
+        dx, dy = np.median(new - old, axis=0)
+        # Scale is the median ratio of the distances between every pair of points
+        first, second = np.triu_indices(len(old), k=1)
+        old_distance = np.linalg.norm(old[first] - old[second], axis=1)
+        new_distance = np.linalg.norm(new[first] - new[second], axis=1)
+        valid = old_distance > 1e-3
+        scale = (
+            float(np.median(new_distance[valid] / old_distance[valid]))
+            if np.any(valid)
+            else 1.0
+        )
+
+        x, y, width, height = self.box
+        new_width, new_height = width * scale, height * scale
+        x += dx - (new_width - width) / 2
+        y += dy - (new_height - height) / 2
+        self.box = (x, y, new_width, new_height)
+        self.points = new.reshape(-1, 1, 2).astype(np.float32)
+        if len(self.points) < self.max_corners // 2:
+            # Top the corners back up before too many of them have drifted off
+            self.points = self.__find_points(gray, self.box)
+        return True, tuple(int(round(i)) for i in self.box)
+
+    def __find_points(
+        self, gray: ndarray, box: Tuple[float, float, float, float]
+    ) -> ndarray | None:
+        x, y, width, height = (int(round(i)) for i in box)
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(gray.shape[1], x + width), min(gray.shape[0], y + height)
+        if x1 - x0 < 2 or y1 - y0 < 2:
+            return None
+        mask = np.zeros_like(gray)
+        mask[y0:y1, x0:x1] = 255
+        return cv2.goodFeaturesToTrack(
+            gray,
+            maxCorners=self.max_corners,
+            qualityLevel=0.01,
+            minDistance=3,
+            mask=mask,
+        )
+
+    @staticmethod
+    def __gray(frame: Frame) -> ndarray:
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+
+
+Tracker = cv2.Tracker | OpticalFlowTracker
+
+TRACKER_BACKENDS: Dict[str, Callable[[], Tracker]] = {
+    "csrt": cv2.TrackerCSRT.create,
+    "kcf": cv2.TrackerKCF.create,
+    # MOSSE only survives in the legacy module of opencv-contrib
+    "mosse": lambda: cv2.legacy.TrackerMOSSE.create(),
+    "mil": cv2.TrackerMIL.create,
+    "lk": OpticalFlowTracker,
+}
+
+
+def create_tracker(name: str = "csrt") -> Tracker:
+    """
+    Creates a fresh tracker of the given backend
+    """
+    try:
+        factory = TRACKER_BACKENDS[name.lower()]
+    except KeyError:
+        raise ValueError(
+            f"Unknown tracker {name!r}, choose one of {', '.join(TRACKER_BACKENDS)}"
+        ) from None
+    return factory()
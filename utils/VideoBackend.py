@@ -0,0 +1,162 @@
+"""
+Selectable video decoding backends
+
+Every capture has IndexedCapture's interface: seek(n) makes the next read return frame n, grab(), read(), get(prop),
+isOpened(), release() and frame_count, so the frame sources, the validator's prefetcher and export don't care
+which one decodes
+
+cv2  : OpenCV's FFmpeg capture, seeking through the keyframe index, with decode_threads codec threads (0 lets FFmpeg pick)
+pyav : PyAV, decoding with frame and slice threads. read_scaled converts straight to the scaled BGR frame in
+       libswscale, so the full size BGR frame is never made. Optional, install it with pip install av
+
+PyAV is only imported once a pyav capture is opened
+"""
+
+from typing import Any, Tuple
+
+import cv2
+from numpy import dtype, floating, integer, ndarray
+
+from utils.FrameIndex import FrameIndex, IndexedCapture
+
+Frame = cv2.Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]]
+
+CAPTURE_BACKENDS: Tuple[str, ...] = ("cv2", "pyav")
+
+
+class PyAVCapture:
+    """
+    IndexedCapture's interface on top of PyAV, seeks land on the keyframe before the frame and decode forward
+    to the frame's pts, taken from the keyframe index when there is one and from the frame rate otherwise
+    """
+
+    def __init__(
+        self, video_path: str, index: FrameIndex | None = None, decode_threads: int = 0
+    ):
+        try:
+            import av
+        except ImportError:
+            raise ValueError(
+                "The pyav backend needs PyAV, install it with pip install av"
+            ) from None
+        self.av = av
+        self.container = av.open(video_path)
+        self.stream = self.container.streams.video[0]
+        # Frame and slice threading, FFmpeg picks the thread count unless one is given
+        self.stream.thread_type = "AUTO"
+        if decode_threads > 0:
+            self.stream.codec_context.thread_count = decode_threads
+        self.index: FrameIndex | None = index
+        self.fps: float = float(
+            self.stream.average_rate or self.stream.guessed_rate or 30
+        )
+        self.frames = self.container.decode(self.stream)
+        # A seek decodes the frame it was asked for to find it, the next read returns it
+        self.pending = None
+        self.opened: bool = True
+
+    @property
+    def frame_count(self) -> int:
+        if self.index is not None:
+            return len(self.index)
+        return int(self.stream.frames)
+
+    def get(self, prop: int) -> float:
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.stream.codec_context.width)
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.stream.codec_context.height)
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return float(self.frame_count)
+        return 0.0
+
+    def isOpened(self) -> bool:
+        return self.opened
+
+    def __next_frame(self):
+        if self.pending is not None:
+            frame, self.pending = self.pending, None
+            return frame
+        try:
+            return next(self.frames)
+        except (StopIteration, self.av.error.EOFError):
+            return None
+
+    def seek(self, frame_number: int) -> None:
+        """
+        The next read returns frame_number
+        """
+        self.pending = None
+        time_base = float(self.stream.time_base)
+        start = self.stream.start_time or 0
+        if self.index is not None and 0 <= frame_number < len(self.index):
+            target = int(self.index.pts[frame_number])
+            keyframe = int(
+                self.index.pts[
+                    self.index.keyframes[self.index.keyframe_before(frame_number)]
+                ]
+            )
+        else:
+            target = start + int(round(frame_number / self.fps / time_base))
+            keyframe = target
+        self.container.seek(keyframe, stream=self.stream, backward=True)
+        self.frames = self.container.decode(self.stream)
+        # Decoding restarts at the keyframe, step forward to the first frame at or past the target
+        while (frame := self.__next_frame()) is not None:
+            if frame.pts is None or frame.pts >= target:
+                self.pending = frame
+                return
+
+    def grab(self) -> bool:
+        return self.__next_frame() is not None
+
+    def read(self, image: ndarray | None = None) -> Tuple[bool, Frame | None]:
+        """
+        image is only there for IndexedCapture's interface, PyAV always hands over a new array
+        """
+        frame = self.__next_frame()
+        if frame is None:
+            return False, None
+        return True, frame.to_ndarray(format="bgr24")
+
+    def read_scaled(self, width: int, height: int) -> Tuple[bool, Frame | None]:
+        """
+        The next frame converted and scaled to width x height in one libswscale pass
+        """
+        frame = self.__next_frame()
+        if frame is None:
+            return False, None
+        return (
+            True,
+            frame.reformat(
+                width=width, height=height, format="bgr24", interpolation="AREA"
+            ).to_ndarray(),
+        )
+
+    def release(self) -> None:
+        if self.opened:
+            self.container.close()
+            self.opened = False
+
+
+Capture = IndexedCapture | PyAVCapture
+
+
+def open_capture(
+    video_path: str,
+    index: FrameIndex | None = None,
+    backend: str = "cv2",
+    decode_threads: int = 0,
+) -> Capture:
+    """
+    Opens the video with the given backend
+    """
+    if backend == "cv2":
+        return IndexedCapture(video_path, index, decode_threads)
+    if backend == "pyav":
+        return PyAVCapture(video_path, index, decode_threads)
+    raise ValueError(
+        f"Unknown video backend {backend!r}, choose one of {', '.join(CAPTURE_BACKENDS)}"
+    )
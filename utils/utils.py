@@ -2,12 +2,32 @@
 Useful shared code functions
 """
 
+import os
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
-from typing import Any, List
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Sequence, Tuple
 import cv2
+import numpy as np
 from numpy import ndarray
 from numpy import dtype, floating, integer, ndarray
-from screeninfo import get_monitors
+
+INFOBAR_FONT: int = cv2.FONT_HERSHEY_SIMPLEX
+INFOBAR_THICKNESS: int = 2
+# (x, y) coordinates for bottom-left corner of the text
+INFOBAR_ORIGIN: Tuple[int, int] = (10, 30)
+# Box colors (B, G, R) of the tracks of a multi object session, the first track keeps the usual green
+TRACK_COLORS: List[Tuple[int, int, int]] = [
+    (0, 255, 0),
+    (255, 0, 0),
+    (0, 165, 255),
+    (255, 0, 255),
+    (255, 255, 0),
+    (0, 255, 255),
+    (128, 0, 255),
+    (0, 128, 128),
+    (128, 128, 255),
+]
 
 
 @dataclass
@@ -19,9 +39,11 @@ class Annotation:
     height: int
 
 
+@lru_cache(maxsize=256)
 def get_optimal_font_scale(text: str, width: int) -> int:
     """
     Based on width of the current image, finds a good font size to display text as
+    Memoized, the search is up to 60 getTextSize calls and the same text gets drawn on every frame
     """
     for scale in reversed(range(0, 60, 1)):
         textSize = cv2.getTextSize(
@@ -38,6 +60,9 @@ def get_optimal_window_scaling(width: int, height: int) -> float:
     Based on the screen size, return the scaling that will fit the image to the screen, keeping the aspect ratio
     of the original window
     """
+    # screeninfo is only needed here, so don't pay for importing it until a window is about to be sized
+    from screeninfo import get_monitors
+
     # First, do we need to resize?
     monitor = get_monitors()[0]
     screen_width = monitor.width
@@ -50,6 +75,38 @@ def get_optimal_window_scaling(width: int, height: int) -> float:
     return min(width_scaling, height_scaling)
 
 
+def video_window_scale(video_path: str) -> float:
+    """
+    The scale the annotation window shows the video at on this screen
+    Raises a ValueError when there is no display to ask, callers without one should take a scale as an option
+    """
+    from screeninfo.common import ScreenInfoError
+
+    cap = cv2.VideoCapture(video_path)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+    try:
+        return get_optimal_window_scaling(width, height)
+    except ScreenInfoError as error:
+        raise ValueError(
+            f"No screen to get the window's scale for {video_path} from ({error})"
+        ) from None
+
+
+def scale_boxes(
+    boxes: ndarray, factor: float, visible: ndarray | None = None
+) -> ndarray:
+    """
+    Boxes (x, y, width and height, centered or top left) scaled by factor and rounded to whole pixels, all at once
+    Only the rows marked visible are scaled, so the -1 placeholders of I and S records stay as they are
+    """
+    scaled = np.rint(np.asarray(boxes, dtype=np.float64) * factor).astype(np.int32)
+    if visible is None:
+        return scaled
+    return np.where(visible[:, None], scaled, boxes).astype(np.int32)
+
+
 def get_scaled_image(
     image: cv2.Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]], scale: float
 ) -> cv2.Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]]:
@@ -59,6 +116,92 @@ def get_scaled_image(
     return scaled_image
 
 
+def copy_into(
+    buffer: ndarray | None,
+    frame: cv2.Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]],
+) -> cv2.Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]]:
+    """
+    Copies frame into buffer and returns it, or a new copy when there is no buffer of the frame's shape yet,
+    so redrawing every frame into the window doesn't allocate a new one each time
+    """
+    if buffer is None or buffer.shape != frame.shape or buffer.dtype != frame.dtype:
+        return frame.copy()
+    np.copyto(buffer, frame)
+    return buffer
+
+
+@dataclass(frozen=True)
+class InfobarSprite:
+    """
+    The options part of an infobar rendered once, as a multiplier mask for the region it covers
+    (255 leaves the frame untouched, lower values darken it towards the black text)
+    """
+
+    mask: ndarray
+    top: int
+    left: int
+    font_scale: float
+    # Where the frame number starts, right after "Frame : "
+    number_x: int
+
+
+@lru_cache(maxsize=64)
+def get_infobar_sprite(
+    options: Tuple[str, ...], width: int, frame_digits: int
+) -> InfobarSprite:
+    """
+    Renders everything of the infobar but the frame number, the font scale is picked for a frame number
+    with the given amount of digits, exactly as if the whole text was drawn (Hershey digits are all as wide)
+    """
+    text = ""
+    for option in options:
+        text = text + option + " | "
+    text += "Frame : "
+    font_scale = get_optimal_font_scale(text + "0" * frame_digits, width)
+
+    (text_width, _), baseline = cv2.getTextSize(
+        text, INFOBAR_FONT, font_scale, INFOBAR_THICKNESS
+    )
+    # putText starts every string with the same padding, so the number goes where it would have been in the full text
+    number_offset = (
+        cv2.getTextSize(
+            text + "0" * frame_digits, INFOBAR_FONT, font_scale, INFOBAR_THICKNESS
+        )[0][0]
+        - cv2.getTextSize(
+            "0" * frame_digits, INFOBAR_FONT, font_scale, INFOBAR_THICKNESS
+        )[0][0]
+    )
+    org_x, org_y = INFOBAR_ORIGIN
+    coverage = np.zeros(
+        (
+            org_y + baseline + INFOBAR_THICKNESS,
+            org_x + text_width + INFOBAR_THICKNESS,
+            3,
+        ),
+        dtype=np.uint8,
+    )
+    cv2.putText(
+        coverage,
+        text,
+        INFOBAR_ORIGIN,
+        INFOBAR_FONT,
+        font_scale,
+        (255, 255, 255),
+        INFOBAR_THICKNESS,
+        cv2.LINE_AA,
+    )
+    # Only keep the rows and columns the text actually touches
+    rows = np.flatnonzero(coverage.any(axis=(1, 2)))
+    cols = np.flatnonzero(coverage.any(axis=(0, 2)))
+    if len(rows) == 0:
+        return InfobarSprite(
+            np.zeros((0, 0, 3), dtype=np.uint8), 0, 0, font_scale, org_x + number_offset
+        )
+    top, left = int(rows[0]), int(cols[0])
+    mask = 255 - coverage[top : rows[-1] + 1, left : cols[-1] + 1]
+    return InfobarSprite(mask, top, left, font_scale, org_x + number_offset)
+
+
 def apply_infobar(
     frame: cv2.Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]],
     options: List[str],
@@ -68,37 +211,160 @@ def apply_infobar(
     """
     Applies the keyboard shortcuts, as well as the current frame number to the top left of the
     current frame
+    The options are blitted from a cached sprite, only the frame number is drawn per frame
     """
-    text = ""
-    for option in options:
-        text = text + option + " | "
-
-    # Add the frame number now
-    str_frame: str = f"Frame : {frame_number}"
-    text += str_frame
-    font = cv2.FONT_HERSHEY_SIMPLEX
-    font_scale = get_optimal_font_scale(text, width)
+    str_frame: str = str(frame_number)
+    sprite = get_infobar_sprite(tuple(options), width, len(str_frame))
+    height = min(sprite.mask.shape[0], frame.shape[0] - sprite.top)
+    sprite_width = min(sprite.mask.shape[1], frame.shape[1] - sprite.left)
+    if height > 0 and sprite_width > 0:
+        region = frame[
+            sprite.top : sprite.top + height, sprite.left : sprite.left + sprite_width
+        ]
+        # Same result as drawing the black anti-aliased text, region * (1 - coverage)
+        cv2.multiply(
+            region,
+            sprite.mask[:height, :sprite_width],
+            dst=region,
+            scale=1 / 255,
+        )
     color = (0, 0, 0)
-    thickness = 2
-    org = (10, 30)  # (x, y) coordinates for bottom-left corner of the text
     return cv2.putText(
-        frame, text, org, font, font_scale, color, thickness, cv2.LINE_AA
+        frame,
+        str_frame,
+        (sprite.number_x, INFOBAR_ORIGIN[1]),
+        INFOBAR_FONT,
+        sprite.font_scale,
+        color,
+        INFOBAR_THICKNESS,
+        cv2.LINE_AA,
     )
 
 
-def read_annotations(annotation_path: str) -> List[Annotation]:
-    ret = []
-    with open(annotation_path, "r") as file:
-        for line in file:
-            split_line = line.strip().split(" ")
-            # convert center x center y width and height strings to ints
-            ret.append(
-                Annotation(
-                    split_line[0],
-                    int(split_line[1]),
-                    int(split_line[2]),
-                    int(split_line[3]),
-                    int(split_line[4]),
+def draw_tracks(
+    frame: cv2.Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]],
+    annotations: List[Annotation],
+    height: int,
+    width: int,
+    active_track: int = -1,
+    interpolated: List[bool] | None = None,
+) -> None:
+    """
+    Draws every track of a frame, visible ones as a box in the track's color labelled with its number,
+    the statuses of the others as one line of text at the bottom of the frame
+    The active track's box is drawn thicker, interpolated boxes thinner
+    """
+    statuses: List[str] = []
+    for track, annotation in enumerate(annotations):
+        color = TRACK_COLORS[track % len(TRACK_COLORS)]
+        if annotation.annotation_type != "V":
+            statuses.append(f"{track + 1}: {annotation.annotation_type}")
+            continue
+        top_left = (
+            annotation.center_x - int(annotation.width / 2),
+            annotation.center_y - int(annotation.height / 2),
+        )
+        bottom_right = (
+            annotation.center_x + int(annotation.width / 2),
+            annotation.center_y + int(annotation.height / 2),
+        )
+        thickness = 3 if track == active_track else 2
+        if interpolated is not None and interpolated[track]:
+            thickness = 1
+        cv2.rectangle(frame, top_left, bottom_right, color, thickness)
+        cv2.putText(
+            frame,
+            str(track + 1),
+            (top_left[0], max(top_left[1] - 5, 15)),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.6,
+            color,
+            2,
+            cv2.LINE_AA,
+        )
+    if statuses:
+        text = "Tracks " + "  ".join(statuses)
+        cv2.putText(
+            frame,
+            text,
+            (0, int(height * 0.95)),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            get_optimal_font_scale(text, width),
+            (0, 0, 255),
+            2,
+            cv2.LINE_AA,
+        )
+
+
+def box_iou(boxes_a: ndarray, boxes_b: ndarray) -> ndarray:
+    """
+    Row by row intersection over union of two (N, 4) arrays of (center x, center y, width, height) boxes
+    """
+    boxes_a = np.asarray(boxes_a, dtype=np.float64)
+    boxes_b = np.asarray(boxes_b, dtype=np.float64)
+    half_a = boxes_a[:, 2:] / 2
+    half_b = boxes_b[:, 2:] / 2
+    lower = np.maximum(boxes_a[:, :2] - half_a, boxes_b[:, :2] - half_b)
+    upper = np.minimum(boxes_a[:, :2] + half_a, boxes_b[:, :2] + half_b)
+    intersection = np.prod(np.clip(upper - lower, 0, None), axis=1)
+    union = (
+        np.prod(boxes_a[:, 2:], axis=1) + np.prod(boxes_b[:, 2:], axis=1) - intersection
+    )
+    return np.divide(
+        intersection, union, out=np.zeros_like(intersection), where=union > 0
+    )
+
+
+def read_annotation_tracks(
+    annotation_path: str, window_scale: float = 0
+) -> List[List[Annotation]]:
+    """
+    Every track of an annotation file in either format, one list of per frame annotations each
+    With window_scale, boxes stored in the video's pixels are mapped to a window at that scale
+    """
+    # Imported here, AnnotationStore itself imports this module
+    from utils.AnnotationStore import AnnotationStore
+
+    tracks = []
+    for store in AnnotationStore.load_tracks(annotation_path):
+        if window_scale > 0:
+            store = store.at_scale(window_scale)
+        tracks.append(
+            [
+                Annotation(chr(annotation_type), *box)
+                for annotation_type, box in zip(
+                    store.types.tolist(), store.boxes.tolist()
                 )
-            )
-    return ret
+            ]
+        )
+    return tracks
+
+
+def read_annotations(annotation_path: str, window_scale: float = 0) -> List[Annotation]:
+    """
+    The annotations of a single object file, see read_annotation_tracks for files with several tracks
+    """
+    tracks = read_annotation_tracks(annotation_path, window_scale)
+    if len(tracks) > 1:
+        raise ValueError(
+            f"{annotation_path} has {len(tracks)} tracks, read it with read_annotation_tracks"
+        )
+    return tracks[0]
+
+
+def map_files(
+    function: Callable[..., Dict], *arguments: Sequence, workers: int = 0
+) -> List[Dict]:
+    """
+    function applied to every set of arguments in order, on a pool of workers processes (one per core for 0)
+    One call, or a single worker, runs in this process
+    """
+    workers = workers if workers > 0 else (os.cpu_count() or 1)
+    calls = min((len(argument) for argument in arguments), default=0)
+    if workers == 1 or calls <= 1:
+        return [function(*call) for call in zip(*arguments)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Annotation files are small, batching them keeps the pool's overhead per file down
+        return list(
+            pool.map(function, *arguments, chunksize=max(1, calls // (workers * 4)))
+        )